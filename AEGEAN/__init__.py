@@ -10,7 +10,11 @@ import matplotlib.pyplot as plt
 
 from .init import *
 from .models import *
+from .dataset import *
 from .utils import *
+from .diagnostics import *
+from .augment import *
+from .history import *
 from .aegean import *
 
-__all__ = ["utils", "models", "init", "aegean"]
+__all__ = ["utils", "models", "init", "dataset", "diagnostics", "augment", "history", "aegean"]
@@ -3,15 +3,23 @@ import time
 import numpy as np
 
 import torch
-torch.autograd.set_detect_anomaly(True)
 from torch.autograd import Variable
 import torch.nn.functional as F
 import torch.nn as nn
 
 # from .init import init
-from .utils import print_network, sampling
-from .utils import init_hist, load_data, weights_init_normal, save_hist_batch
+from .utils import print_network, sampling, slerp, NoisePool
+from .utils import init_hist, load_data, weights_init_normal
 from .models import Generator, Discriminator, Encoder
+from .diagnostics import Diagnostics
+from .augment import BatchAugment
+from .metrics import MetricsAccumulator
+from .timers import PhaseTimer
+from .history import History
+from .checkpoint import save_checkpoint, load_checkpoint, get_rng_state, set_rng_state
+from .checkpoint import read_status, write_status, is_running
+from .experiments import write_config, config_diff
+from .init import REUSE_LATENT
 
 try:
     # to use with `$ tensorboard --logdir runs`
@@ -21,22 +29,93 @@ except:  # ImportError:
     do_tensorboard = False
     print("Failed loading Tensorboard.")
 
+def estimate_step_time(opt, encoder, generator, discriminator, device, autocast, scaler, n_iter=3):
+    """
+    Lower bound of the duration of a training iteration: forward and backward
+    passes through E, G and D on a random batch (the gradients are discarded),
+    with the mixed precision of the training (autocast and scaler, see opt.amp).
+
+    """
+    imgs = torch.rand(opt.batch_size, opt.channels, opt.img_size, opt.img_size, device=device)
+    models = [encoder, generator, discriminator]
+    for model in models: model.eval()
+
+    def iteration():
+        with autocast():
+            gen_imgs = generator(encoder(imgs))
+            loss = (gen_imgs - imgs).pow(2).mean() + discriminator(gen_imgs).float().mean()
+        scaler.scale(loss).backward()
+
+    iteration() # warm-up
+    if device.type == 'cuda': torch.cuda.synchronize()
+    t0 = time.time()
+    for _ in range(n_iter): iteration()
+    if device.type == 'cuda': torch.cuda.synchronize()
+    step_time = (time.time() - t0) / n_iter
+    for model in models:
+        model.zero_grad(set_to_none=True)
+        model.train()
+    print(f"[Estimated step time: {step_time:.4f}s]")
+    return step_time
+
 def learn(opt, run_dir="./runs"):
+    """
+    Trains a run unless it is done or running: a new run starts from scratch,
+    an incomplete run (killed, failed) resumes from its last checkpoint.
+
+    """
     os.makedirs(run_dir, exist_ok=True)
     path_data = os.path.join(run_dir, opt.run_path)
-    if not os.path.isdir(path_data):
-        os.makedirs(path_data, exist_ok=True)
-        do_learn(opt)
-
-def do_learn(opt, run_dir="./runs"):
-    print('Starting ', opt.run_path)
+    try:
+        os.makedirs(path_data)
+        resume = False
+    except FileExistsError:
+        status = read_status(path_data)
+        if status is None or status['status'] == 'done':
+            # runs without status marker predate checkpoints and are considered as done
+            return
+        if is_running(status):
+            print('Skipping ', opt.run_path, ': running on ', status['host'], ' with PID ', status['pid'])
+            return
+        resume = True
+    try:
+        do_learn(opt, run_dir, resume=resume)
+    except BaseException:
+        write_status(path_data, 'failed')
+        raise
+
+def do_learn(opt, run_dir="./runs", resume=False, dataloader=None):
+    """
+    Trains the models of a run (see learn). dataloader replaces the images of
+    opt.datapath (batches of (images in [0, 1], names), e.g. for benchmarks).
+
+    outputs the history of the run (see History)
+    """
+    print('Resuming ' if resume else 'Starting ', opt.run_path)
+    # options set from Python are not checked by the parser
+    if not opt.reuse_latent in REUSE_LATENT:
+        raise ValueError(f'Unknown reuse_latent {opt.reuse_latent!r}, expected one of {REUSE_LATENT}')
     path_data = os.path.join(run_dir, opt.run_path)
+    os.makedirs(path_data, exist_ok=True)
+    checkpoint = load_checkpoint(path_data) if (resume or opt.load_model) else None
+    start_epoch = 1 if checkpoint is None else checkpoint['epoch'] + 1
+    if not checkpoint is None:
+        diff = config_diff(checkpoint['opt'], opt)
+        if diff:
+            raise ValueError(f'The checkpoint of {opt.run_path} was trained with different options: ' +
+                             ', '.join(f'{key}={saved!r} (now {value!r})' for key, (saved, value) in diff.items()))
+    # a resumed run keeps the epoch and timings of its previous status until its next epoch
+    previous = (read_status(path_data) or {}) if not checkpoint is None else {}
+    write_status(path_data, 'running', epoch=start_epoch - 1,
+                 **{key: previous[key] for key in ('epoch_time', 'phases') if key in previous})
+    write_config(path_data, opt)
     # ----------
     #  Tensorboard
     # ----------
     if do_tensorboard:
         # stats are stored in "runs", within subfolder opt.run_path.
-        writer = SummaryWriter(log_dir=path_data)
+        # events after the checkpoint are discarded when resuming
+        writer = SummaryWriter(log_dir=path_data, purge_step=None if checkpoint is None else start_epoch)
 
     # Create a time tag
     import datetime
@@ -49,11 +128,6 @@ def do_learn(opt, run_dir="./runs"):
     tag = tag.replace(':', '-')
 
 
-    # Configure data loader
-    dataloader = load_data(opt.datapath, opt.img_size, opt.batch_size,
-                           rand_hflip=opt.rand_hflip, rand_affine=opt.rand_affine)
-
-
     if opt.do_SSIM:
         # from pytorch_msssim import NMSSSIM
         # E_loss = NMSSSIM(window_size=opt.window_size, val_range=1., size_average=True, channel=3, normalize=True)
@@ -79,6 +153,10 @@ def do_learn(opt, run_dir="./runs"):
         print_network(discriminator)
         print_network(encoder)
 
+    # diagnostics are attached as hooks only when requested, `verbose` traces the shapes
+    diagnostics = Diagnostics(opt.diagnostics or ('shapes' if opt.verbose else ''))
+    diagnostics.attach(encoder, generator, discriminator).start()
+
     eye = 1 - torch.eye(opt.batch_size)
     use_cuda = True if torch.cuda.is_available() else False
     if use_cuda:
@@ -98,6 +176,14 @@ def do_learn(opt, run_dir="./runs"):
     else:
         print("Running on CPU ")
         Tensor = torch.FloatTensor
+    device = torch.device('cuda' if use_cuda else 'cpu')
+
+    # mixed precision: bfloat16 autocast on CPU, float16 with loss scaling on GPU
+    # losses, hardsoft and the SSIM statistics are computed in float32
+    amp_dtype = torch.float16 if use_cuda else torch.bfloat16
+    def autocast():
+        return torch.autocast(device_type=device.type, dtype=amp_dtype, enabled=opt.amp)
+    scaler = torch.cuda.amp.GradScaler(enabled=opt.amp and use_cuda)
 
     # Initialize weights
     if opt.init_weight:
@@ -138,20 +224,34 @@ def do_learn(opt, run_dir="./runs"):
     #  Training
     # ----------
 
+    # Configure data loader
+    # (data augmentation is applied on the device to whole batches, see BatchAugment)
+    step_time = None
+    if opt.num_workers == -1 and dataloader is None:
+        step_time = estimate_step_time(opt, encoder, generator, discriminator, device, autocast, scaler)
+    if dataloader is None:
+        dataloader = load_data(opt.datapath, opt.img_size, opt.batch_size,
+                               mode=opt.data_mode, cache_size=opt.cache_size, seed=opt.seed,
+                               num_workers=opt.num_workers, prefetch_factor=opt.prefetch_factor,
+                               persistent_workers=opt.persistent_workers, pin_memory=opt.pin_memory,
+                               step_time=step_time)
+
     nb_batch = len(dataloader)
+    if nb_batch == 0:
+        raise ValueError(f'No batch to train on: {opt.datapath} has less than batch_size={opt.batch_size} images')
 
     stat_record = init_hist(opt.n_epochs, nb_batch)
-
-    # https://github.com/soumith/dcgan.torch/issues/14  dribnet commented on 21 Mar 2016
-    # https://arxiv.org/abs/1609.04468
-    def slerp(val, low, high):
-        corr = np.diag((low/np.linalg.norm(low)) @ (high/np.linalg.norm(high)).T)
-        omega = np.arccos(np.clip(corr, -1, 1))[:, None]
-        so = np.sin(omega)
-        out =  np.sin((1.0-val)*omega) / so * low + np.sin(val*omega) / so * high
-        # L'Hopital's rule/LERP
-        out[so[:, 0] == 0, :] = (1.0-val) * low[so[:, 0] == 0, :] + val * high[so[:, 0] == 0, :]
-        return out
+    # time spent in each phase of the loop, with device synchronization (off by default)
+    timers = PhaseTimer(device, enabled=opt.timers)
+    metrics = MetricsAccumulator(stat_record, device, run_path=opt.run_path, n_epochs=opt.n_epochs, nb_batch=nb_batch,
+                                 flush_every=opt.metrics_interval, print_interval=opt.print_interval)
+
+    # random numbers for the latent vectors are drawn on the device
+    gen = torch.Generator(device=device)
+    if opt.seed is None:
+        gen.seed()
+    else:
+        gen.manual_seed(opt.seed)
 
     def norm2(z):
         """
@@ -162,45 +262,61 @@ def do_learn(opt, run_dir="./runs"):
         # return torch.mean(z.pow(2)).pow(.5)
         return (z**2).sum().sqrt()
 
-    def gen_z(imgs=None, rho=.25, do_slerp=opt.do_slerp):
+    def gen_z(imgs=None, z_imgs=None, rho=.25, do_slerp=opt.do_slerp):
         """
-        Generate noise in the feature space.
+        Generate noise in the feature space, around the latents of imgs
+        (or around z_imgs if these latents are already computed).
 
         outputs a vector
         """
-        if not imgs is None:
-            z_imgs = encoder(imgs).cpu().numpy()
+        if z_imgs is None and not imgs is None:
+            with autocast():
+                z_imgs = encoder(imgs).detach().float()
+        if not z_imgs is None:
             if do_slerp:
-                z_shuffle = z_imgs.copy()
-                z_shuffle = z_shuffle[torch.randperm(opt.batch_size), :]
+                z_shuffle = z_imgs[torch.randperm(z_imgs.shape[0], generator=gen, device=device), :]
                 z = slerp(rho, z_imgs, z_shuffle)
             else:
+                z = torch.randn(z_imgs.shape, generator=gen, device=device)
                 z /= norm2(z)
-                z_imgs /= norm2(z_imgs)
+                z_imgs = z_imgs / norm2(z_imgs)
                 z = (1-rho) * z_imgs + rho * z
                 z /= norm2(z)
         else:
-            z = np.random.normal(0, 1, (opt.batch_size, opt.latent_dim))
-        # convert to tensor
-        return Variable(Tensor(z), requires_grad=False)
+            z = torch.randn((opt.batch_size, opt.latent_dim), generator=gen, device=device)
+        return z
 
-    def gen_noise(imgs):
-        """
-        Generate noise in the image space
-
-        outputs an image
-        """
-        v_noise = np.random.normal(0, 1, imgs.shape) # one random image
-        # one contrast value per image
-        v_noise *= np.abs(np.random.normal(0, 1, (imgs.shape[0], opt.channels, 1, 1)))
-        # convert to tensor
-        v_noise =  Variable(Tensor(v_noise), requires_grad=False)
-        return v_noise
+    # noise in the image space and smoothed labels are drawn in buffers on the device
+    noise_pool = NoisePool(device, valid_smooth=opt.valid_smooth, seed=opt.seed)
+    # random flips and rotations, drawn from a stream distinct from the latents and the noise
+    augment = BatchAugment(rand_hflip=opt.rand_hflip, rand_affine=opt.rand_affine, device=device,
+                           seed=None if opt.seed is None else opt.seed + 100)
 
     # Vecteur z fixe pour faire les samples
     fixed_noise = gen_z()
     real_imgs_samples = None
 
+    if checkpoint is not None:
+        print('Resuming from epoch ', start_epoch)
+        encoder.load_state_dict(checkpoint['encoder'])
+        generator.load_state_dict(checkpoint['generator'])
+        discriminator.load_state_dict(checkpoint['discriminator'])
+        optimizer_E.load_state_dict(checkpoint['optimizer_E'])
+        optimizer_D.load_state_dict(checkpoint['optimizer_D'])
+        optimizer_G.load_state_dict(checkpoint['optimizer_G'])
+        scaler.load_state_dict(checkpoint['scaler'])
+        # checkpoints from before History hold the per-batch arrays of the last epoch only
+        if isinstance(checkpoint['stat_record'], History):
+            stat_record = checkpoint['stat_record']
+            metrics.hist = stat_record
+        fixed_noise = checkpoint['fixed_noise'].to(device)
+        real_imgs_samples = checkpoint['real_imgs_samples'].to(device)
+        gen.set_state(checkpoint['gen'])
+        noise_pool.load_state_dict(checkpoint['noise_pool'])
+        augment.load_state_dict(checkpoint['augment'])
+        set_rng_state(checkpoint['rng'])
+        del checkpoint
+
     # z_zeros = Variable(Tensor(opt.batch_size, opt.latent_dim).fill_(0), requires_grad=False)
     # z_ones = Variable(Tensor(opt.batch_size, opt.latent_dim).fill_(1), requires_grad=False)
     # Adversarial ground truths
@@ -208,8 +324,15 @@ def do_learn(opt, run_dir="./runs"):
     # fake = Variable(Tensor(opt.batch_size, 1).fill_(0), requires_grad=False)
 
     t_total = time.time()
-    for i_epoch, epoch in enumerate(range(1, opt.n_epochs + 1)):
+    epoch = start_epoch - 1
+    for epoch in range(start_epoch, opt.n_epochs + 1):
+        i_epoch = epoch - 1
         t_epoch = time.time()
+        if hasattr(dataloader.dataset, 'set_epoch'):
+            dataloader.dataset.set_epoch(epoch)
+        encoder_saved = 0 # number of forward passes of the encoder saved by opt.reuse_latent
+        timers.switch('data')
+        iteration = -1
         for iteration, (imgs, _) in enumerate(dataloader):
             t_batch = time.time()
 
@@ -224,7 +347,8 @@ def do_learn(opt, run_dir="./runs"):
             for p in discriminator.parameters():
                 p.requires_grad = False  # to avoid learning D when learning E
 
-            real_imgs = Variable(imgs.type(Tensor), requires_grad=False)
+            real_imgs = augment(imgs.to(device, non_blocking=True))
+            timers.switch('E')
 
             # init samples used to visualize performance of the AE
             if real_imgs_samples is None:
@@ -232,13 +356,15 @@ def do_learn(opt, run_dir="./runs"):
 
             # add noise here to real_imgs
             real_imgs_ = real_imgs * 1.
-            if opt.E_noise > 0: real_imgs_ += opt.E_noise * gen_noise(real_imgs)
+            if opt.E_noise > 0: real_imgs_.add_(noise_pool.image_noise('E', real_imgs.shape), alpha=opt.E_noise)
 
-            z_imgs = encoder(real_imgs_)
-            decoded_imgs = generator(z_imgs)
+            with autocast():
+                z_imgs = encoder(real_imgs_)
+                decoded_imgs = generator(z_imgs)
+            z_imgs = z_imgs.float()
 
             # Loss measures Encoder's ability to generate vectors suitable with the generator
-            e_loss = 1.-E_loss(real_imgs, decoded_imgs)
+            e_loss = 1.-E_loss(real_imgs, decoded_imgs.float())
             # energy = 1. # E_loss(real_imgs, zero_target)  # normalize on the energy of imgs
             # if opt.do_joint:
             #     e_loss = E_loss(real_imgs, decoded_imgs) / energy
@@ -252,17 +378,15 @@ def do_learn(opt, run_dir="./runs"):
 
             # Backward
             optimizer_E.zero_grad()
-            e_loss.backward()
-            optimizer_E.step()
+            scaler.scale(e_loss).backward()
+            scaler.step(optimizer_E)
 
-            valid_smooth = np.random.uniform(opt.valid_smooth, 1.0-(1-opt.valid_smooth)/2, (opt.batch_size, 1))
-            valid_smooth = Variable(Tensor(valid_smooth), requires_grad=False)
-            fake_smooth = np.random.uniform((1-opt.valid_smooth)/2, 1-opt.valid_smooth, (opt.batch_size, 1))
-            fake_smooth = Variable(Tensor(fake_smooth), requires_grad=False)
+            valid_smooth, fake_smooth = noise_pool.labels(opt.batch_size)
 
             # ---------------------
             #  Train Discriminator
             # ---------------------
+            timers.switch('D')
             # Discriminator Requires grad, Encoder + Generator requires_grad = False
             for p in discriminator.parameters():
                 p.requires_grad = True
@@ -271,19 +395,33 @@ def do_learn(opt, run_dir="./runs"):
             for p in encoder.parameters():
                 p.requires_grad = False  # to avoid computation
 
-            # Configure input
-            real_imgs = Variable(imgs.type(Tensor), requires_grad=False)
+            # Configure input (real_imgs is already on the device)
             real_imgs_ = real_imgs * 1.
-            if opt.D_noise > 0: real_imgs_ += opt.D_noise * gen_noise(real_imgs)
+            if opt.D_noise > 0: real_imgs_.add_(noise_pool.image_noise('D', real_imgs.shape), alpha=opt.D_noise)
+
+            # latents of the real images shared by the D and G steps
+            if opt.reuse_latent == 'detach':
+                # output of the E step, before the update of the encoder
+                z_real = z_imgs.detach()
+                encoder_saved += 2 + opt.do_insight
+            elif opt.reuse_latent == 'recompute':
+                with torch.no_grad(), autocast():
+                    z_real = encoder(real_imgs_).float()
+                encoder_saved += 1 + opt.do_insight
+            else:
+                z_real = None
+
             if opt.do_insight:
                 # the discriminator can not access the images directly but only
                 # what is visible through the auto-encoder
-                real_imgs_ = generator(encoder(real_imgs_))
+                with autocast():
+                    real_imgs_ = generator(encoder(real_imgs_) if z_real is None else z_real).float()
 
             # Discriminator decision (in logit units)
             # TODO : group images by sub-batches and train to discriminate from all together
             # should allow to avoid mode collapse
-            logit_d_x = discriminator(real_imgs_)
+            with autocast():
+                logit_d_x = discriminator(real_imgs_).float()
 
             # ---------------------
             #  Train Discriminator
@@ -316,12 +454,14 @@ def do_learn(opt, run_dir="./runs"):
             else: print ('GAN_loss not defined', opt.GAN_loss)
 
             # Generate a batch of fake images and learn the discriminator to treat them as such
-            z = gen_z(imgs=real_imgs_)
-            gen_imgs = generator(z)
-            if opt.D_noise > 0: gen_imgs += opt.D_noise * gen_noise(real_imgs)
+            z = gen_z(imgs=real_imgs_, z_imgs=z_real)
+            with autocast():
+                gen_imgs = generator(z).float()
+            if opt.D_noise > 0: gen_imgs.add_(noise_pool.image_noise('D', real_imgs.shape), alpha=opt.D_noise)
 
             # Discriminator decision for fake data
-            logit_d_fake = discriminator(gen_imgs.detach())
+            with autocast():
+                logit_d_fake = discriminator(gen_imgs.detach()).float()
             # Measure discriminator's ability to classify real from generated samples
             if opt.GAN_loss == 'wasserstein':
                 fake_loss = torch.mean(sigmoid(logit_d_fake))
@@ -344,14 +484,15 @@ def do_learn(opt, run_dir="./runs"):
 
             # Backward
             optimizer_D.zero_grad()
-            real_loss.backward()
-            fake_loss.backward()
+            scaler.scale(real_loss).backward()
+            scaler.scale(fake_loss).backward()
             # apply the gradients
-            optimizer_D.step()
+            scaler.step(optimizer_D)
 
             # -----------------
             #  Train Generator
             # -----------------
+            timers.switch('G')
             for p in generator.parameters():
                 p.requires_grad = True
             for p in discriminator.parameters():
@@ -360,12 +501,14 @@ def do_learn(opt, run_dir="./runs"):
                 p.requires_grad = False  # to avoid computation
 
             # Generate a batch of fake images
-            z = gen_z(imgs=real_imgs_)
-            gen_imgs = generator(z)
-            if opt.G_noise > 0: gen_imgs += opt.G_noise * gen_noise(real_imgs)
+            z = gen_z(imgs=real_imgs_, z_imgs=z_real)
+            with autocast():
+                gen_imgs = generator(z).float()
+            if opt.G_noise > 0: gen_imgs.add_(noise_pool.image_noise('G', real_imgs.shape), alpha=opt.G_noise)
 
             # New discriminator decision (since we just updated D)
-            logit_d_g_z = discriminator(gen_imgs)
+            with autocast():
+                logit_d_g_z = discriminator(gen_imgs).float()
 
             # Loss functions
             # Loss measures generator's ability to fool the discriminator
@@ -398,36 +541,45 @@ def do_learn(opt, run_dir="./runs"):
             # penalize low variability in a batch, that is, mode collapse
             # TODO maximize sum of the distances to the nearest neighbors
             if opt.lambdaG > 0:
-                e_g_z = encoder(gen_imgs) # get normal vectors
+                with autocast():
+                    e_g_z = encoder(gen_imgs).float() # get normal vectors
                 Xcorr = torch.tensordot(e_g_z, torch.transpose(e_g_z, 0, 1), 1)/opt.latent_dim
                 Xcorr *= eye # set the diagonal elements to zero
                 g_loss += opt.lambdaG * torch.sum(Xcorr.pow(2)).pow(.5)
 
             # Backward
             optimizer_G.zero_grad()
-            g_loss.backward()
+            scaler.scale(g_loss).backward()
             # apply the gradients
-            optimizer_G.step()
+            scaler.step(optimizer_G)
+            # one update of the loss scale per iteration (no-op without --amp on GPU)
+            scaler.update()
 
             # -----------------
             #  Recording stats
             # -----------------
+            timers.switch('metrics')
             d_loss = real_loss + fake_loss
 
             # Compensation pour le BCElogits
             d_fake = sigmoid(logit_d_fake)
             d_x = sigmoid(logit_d_x)
             d_g_z = sigmoid(logit_d_g_z)
-            print(
-                "%s [Epoch %d/%d] [Batch %d/%d] [E loss: %f] [D loss: %f] [G loss: %f] [D(x) %f] [D(G(z)) %f] [D(G(z')) %f] [Time: %fs]"
-                % (opt.run_path, epoch, opt.n_epochs, iteration+1, len(dataloader), e_loss.item(), d_loss.item(), g_loss.item(), torch.mean(d_x), torch.mean(d_fake), torch.mean(d_g_z), time.time()-t_batch)
-            )
-            # Save Losses and scores for Tensorboard
-            save_hist_batch(stat_record, iteration, i_epoch, g_loss, d_loss, e_loss, d_x, d_g_z)
-
+            # Save Losses and scores for Tensorboard (copied to the host every opt.metrics_interval batches)
+            metrics.record(epoch, iteration, time.time()-t_batch, e_loss=e_loss, d_loss=d_loss, g_loss=g_loss,
+                           d_x=d_x, d_fake=d_fake, d_g_z=d_g_z)
+            timers.switch('data')
+
+        if iteration < 0:
+            raise RuntimeError(f'The dataloader yielded no batch at epoch {epoch}')
+        timers.switch('metrics')
+        metrics.flush(wait=True)
+        epoch_record = stat_record.end_epoch(epoch, time=time.time() - t_epoch)
+        stat_record.save(path_data)
         if do_tensorboard:
+            timers.switch('tensorboard')
             # Tensorboard save
-            writer.add_scalar('loss/E', e_loss.item(), global_step=epoch)
+            writer.add_scalar('loss/E', metrics.last['e_loss'], global_step=epoch)
             # writer.add_histogram('coeffs/z', z, global_step=epoch)
             try:
                 writer.add_histogram('coeffs/E_x', z_imgs, global_step=epoch)
@@ -442,13 +594,13 @@ def do_learn(opt, run_dir="./runs"):
             #     writer.add_histogram('image/G_z', gen_imgs, global_step=epoch)
             # except:
             #     pass
-            writer.add_scalar('loss/G', g_loss.item(), global_step=epoch)
+            writer.add_scalar('loss/G', metrics.last['g_loss'], global_step=epoch)
             # writer.add_scalar('score/D_fake', hist["d_fake_mean"][i], global_step=epoch)
             # print(stat_record["d_g_z_mean"])
-            writer.add_scalar('score/D_g_z', np.mean(stat_record["d_g_z_mean"]), global_step=epoch)
-            writer.add_scalar('loss/D', d_loss.item(), global_step=epoch)
+            writer.add_scalar('score/D_g_z', epoch_record['d_g_z'], global_step=epoch)
+            writer.add_scalar('loss/D', metrics.last['d_loss'], global_step=epoch)
 
-            writer.add_scalar('score/D_x', np.mean(stat_record["d_x_mean"]), global_step=epoch)
+            writer.add_scalar('score/D_x', epoch_record['d_x'], global_step=epoch)
 
             # Save samples
             if epoch % opt.sample_interval == 0:
@@ -459,7 +611,7 @@ def do_learn(opt, run_dir="./runs"):
                 generator.eval()
                 gen_imgs = generator(fixed_noise)
                 from torchvision.utils import make_grid
-                grid = make_grid(gen_imgs, normalize=True, nrow=16, range=(0, 1))
+                grid = make_grid(gen_imgs, normalize=True, nrow=16, value_range=(0, 1))
                 writer.add_image('Generated images', grid, epoch)
                 generator.train()
 
@@ -468,14 +620,14 @@ def do_learn(opt, run_dir="./runs"):
                 Save them to tensorboard
 
                 """
-                # grid_imgs = make_grid(real_imgs_samples, normalize=True, nrow=8, range=(0, 1))
+                # grid_imgs = make_grid(real_imgs_samples, normalize=True, nrow=8, value_range=(0, 1))
                 # writer.add_image('Images/original', grid_imgs, epoch)
 
                 generator.eval()
                 encoder.eval()
                 enc_imgs = encoder(real_imgs_samples)
                 dec_imgs = generator(enc_imgs)
-                grid_dec = make_grid(dec_imgs, normalize=True, nrow=16, range=(0, 1))
+                grid_dec = make_grid(dec_imgs, normalize=True, nrow=16, value_range=(0, 1))
                 # writer.add_image('Images/auto-encoded', grid_dec, epoch)
                 writer.add_image('Auto-encoded', grid_dec, epoch)
                 generator.train()
@@ -490,6 +642,27 @@ def do_learn(opt, run_dir="./runs"):
         #     sampling(fixed_noise, generator, path_data, epoch, tag)
         #     # do_plot(hist, start_epoch, epoch)
 
+        if not opt.reuse_latent == '':
+            print("[Encoder forwards saved: ", encoder_saved, "]")
+            if do_tensorboard:
+                writer.add_scalar('perf/encoder_forwards_saved', encoder_saved, global_step=epoch)
+        if epoch % opt.model_save_interval == 0 or epoch == opt.n_epochs:
+            timers.switch('checkpoint')
+            save_checkpoint(path_data, dict(epoch=epoch, opt=vars(opt),
+                encoder=encoder.state_dict(), generator=generator.state_dict(), discriminator=discriminator.state_dict(),
+                optimizer_E=optimizer_E.state_dict(), optimizer_D=optimizer_D.state_dict(), optimizer_G=optimizer_G.state_dict(),
+                scaler=scaler.state_dict(), stat_record=stat_record,
+                fixed_noise=fixed_noise.cpu(), real_imgs_samples=real_imgs_samples.cpu(),
+                gen=gen.get_state(), noise_pool=noise_pool.state_dict(),
+                augment=augment.state_dict(), rng=get_rng_state()))
+        phases = timers.end_epoch()
+        if phases:
+            print("[Phases: ", ', '.join(f'{phase} {t:.3f}s' for phase, t in phases.items()), "]")
+            if do_tensorboard:
+                for phase, t in phases.items():
+                    writer.add_scalar(f'time/{phase}', t, global_step=epoch)
+        write_status(path_data, 'running', epoch=epoch, epoch_time=time.time() - t_epoch, phases=phases)
+
         print("[Epoch Time: ", time.time() - t_epoch, "s]")
 
     sampling(fixed_noise, generator, path_data, epoch, tag, nrow=16)
@@ -499,5 +672,8 @@ def do_learn(opt, run_dir="./runs"):
     print("[Total Time: ", t_final.tm_mday - 1, "j:",
           time.strftime("%Hh:%Mm:%Ss", t_final), "]", sep='')
 
+    diagnostics.stop()
+    write_status(path_data, 'done', epoch=epoch)
     if do_tensorboard:
         writer.close()
+    return stat_record
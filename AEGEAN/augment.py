@@ -0,0 +1,60 @@
+"""
+Data augmentation on whole batches, on the training device.
+
+Random horizontal flips and rotations are drawn per sample and applied to the
+batch in one `affine_grid` / `grid_sample` call, with the border values
+repeated outside the image (as with the "edge" mode of `RotoTransform`).
+"""
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+
+class BatchAugment(object):
+    def __init__(self, rand_hflip=False, rand_affine=0., device='cpu', seed=None):
+        """
+        Args:
+                rand_hflip (bool): random horizontal flip with probability .5
+                rand_affine (float): maximal angle of the random rotations, in degrees
+                device: device of the batches
+                seed (int): seed of the random number generator (None: not reproducible)
+        """
+        self.rand_hflip = rand_hflip
+        self.rand_affine = rand_affine
+        self.generator = torch.Generator(device=device)
+        if seed is None:
+            self.generator.seed()
+        else:
+            self.generator.manual_seed(seed)
+        self.device = device
+
+    def __call__(self, imgs):
+        """
+        :param imgs: N x C x H x W batch, uint8 or float (on the device)
+        :return: augmented float32 batch (same range of values)
+        """
+        imgs = imgs.to(dtype=torch.float32)
+        if not self.rand_hflip and not self.rand_affine > 0:
+            return imgs
+        n = imgs.shape[0]
+        theta = (2 * torch.rand(n, generator=self.generator, device=self.device) - 1) * self.rand_affine * np.pi / 180
+        flip = torch.ones(n, device=self.device)
+        if self.rand_hflip:
+            flip[torch.rand(n, generator=self.generator, device=self.device) < .5] = -1
+        # maps the coordinates of the output to the input: rotation @ flip
+        cos, sin = torch.cos(theta), torch.sin(theta)
+        affine = torch.zeros((n, 2, 3), device=self.device)
+        affine[:, 0, 0], affine[:, 0, 1] = cos * flip, -sin
+        affine[:, 1, 0], affine[:, 1, 1] = sin * flip, cos
+        # https://pytorch.org/docs/stable/generated/torch.nn.functional.grid_sample.html
+        grid = F.affine_grid(affine, imgs.shape, align_corners=False)
+        return F.grid_sample(imgs, grid, mode='bilinear', padding_mode='border', align_corners=False)
+
+    def state_dict(self):
+        return dict(generator=self.generator.get_state())
+
+    def load_state_dict(self, state_dict):
+        self.generator.set_state(state_dict['generator'])
+
+    def __repr__(self):
+        return self.__class__.__name__ + "(rand_hflip: {}, rand_affine: {})".format(self.rand_hflip, self.rand_affine)
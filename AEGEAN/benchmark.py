@@ -0,0 +1,481 @@
+"""
+Benchmarks on synthetic data (no image database needed).
+
+    $ python3 -m AEGEAN.benchmark --bench diagnostics --img_size 64 --batch_size 32
+    $ python3 -m AEGEAN.benchmark --bench slerp --n_iter 1000
+    $ python3 -m AEGEAN.benchmark --bench noise --img_size 256
+    $ python3 -m AEGEAN.benchmark --bench amp --img_size 128
+    $ python3 -m AEGEAN.benchmark --bench augment --img_size 256
+    $ python3 -m AEGEAN.benchmark --bench normalize --img_size 256
+    $ python3 -m AEGEAN.benchmark --bench ingest --img_size 64
+    $ python3 -m AEGEAN.benchmark --bench components --output components.json
+    $ python3 -m AEGEAN.benchmark --bench iteration --img_size 64 --output iteration.json
+    $ python3 -m AEGEAN.benchmark --bench export --img_size 128
+
+With --output, the results are written as JSON (with the options, the versions
+and the device), such that they can be compared between commits.
+
+"""
+import os
+import json
+import time
+import argparse
+import contextlib
+import multiprocessing
+import tracemalloc
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+from .init import init
+from .models import Generator, Discriminator, Encoder
+from .utils import weights_init_normal, slerp, NoisePool
+from .diagnostics import Diagnostics
+from .augment import BatchAugment
+
+use_cuda = True if torch.cuda.is_available() else False
+device = torch.device('cuda' if use_cuda else 'cpu')
+
+
+def get_opt(**kwargs):
+    """
+    Default options (ignoring the command line) updated with kwargs.
+
+    """
+    opt = init(args=[])
+    for variable, value in kwargs.items():
+        vars(opt)[variable] = value
+    return opt
+
+
+def synchronize():
+    if use_cuda:
+        torch.cuda.synchronize()
+
+
+def timeit(func, n_iter=10, n_warmup=2):
+    """
+    Average wall time (in seconds) of one call to func.
+
+    """
+    for _ in range(n_warmup):
+        func()
+    synchronize()
+    t0 = time.perf_counter()
+    for _ in range(n_iter):
+        func()
+    synchronize()
+    return (time.perf_counter() - t0) / n_iter
+
+
+def peak_memory():
+    """
+    Peak memory of the process in bytes: allocated by torch on GPU, resident set size on CPU.
+
+    """
+    if use_cuda:
+        return torch.cuda.max_memory_allocated()
+    import resource
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024 # in kilobytes on linux
+
+
+def run_isolated(func, *args, **kwargs):
+    """
+    Runs func in a fresh process, such that peak memories are not mixed between measures.
+
+    """
+    with multiprocessing.get_context('spawn').Pool(1) as pool:
+        return pool.apply(func, args, kwargs)
+
+
+def get_models(opt):
+    encoder, generator, discriminator = Encoder(opt), Generator(opt), Discriminator(opt)
+    for model in [encoder, generator, discriminator]:
+        model.apply(weights_init_normal)
+        model.to(device)
+    return encoder, generator, discriminator
+
+
+def bench_diagnostics(opt, levels=['', 'shapes', 'minmax', 'nan', 'anomaly', 'all'], n_iter=10):
+    """
+    Time of a forward/backward pass through E, G and D for each diagnostics level.
+
+    """
+    encoder, generator, discriminator = get_models(opt)
+    imgs = torch.rand(opt.batch_size, opt.channels, opt.img_size, opt.img_size, device=device)
+
+    def iteration():
+        gen_imgs = generator(encoder(imgs))
+        loss = F.mse_loss(gen_imgs, imgs) + discriminator(gen_imgs).mean()
+        loss.backward()
+
+    results = {}
+    for level in levels:
+        # the traces are part of the cost but are not displayed
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            with Diagnostics(level).attach(encoder, generator, discriminator):
+                results[level or 'off'] = timeit(iteration, n_iter=n_iter)
+    t_off = results['off']
+    for level, t_iter in results.items():
+        print(f"diagnostics={level:8s} {t_iter*1000:9.2f} ms/iteration ({t_iter/t_off:5.2f}x)")
+    return results
+
+
+def slerp_numpy(val, low, high):
+    """
+    Former NumPy implementation of `gen_z`'s slerp (float64 on the host).
+
+    """
+    corr = np.diag((low/np.linalg.norm(low)) @ (high/np.linalg.norm(high)).T)
+    omega = np.arccos(np.clip(corr, -1, 1))[:, None]
+    so = np.sin(omega)
+    out =  np.sin((1.0-val)*omega) / so * low + np.sin(val*omega) / so * high
+    # L'Hopital's rule/LERP
+    out[so[:, 0] == 0, :] = (1.0-val) * low[so[:, 0] == 0, :] + val * high[so[:, 0] == 0, :]
+    return out
+
+
+def bench_slerp(opt, rho=.25, n_iter=100):
+    """
+    Time of the latent interpolation of `gen_z`: host round-trip with NumPy vs. torch on the device.
+
+    """
+    z_imgs = torch.randn(opt.batch_size, opt.latent_dim, device=device)
+    gen = torch.Generator(device=device)
+
+    def numpy_path():
+        z = z_imgs.cpu().numpy()
+        z_shuffle = z[torch.randperm(opt.batch_size), :]
+        return torch.tensor(slerp_numpy(rho, z, z_shuffle), dtype=torch.float32, device=device)
+
+    def torch_path():
+        z_shuffle = z_imgs[torch.randperm(opt.batch_size, generator=gen, device=device), :]
+        return slerp(rho, z_imgs, z_shuffle)
+
+    results = {'numpy': timeit(numpy_path, n_iter=n_iter), 'torch': timeit(torch_path, n_iter=n_iter)}
+    for name, t_iter in results.items():
+        print(f"slerp {name:6s} {t_iter*1e6:9.2f} us/call ({results['numpy']/t_iter:5.2f}x)")
+    return results
+
+
+def bench_noise(opt, n_iter=20):
+    """
+    Noise and label smoothing of one training iteration: NumPy arrays uploaded
+    at each call vs. buffers refilled in place on the device.
+
+    Reports the time per iteration, the host memory allocated by NumPy and the
+    number of allocations made by the CUDA caching allocator (on GPU).
+
+    """
+    shape = (opt.batch_size, opt.channels, opt.img_size, opt.img_size)
+    Tensor = torch.cuda.FloatTensor if use_cuda else torch.FloatTensor
+
+    def numpy_path():
+        for _ in range(3): # E_noise, D_noise, G_noise
+            v_noise = np.random.normal(0, 1, shape)
+            v_noise *= np.abs(np.random.normal(0, 1, (shape[0], opt.channels, 1, 1)))
+            Tensor(v_noise)
+        Tensor(np.random.uniform(opt.valid_smooth, 1.0-(1-opt.valid_smooth)/2, (opt.batch_size, 1)))
+        Tensor(np.random.uniform((1-opt.valid_smooth)/2, 1-opt.valid_smooth, (opt.batch_size, 1)))
+
+    noise_pool = NoisePool(device, valid_smooth=opt.valid_smooth, seed=42)
+
+    def pool_path():
+        for stream in ['E', 'D', 'G']:
+            noise_pool.image_noise(stream, shape)
+        noise_pool.labels(opt.batch_size)
+
+    results = {}
+    for name, func in [('numpy', numpy_path), ('pool', pool_path)]:
+        func()
+        n_alloc = torch.cuda.memory_stats().get('allocation.all.allocated', 0) if use_cuda else 0
+        tracemalloc.start()
+        t_iter = timeit(func, n_iter=n_iter, n_warmup=0)
+        _, host_peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        if use_cuda:
+            n_alloc = (torch.cuda.memory_stats().get('allocation.all.allocated', 0) - n_alloc) / n_iter
+        results[name] = dict(time=t_iter, host_peak=host_peak, cuda_allocs=n_alloc)
+        print(f"noise {name:6s} {t_iter*1000:9.2f} ms/iteration - host peak {host_peak/2**20:8.2f} MiB "
+              f"- {n_alloc:5.1f} CUDA allocations/iteration")
+    return results
+
+
+def amp_iteration(opt, amp, n_iter=10, seed=42):
+    """
+    Times an E/G/D iteration with or without mixed precision.
+
+    """
+    torch.manual_seed(seed)
+    encoder, generator, discriminator = get_models(opt)
+    params = list(encoder.parameters()) + list(generator.parameters()) + list(discriminator.parameters())
+    optimizer = torch.optim.SGD(params, lr=opt.lrE)
+    scaler = torch.cuda.amp.GradScaler(enabled=amp and use_cuda)
+    amp_dtype = torch.float16 if use_cuda else torch.bfloat16
+    imgs = torch.rand(opt.batch_size, opt.channels, opt.img_size, opt.img_size).to(device)
+
+    def iteration():
+        optimizer.zero_grad()
+        with torch.autocast(device_type=device.type, dtype=amp_dtype, enabled=amp):
+            gen_imgs = generator(encoder(imgs)).float()
+            logit = discriminator(gen_imgs).float()
+        loss = F.mse_loss(gen_imgs, imgs) + F.binary_cross_entropy(torch.sigmoid(logit), torch.ones_like(logit))
+        scaler.scale(loss).backward()
+        scaler.step(optimizer)
+        scaler.update()
+        return loss
+
+    t_iter = timeit(iteration, n_iter=n_iter)
+    return dict(time=t_iter, imgs_per_s=opt.batch_size/t_iter, peak_memory=peak_memory(), loss=iteration().item())
+
+
+def bench_amp(opt, n_iter=10, seed=42):
+    """
+    Throughput and peak memory of float32 vs. mixed precision (each in its own process).
+
+    """
+    results = {}
+    for name, amp in [('fp32', False), ('amp', True)]:
+        results[name] = run_isolated(amp_iteration, opt, amp, n_iter=n_iter, seed=seed)
+        print(f"{name:5s} {results[name]['imgs_per_s']:9.2f} images/s - peak memory "
+              f"{results[name]['peak_memory']/2**20:9.2f} MiB - loss {results[name]['loss']:.5f}")
+    return results
+
+
+def bench_augment(opt, n_iter=5):
+    """
+    Random flips and rotations of a batch: per image with PIL/skimage (as in
+    the DataLoader workers) vs. batched on the device.
+
+    """
+    from PIL import Image
+    from torchvision import transforms
+    from .utils import RotoTransform
+    imgs = torch.randint(0, 256, (opt.batch_size, opt.channels, opt.img_size, opt.img_size), dtype=torch.uint8)
+    pils = [Image.fromarray(img.permute(1, 2, 0).numpy()) for img in imgs]
+    per_image = transforms.Compose([transforms.RandomHorizontalFlip(p=0.5), RotoTransform(theta=opt.rand_affine)])
+    augment = BatchAugment(rand_hflip=True, rand_affine=opt.rand_affine, device=device, seed=42)
+    imgs = imgs.to(device)
+
+    results = {'per_image': timeit(lambda: [per_image(img) for img in pils], n_iter=n_iter),
+               'batch': timeit(lambda: augment(imgs), n_iter=n_iter)}
+    for name, t_iter in results.items():
+        print(f"augment {name:9s} {opt.batch_size/t_iter:12.1f} images/s ({results['per_image']/t_iter:6.2f}x)")
+    return results
+
+
+def bench_normalize(opt, n_iter=5):
+    """
+    Normalization of a batch: former float64 `Normalize` + `ToTensor` per
+    image and `default_collate` vs. `NormalizeCollate`. Also checks that both
+    outputs match.
+
+    """
+    from torchvision import transforms
+    from torch.utils.data import default_collate
+    from .utils import NormalizeCollate
+    imgs = np.random.randint(0, 256, (opt.batch_size, opt.img_size, opt.img_size, opt.channels), dtype=np.uint8)
+    to_tensor = transforms.ToTensor()
+
+    def normalize_float64(img):
+        tmp_img = np.array(img).astype(np.float64)
+        tmp_img -= np.min(tmp_img)
+        tmp_img = tmp_img / tmp_img.max()
+        return (1.-0.)*tmp_img + 0.
+
+    def per_image():
+        return default_collate([to_tensor(normalize_float64(img)) for img in imgs]).float()
+
+    collate = NormalizeCollate(0., 1.)
+    batch = [(img, '') for img in imgs]
+    results = {'per_image': timeit(per_image, n_iter=n_iter),
+               'batch': timeit(lambda: collate(batch), n_iter=n_iter)}
+    error = (per_image() - collate(batch)[0]).abs().max().item()
+    for name, t_iter in results.items():
+        print(f"normalize {name:9s} {opt.batch_size/t_iter:12.1f} images/s ({results['per_image']/t_iter:6.2f}x)")
+    print(f"normalize max abs difference {error:.2e}")
+    results['max_abs_difference'] = error
+    return results
+
+
+def bench_ingest(opt, n_images=64, source_size=1536):
+    """
+    Cold build of the dataset store from synthetic JPEG images: serial full
+    decoding vs. parallel decoding at a reduced scale.
+
+    """
+    import tempfile
+    from PIL import Image
+    from .dataset import list_images, decode_images
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for i in range(n_images):
+            img = np.random.randint(0, 256, (source_size//8, source_size//8, 3), dtype=np.uint8)
+            Image.fromarray(img).resize((source_size, source_size)).save(os.path.join(tmp_dir, f'{i}.jpg'))
+        fnames = list_images(tmp_dir)
+        results = {}
+        for name, kwargs in [('serial', dict(n_jobs=1, draft=False)), ('parallel_draft', dict(draft=True))]:
+            t0 = time.perf_counter()
+            for _ in decode_images(fnames, opt.img_size, opt.img_size, **kwargs):
+                pass
+            results[name] = time.perf_counter() - t0
+            print(f"ingest {name:15s} {n_images/results[name]:9.1f} images/s ({results['serial']/results[name]:6.2f}x)")
+    return results
+
+
+COMPONENTS = {'encoder': Encoder, 'generator': Generator, 'discriminator': Discriminator}
+AXES = dict(img_size=[32, 64, 128, 256], batch_size=[16, 32, 64, 128], resblocks=[1, 2, 4, 8],
+            do_transpose=[False, True], channel0_bg=[0, 2, 8])
+
+
+def component_throughput(opt, component, n_iter=10, seed=42):
+    """
+    Images/s and peak memory of the forward and of the forward+backward passes of one model.
+
+    """
+    torch.manual_seed(seed)
+    model = COMPONENTS[component](opt)
+    model.apply(weights_init_normal)
+    model.to(device)
+    if component == 'generator':
+        inputs = torch.randn(opt.batch_size, opt.latent_dim, device=device)
+    else:
+        inputs = torch.rand(opt.batch_size, opt.channels, opt.img_size, opt.img_size, device=device)
+
+    def forward():
+        with torch.no_grad():
+            model(inputs)
+
+    def forward_backward():
+        model(inputs).float().mean().backward()
+
+    results = {}
+    # forward first: on CPU, the peak memory only increases
+    for name, func in [('forward', forward), ('forward_backward', forward_backward)]:
+        if use_cuda:
+            torch.cuda.reset_peak_memory_stats()
+        t_iter = timeit(func, n_iter=n_iter)
+        results[name] = dict(time=t_iter, imgs_per_s=opt.batch_size/t_iter, peak_memory=peak_memory())
+    return results
+
+
+def bench_components(opt, axes=AXES, n_iter=10):
+    """
+    Throughput and peak memory of E, G and D for opt and along each axis
+    (one option changed at a time), each measure in its own process.
+
+    """
+    configs = [{}] + [{key: value} for key, values in axes.items() for value in values if value != getattr(opt, key)]
+    results = []
+    for config in configs:
+        opt_config = argparse.Namespace(**vars(opt))
+        vars(opt_config).update(config)
+        for component in COMPONENTS:
+            measure = run_isolated(component_throughput, opt_config, component, n_iter=n_iter)
+            results.append(dict(config=config, component=component, **measure))
+            name = ' '.join(f'{key}={value}' for key, value in config.items()) or 'default'
+            print(f"{name:20s} {component:14s} forward {measure['forward']['imgs_per_s']:10.1f} images/s "
+                  f"- forward+backward {measure['forward_backward']['imgs_per_s']:10.1f} images/s "
+                  f"- peak memory {measure['forward_backward']['peak_memory']/2**20:9.2f} MiB")
+    return results
+
+
+def iteration_throughput(opt, n_batch=8, n_epochs=3):
+    """
+    Time of the training iterations of do_learn (E, D and G steps with the
+    metrics, checkpoint excluded) on random images held in memory. The first
+    epoch is a warm-up.
+
+    """
+    import tempfile
+    from torch.utils.data import TensorDataset, DataLoader
+    from .aegean import do_learn
+    imgs = torch.rand(n_batch * opt.batch_size, opt.channels, opt.img_size, opt.img_size)
+    dataloader = DataLoader(TensorDataset(imgs, torch.zeros(len(imgs))), batch_size=opt.batch_size,
+                            shuffle=True, drop_last=True)
+    opt = argparse.Namespace(**vars(opt))
+    vars(opt).update(run_path='benchmark', n_epochs=n_epochs, sample_interval=n_epochs+1,
+                     model_save_interval=n_epochs+1, print_interval=np.inf, load_model=False)
+    with tempfile.TemporaryDirectory() as run_dir:
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            history = do_learn(opt, run_dir, dataloader=dataloader)
+    # the epoch time stops before the checkpoint of the last epoch
+    t_iter = np.mean(history.epochs['time'][1:] / history.epochs['n_batch'][1:])
+    return dict(time=float(t_iter), imgs_per_s=opt.batch_size/float(t_iter), peak_memory=peak_memory())
+
+
+def bench_iteration(opt, n_batch=8, n_epochs=3):
+    """
+    Throughput and peak memory of a full E/D/G iteration of do_learn (in its own process).
+
+    """
+    results = run_isolated(iteration_throughput, opt, n_batch=n_batch, n_epochs=n_epochs)
+    print(f"iteration {results['time']*1000:9.2f} ms - {results['imgs_per_s']:9.2f} images/s "
+          f"- peak memory {results['peak_memory']/2**20:9.2f} MiB")
+    return results
+
+
+def bench_export(opt, n_iter=20):
+    """
+    Parity and latency of the TorchScript encoder and generator (see export.py)
+    vs. the eager models, and vs. torch.compile when available.
+
+    """
+    from .export import script, check_parity, compare_latency
+    encoder, generator, _ = get_models(opt)
+    scripted = script(encoder, generator)
+    errors = check_parity(encoder, generator, *scripted, batch_size=opt.batch_size)
+    print(f"export max abs difference: encoder {errors['encoder']:.2e} - generator {errors['generator']:.2e}")
+    results = compare_latency(encoder, generator, *scripted, batch_size=opt.batch_size, n_iter=n_iter,
+                              compile=hasattr(torch, 'compile'))
+    for name, times in results.items():
+        print(f"export {name:8s} encoder {times['encoder']*1000:9.3f} ms ({results['eager']['encoder']/times['encoder']:5.2f}x)"
+              f" - generator {times['generator']*1000:9.3f} ms ({results['eager']['generator']/times['generator']:5.2f}x)")
+    results['max_abs_difference'] = errors
+    return results
+
+
+def to_json(value):
+    if hasattr(value, 'item'):
+        return value.item()
+    return repr(value)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--bench", type=str, default='diagnostics', help="which benchmark to run")
+    parser.add_argument("--img_size", type=int, default=64, help="size of each image dimension")
+    parser.add_argument("--batch_size", type=int, default=32, help="size of the batches")
+    parser.add_argument("--n_iter", type=int, default=10, help="number of timed iterations")
+    parser.add_argument("--output", type=str, default='', help="JSON file for the results")
+    args = parser.parse_args()
+
+    opt = get_opt(img_size=args.img_size, batch_size=args.batch_size)
+    results = None
+    if args.bench == 'diagnostics':
+        results = bench_diagnostics(opt, n_iter=args.n_iter)
+    elif args.bench == 'slerp':
+        results = bench_slerp(opt, n_iter=args.n_iter)
+    elif args.bench == 'noise':
+        results = bench_noise(opt, n_iter=args.n_iter)
+    elif args.bench == 'amp':
+        results = bench_amp(opt, n_iter=args.n_iter)
+    elif args.bench == 'augment':
+        results = bench_augment(opt, n_iter=args.n_iter)
+    elif args.bench == 'normalize':
+        results = bench_normalize(opt, n_iter=args.n_iter)
+    elif args.bench == 'ingest':
+        results = bench_ingest(opt)
+    elif args.bench == 'components':
+        results = bench_components(opt, n_iter=args.n_iter)
+    elif args.bench == 'iteration':
+        results = bench_iteration(opt)
+    elif args.bench == 'export':
+        results = bench_export(opt, n_iter=args.n_iter)
+    else:
+        print('unknown benchmark', args.bench)
+
+    if args.output and not results is None:
+        with open(args.output, 'w') as f:
+            json.dump(dict(bench=args.bench, opt=vars(opt), torch=torch.__version__, device=str(device),
+                           n_threads=torch.get_num_threads(), results=results), f, indent=1, default=to_json)
@@ -0,0 +1,136 @@
+"""
+Checkpoints and status of the runs.
+
+Each run folder `runs/<run_path>` holds:
+
+- `status.json`: the status of the run ('running', 'failed' or 'done') with the
+  host and PID of the process and the last completed epoch,
+- `checkpoint.pt`: the state of the models, optimizers, random number
+  generators, statistics and epoch counter at the last checkpoint.
+
+Both files are written atomically (write to a temporary file, then rename) such
+that a run killed while saving always leaves the previous version intact.
+"""
+import os
+import json
+import time
+import random
+import argparse
+import numpy as np
+import torch
+
+from .models import Encoder, Generator, Discriminator
+
+STATUS_FILE = 'status.json'
+CHECKPOINT_FILE = 'checkpoint.pt'
+HOST = os.uname()[1]
+
+
+def atomic_write(file_path, write):
+    """
+    Calls write(f) on a temporary file which then replaces file_path.
+
+    """
+    tmp_path = f'{file_path}.tmp{os.getpid()}'
+    with open(tmp_path, 'wb') as f:
+        write(f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, file_path)
+
+
+def get_rng_state():
+    state = dict(python=random.getstate(), numpy=np.random.get_state(), torch=torch.get_rng_state())
+    if torch.cuda.is_available():
+        state['cuda'] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state):
+    random.setstate(state['python'])
+    np.random.set_state(state['numpy'])
+    torch.set_rng_state(state['torch'])
+    if 'cuda' in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+
+def save_checkpoint(path_data, state):
+    """
+    Saves the state dictionary of a run (atomically).
+
+    """
+    atomic_write(os.path.join(path_data, CHECKPOINT_FILE), lambda f: torch.save(state, f))
+
+
+def load_checkpoint(path_data):
+    """
+    Loads the last checkpoint of a run on the CPU, or None if there is none.
+
+    """
+    file_path = os.path.join(path_data, CHECKPOINT_FILE)
+    if not os.path.isfile(file_path):
+        return None
+    # the checkpoint holds numpy arrays and RNG states, not only tensors
+    return torch.load(file_path, map_location='cpu', weights_only=False)
+
+
+def load_run(path_data, device='cpu', names=('encoder', 'generator')):
+    """
+    Options and models of the last checkpoint of a run, in eval mode on device.
+
+    outputs opt (as a namespace) and a dictionary {name: model}
+    """
+    checkpoint = load_checkpoint(path_data)
+    if checkpoint is None:
+        raise FileNotFoundError(f'No checkpoint in {path_data}')
+    opt = argparse.Namespace(**checkpoint['opt'])
+    classes = dict(encoder=Encoder, generator=Generator, discriminator=Discriminator)
+    models = {}
+    for name in names:
+        models[name] = classes[name](opt)
+        models[name].load_state_dict(checkpoint[name])
+        models[name].to(device).eval()
+    return opt, models
+
+
+def read_status(path_data):
+    """
+    Status of a run as a dictionary, or None for a run without status marker.
+
+    """
+    try:
+        with open(os.path.join(path_data, STATUS_FILE)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def write_status(path_data, status, **info):
+    info.update(status=status, host=HOST, pid=os.getpid(), time=time.time())
+    atomic_write(os.path.join(path_data, STATUS_FILE), lambda f: f.write(json.dumps(info).encode()))
+
+
+def is_running(status, stale_after=None):
+    """
+    True if the process which wrote a 'running' status is still alive.
+
+    On this host, the PID is checked. For a run on another host, it is
+    considered alive if its status was updated less than stale_after seconds
+    ago (by default three epochs, and at least one hour).
+
+    """
+    if status is None or status['status'] != 'running':
+        return False
+    if status['host'] != HOST:
+        if stale_after is None:
+            stale_after = max(3 * status.get('epoch_time', 0), 3600)
+        return time.time() - status['time'] < stale_after
+    if status['pid'] == os.getpid():
+        return False
+    try:
+        os.kill(status['pid'], 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
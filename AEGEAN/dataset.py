@@ -0,0 +1,453 @@
+"""
+On-disk store of the preprocessed images.
+
+The images of a folder are resized once and written as one contiguous
+N x H x W x 3 uint8 array (`<prefix>.npy`) next to an index with the file
+names (`<prefix>.json`). The array is opened with mmap, such that opening the
+store is immediate and its pages are shared by the DataLoader workers and by
+all the runs which use the same store.
+
+The index also holds a manifest (name, size and modification time of each
+file) and the preprocessing parameters. Their hash is the key of the store: if
+the folder or the parameters change, the store is updated, re-decoding only
+the files which changed. Updates are serialized between processes with a lock
+file next to the store.
+
+Runs on the same node can share one copy of a store in /dev/shm (see
+`SharedStore`): it is published by the first run and removed when the last run
+which uses it exits.
+
+For folders which do not fit in memory (or on /tmp), `LazyFolderDataset` and
+`ImageStream` only index the file paths and decode the images on demand in the
+DataLoader workers.
+"""
+import os
+import json
+import time
+import fcntl
+import random
+import shutil
+import hashlib
+import weakref
+import contextlib
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from glob import glob
+import numpy as np
+from PIL import Image
+import torch
+from torch.utils.data import Dataset, IterableDataset
+
+EXTENSIONS = ['png', 'PNG', 'jpg', 'JPG']
+RESAMPLE = {'nearest': Image.NEAREST, 'bilinear': Image.BILINEAR,
+            'bicubic': Image.BICUBIC, 'lanczos': Image.LANCZOS}
+STORE_VERSION = 1
+SHM_DIR = '/dev/shm'
+
+
+def list_images(dir_path, extensions=EXTENSIONS):
+    """
+    Sorted list of the images in dir_path and in its sub-folders.
+
+    """
+    files = []
+    for ext in extensions:
+        files.extend(glob(os.path.join(dir_path, f'*.{ext}')))
+        files.extend(glob(os.path.join(dir_path, f'**/*.{ext}')))
+    return sorted(fname for fname in files if os.path.isfile(fname))
+
+
+def load_image(fname, height, width, resample='bilinear', draft=True):
+    """
+    Reads and resizes one image (resample is a key of RESAMPLE).
+
+    With draft, JPEG images much larger than the target are decoded directly
+    at a reduced scale (1/2, 1/4 or 1/8) which is still larger than the target.
+
+    outputs a height x width x 3 uint8 array
+    """
+    img_as_pil = Image.open(fname)
+    if draft and img_as_pil.format == 'JPEG':
+        # https://pillow.readthedocs.io/en/stable/reference/Image.html#PIL.Image.Image.draft
+        img_as_pil.draft('RGB', (height, width))
+    img_as_pil = img_as_pil.convert('RGB')
+    # HACK for CFD images
+    # if list(img_as_pil.getdata())[0]  == (255, 255, 255): # rgb_im.getpixel((1, 1))
+    #     ImageDraw.floodfill(img_as_pil, xy=(0, 0), value=(127, 127, 127), thresh=10)
+    #     ImageDraw.floodfill(img_as_pil, xy=(0, -1), value=(127, 127, 127), thresh=10)
+    img_as_pil = img_as_pil.resize((height, width), resample=RESAMPLE[resample])
+    # TODO: use LAB color space for CFD / CMYK for simpsons
+    return np.asarray(img_as_pil, dtype=np.uint8)
+
+
+def store_prefix(dir_path, img_size, cache_dir='/tmp'):
+    return os.path.join(cache_dir, f"AEGEAN_dataset_{dir_path.replace('/', '_')}_{img_size}")
+
+
+def n_cpus():
+    return len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count()
+
+
+def _load_entry(args):
+    fname, height, width, resample, draft = args
+    return load_image(fname, height, width, resample=resample, draft=draft)
+
+
+def decode_images(fnames, height, width, resample='bilinear', draft=True, n_jobs=None, chunksize=16):
+    """
+    Decodes and resizes images across a pool of processes.
+
+    outputs a generator of the images, in the order of fnames
+    """
+    n_jobs = n_cpus() if n_jobs is None else n_jobs
+    args = [(fname, height, width, resample, draft) for fname in fnames]
+    if n_jobs <= 1 or len(fnames) <= chunksize:
+        yield from map(_load_entry, args)
+        return
+    # the workers only decode images with PIL: forking is safe
+    with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+        yield from executor.map(_load_entry, args, chunksize=chunksize)
+
+
+def get_manifest(files):
+    """
+    [name, size, modification time] of each file.
+
+    """
+    entries = []
+    for fname in files:
+        stat = os.stat(fname)
+        entries.append([fname, stat.st_size, stat.st_mtime_ns])
+    return entries
+
+
+def get_key(manifest, params):
+    return hashlib.sha1(json.dumps([STORE_VERSION, params, manifest]).encode()).hexdigest()
+
+
+@contextlib.contextmanager
+def file_lock(lock_path):
+    """
+    Exclusive lock between processes (blocks until it is acquired).
+
+    The lock file may be removed by its holder (see SharedStore.release_prefix):
+    a lock acquired on a file which is no longer at lock_path is retried.
+
+    """
+    while True:
+        with open(lock_path, 'a') as f:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+            try:
+                try:
+                    current = os.stat(lock_path).st_ino == os.fstat(f.fileno()).st_ino
+                except FileNotFoundError:
+                    current = False
+                if current:
+                    yield
+                    return
+            finally:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+
+def read_index(prefix):
+    try:
+        with open(f'{prefix}.json') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def build_store(manifest, params, prefix, old_index=None, n_jobs=None):
+    """
+    Writes the resized images of the manifest to the store at prefix.
+
+    Images which are unchanged since old_index (same name, size and
+    modification time, same parameters) are copied from the old store
+    instead of being decoded again.
+
+    Other images are decoded by n_jobs processes (default: all available CPUs).
+
+    Both files are written under a temporary name and then renamed, the
+    array first, such that the index always describes a complete array.
+
+    """
+    height, width = params['height'], params['width']
+    old_rows = {}
+    decoding = ['height', 'width', 'resample', 'draft']
+    if old_index is not None and all(old_index['params'].get(k) == params[k] for k in decoding):
+        try:
+            old_imgs = np.load(f'{prefix}.npy', mmap_mode='r')
+            if old_imgs.shape[0] == len(old_index['manifest']):
+                old_rows = {tuple(entry): i for i, entry in enumerate(old_index['manifest'])}
+        except (OSError, ValueError):
+            pass
+
+    tmp_path = f'{prefix}.tmp{os.getpid()}.npy'
+    imgs = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.uint8, shape=(len(manifest), height, width, 3))
+    to_decode = []
+    for i, entry in enumerate(manifest):
+        if tuple(entry) in old_rows:
+            imgs[i] = old_imgs[old_rows[tuple(entry)]]
+        else:
+            to_decode.append(i)
+    n_decoded, t0, t_print = len(to_decode), time.time(), time.time()
+    decoded = decode_images([manifest[i][0] for i in to_decode], height, width,
+                            resample=params['resample'], draft=params['draft'], n_jobs=n_jobs)
+    for n, (i, img) in enumerate(zip(to_decode, decoded)):
+        imgs[i] = img
+        if time.time() - t_print > 5 or n + 1 == n_decoded:
+            t_print = time.time()
+            print(f"Decoding images: {n+1}/{n_decoded} ({(n+1)/(t_print-t0):.1f} images/s)")
+    imgs.flush()
+    del imgs
+    os.replace(tmp_path, f'{prefix}.npy')
+
+    tmp_path = f'{prefix}.tmp{os.getpid()}.json'
+    with open(tmp_path, 'w') as f:
+        json.dump(dict(files=[entry[0] for entry in manifest], height=height, width=width,
+                       params=params, manifest=manifest, key=get_key(manifest, params)), f)
+    os.replace(tmp_path, f'{prefix}.json')
+    print(f"Dataset store {prefix}: {n_decoded} images decoded, {len(manifest) - n_decoded} reused")
+
+
+def get_store(dir_path, prefix, height, width, resample='bilinear', extensions=EXTENSIONS,
+              draft=True, n_jobs=None):
+    """
+    Makes sure the store at prefix is up to date with the images in dir_path.
+
+    outputs the list of file names in the store
+    """
+    manifest = get_manifest(list_images(dir_path, extensions))
+    params = dict(height=height, width=width, resample=resample, extensions=list(extensions), draft=draft)
+    key = get_key(manifest, params)
+
+    def is_valid(index):
+        return index is not None and index.get('key') == key and os.path.isfile(f'{prefix}.npy')
+
+    if not is_valid(read_index(prefix)):
+        with file_lock(f'{prefix}.lock'):
+            # another process may have updated the store while we were waiting
+            index = read_index(prefix)
+            if not is_valid(index):
+                build_store(manifest, params, prefix, old_index=index if index and 'params' in index else None,
+                            n_jobs=n_jobs)
+    return [entry[0] for entry in manifest]
+
+
+def open_store(prefix):
+    """
+    Opens the store at prefix (read-only, memory-mapped).
+
+    outputs the N x H x W x 3 uint8 array and the list of file names
+    """
+    with open(f'{prefix}.json') as f:
+        index = json.load(f)
+    imgs = np.load(f'{prefix}.npy', mmap_mode='r')
+    if imgs.shape != (len(index['files']), index['height'], index['width'], 3):
+        raise ValueError(f'Store {prefix} does not match its index')
+    return imgs, index['files']
+
+
+def pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class SharedStore(object):
+    def __init__(self, prefix, shm_dir=SHM_DIR):
+        """
+        Copy of the store at prefix in shared memory, used by this process.
+
+        The copy is published (or updated) if needed, and this process is
+        registered as one of its users by a file named after its PID in the
+        `<prefix>.refs` folder. It is released when the object is garbage
+        collected or when the process exits: the copy is then removed if no
+        other live process uses it. Memory maps of the copy stay valid after it
+        is removed or replaced.
+
+        Raises OSError if shm_dir is missing or too small for the store.
+
+        """
+        self.source = prefix
+        self.prefix = os.path.join(shm_dir, os.path.basename(prefix))
+        self.pid = os.getpid()
+        if not os.path.isdir(shm_dir):
+            raise OSError(f'{shm_dir} does not exist')
+        with file_lock(f'{self.prefix}.lock'):
+            source_index, index = read_index(self.source), read_index(self.prefix)
+            if index is None or index.get('key') != source_index['key'] or not os.path.isfile(f'{self.prefix}.npy'):
+                self.publish()
+            os.makedirs(f'{self.prefix}.refs', exist_ok=True)
+            open(os.path.join(f'{self.prefix}.refs', str(self.pid)), 'w').close()
+        self._finalizer = weakref.finalize(self, SharedStore.release_prefix, self.prefix, self.pid)
+
+    def publish(self):
+        size = os.path.getsize(f'{self.source}.npy')
+        # the old copy (if any) is replaced, it does not count
+        if shutil.disk_usage(os.path.dirname(self.prefix)).free < size:
+            raise OSError(f'Not enough shared memory for {self.source} ({size} bytes)')
+        # the array first, such that the index always describes a complete array
+        for ext in ['npy', 'json']:
+            tmp_path = f'{self.prefix}.tmp{os.getpid()}.{ext}'
+            shutil.copyfile(f'{self.source}.{ext}', tmp_path)
+            os.replace(tmp_path, f'{self.prefix}.{ext}')
+        print(f"Dataset store {self.source} published to {self.prefix}")
+
+    def release(self):
+        self._finalizer()
+
+    @staticmethod
+    def release_prefix(prefix, pid):
+        """
+        Unregisters pid, and removes the copy at prefix if no live process uses it.
+
+        """
+        if os.getpid() != pid:
+            # copies of the object in forked processes (e.g. DataLoader workers)
+            return
+        refs = f'{prefix}.refs'
+        with file_lock(f'{prefix}.lock'):
+            users = os.listdir(refs) if os.path.isdir(refs) else []
+            alive = []
+            for user in users:
+                # also forgets the processes which exited without releasing the copy
+                if int(user) == pid or not pid_alive(int(user)):
+                    os.remove(os.path.join(refs, user))
+                else:
+                    alive.append(user)
+            if not alive:
+                # the lock file is removed last, while it is held (see file_lock)
+                for fname in [f'{prefix}.npy', f'{prefix}.json', f'{prefix}.lock']:
+                    if os.path.isfile(fname):
+                        os.remove(fname)
+                if os.path.isdir(refs):
+                    os.rmdir(refs)
+
+
+class LazyFolderDataset(Dataset):
+    def __init__(self, dir_path, height, width, transform=None, cache_size=1024,
+                 resample='bilinear', extensions=EXTENSIONS, draft=True):
+        """
+        Dataset which decodes and resizes the images on access.
+
+        Only the file paths are listed at startup. Each worker keeps the last
+        cache_size decoded images in a LRU cache.
+
+        Args:
+                dir_path (string): path to dir that contains the images
+                height (int): image height
+                width (int): image width
+                transform: pytorch transforms for the PIL images (None: returns the uint8 images, see NormalizeCollate)
+                cache_size (int): number of decoded images kept by each worker
+                resample (string): filter used to resize the images (see RESAMPLE)
+                extensions (list): extensions of the image files
+                draft (bool): decode large JPEG images at a reduced scale (see load_image)
+        """
+        self.files = list_images(dir_path, extensions)
+        self.height, self.width, self.transform = height, width, transform
+        self.cache_size, self.resample, self.draft = cache_size, resample, draft
+        self.cache = OrderedDict()
+
+    def load(self, index):
+        if index in self.cache:
+            self.cache.move_to_end(index)
+            return self.cache[index]
+        img = load_image(self.files[index], self.height, self.width, resample=self.resample, draft=self.draft)
+        if self.cache_size > 0:
+            self.cache[index] = img
+            if len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+        return img
+
+    def sample(self, index):
+        img = self.load(index)
+        if self.transform is None:
+            return (img, self.files[index])
+        return (self.transform(Image.fromarray(img)), self.files[index])
+
+    def __getitem__(self, index):
+        return self.sample(index)
+
+    def __getstate__(self):
+        # each worker starts with an empty cache
+        state = self.__dict__.copy()
+        state['cache'] = OrderedDict()
+        return state
+
+    def __len__(self):
+        return len(self.files)
+
+
+class ImageStream(IterableDataset):
+    def __init__(self, dir_path, height, width, transform=None, cache_size=0, seed=None,
+                 n_ranks=1, rank=0, resample='bilinear', extensions=EXTENSIONS):
+        """
+        Shuffled stream of lazily decoded images, sharded across the DataLoader
+        workers (and across n_ranks processes).
+
+        All shards draw the same permutation of the files at each epoch and
+        each one reads its own slice of it, such that an epoch visits each
+        image once.
+
+        Args:
+                seed (int): seed of the permutations (None: drawn once, at random)
+                n_ranks (int): number of processes reading the same stream
+                rank (int): index of this process
+                (see LazyFolderDataset for the other arguments)
+        """
+        self.dataset = LazyFolderDataset(dir_path, height, width, transform=transform, cache_size=cache_size,
+                                         resample=resample, extensions=extensions)
+        # the seed is fixed here such that all workers share the same permutations
+        self.seed = random.randrange(2**32) if seed is None else seed
+        self.n_ranks, self.rank = n_ranks, rank
+        self.epoch, self.n_iter = 0, 0
+        self.n_workers, self.batch_size = 0, None
+
+    @property
+    def files(self):
+        return self.dataset.files
+
+    def set_loader(self, num_workers, batch_size=None):
+        """
+        To be called with the options of the DataLoader, such that the length
+        accounts for the partial last batch of each worker (see __len__).
+
+        """
+        self.n_workers, self.batch_size = num_workers, batch_size
+
+    def set_epoch(self, epoch):
+        """
+        To be called before each epoch (workers get a copy of the dataset).
+
+        """
+        self.epoch = epoch
+
+    def __iter__(self):
+        worker_info = torch.utils.data.get_worker_info()
+        n_workers, worker_id = (1, 0) if worker_info is None else (worker_info.num_workers, worker_info.id)
+        n_shards, shard = self.n_ranks * n_workers, self.rank * n_workers + worker_id
+        # persistent workers do not see set_epoch, hence the local counter
+        rng = np.random.default_rng([self.seed, self.epoch, self.n_iter])
+        self.n_iter += 1
+        for index in rng.permutation(len(self.dataset))[shard::n_shards]:
+            yield self.dataset.sample(index)
+
+    def __len__(self):
+        """
+        Number of images read by this process in an epoch. With a batch_size
+        (see set_loader), each worker drops its partial last batch, as the
+        DataLoader does with drop_last: len(dataloader) is then exact.
+
+        """
+        n_workers = max(1, self.n_workers)
+        n_shards = self.n_ranks * n_workers
+        sizes = [len(range(self.rank * n_workers + worker_id, len(self.dataset), n_shards))
+                 for worker_id in range(n_workers)]
+        if not self.batch_size is None:
+            sizes = [size // self.batch_size * self.batch_size for size in sizes]
+        return sum(sizes)
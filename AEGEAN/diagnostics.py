@@ -0,0 +1,121 @@
+"""
+Diagnostics of the networks during training.
+
+They are off by default and are switched on per run with the `--diagnostics`
+option, a comma-separated list of levels:
+
+- 'shapes': print the shape of the output of each block,
+- 'minmax': print the min/max values of the input and of each block's output,
+- 'nan': raise a FloatingPointError as soon as a block outputs a NaN or an Inf,
+- 'anomaly': run autograd with anomaly detection (slow but tells which
+  operation produced a NaN in the backward pass),
+- 'all': all of the above.
+
+Everything is implemented with forward hooks attached on the blocks of the
+networks, such that when diagnostics are off, nothing is attached and the
+forward passes run without any extra Python branch.
+"""
+import torch
+
+LEVELS = ['shapes', 'minmax', 'nan', 'anomaly']
+
+
+def parse_levels(diagnostics):
+    """
+    Converts the `--diagnostics` string to a list of levels.
+
+    """
+    if not diagnostics:
+        return []
+    levels = [level.strip() for level in diagnostics.split(',') if level.strip()]
+    if 'all' in levels:
+        return list(LEVELS)
+    for level in levels:
+        if level not in LEVELS:
+            raise ValueError(f'Unknown diagnostics level {level}, choose among {LEVELS + ["all"]}')
+    return levels
+
+
+class Diagnostics(object):
+    def __init__(self, levels):
+        """
+        Args:
+                levels (list or str): diagnostics levels (see `LEVELS`)
+        """
+        if isinstance(levels, str):
+            levels = parse_levels(levels)
+        self.levels = levels
+        self.handles = []
+        self.anomaly_mode = None
+
+    @property
+    def enabled(self):
+        return len(self.levels) > 0
+
+    def attach(self, *models):
+        """
+        Registers the forward hooks on each model and on its blocks.
+
+        """
+        if not any(level in self.levels for level in ['shapes', 'minmax', 'nan']):
+            return self
+        for model in models:
+            name = model._name() if hasattr(model, '_name') else model.__class__.__name__
+            self.handles.append(model.register_forward_pre_hook(self._pre_hook(name)))
+            for child_name, child in model.named_children():
+                self.handles.append(child.register_forward_hook(self._hook(f'{name}.{child_name}')))
+            self.handles.append(model.register_forward_hook(self._hook(f'{name} out')))
+        return self
+
+    def _pre_hook(self, name):
+        shapes, minmax = 'shapes' in self.levels, 'minmax' in self.levels
+
+        def hook(module, inputs):
+            if shapes:
+                print(name, ": input shape ", tuple(inputs[0].shape))
+            if minmax:
+                print(name, ": input min-max ", inputs[0].min().item(), inputs[0].max().item())
+        return hook
+
+    def _hook(self, name):
+        shapes, minmax, nan = 'shapes' in self.levels, 'minmax' in self.levels, 'nan' in self.levels
+
+        def hook(module, inputs, output):
+            if shapes:
+                print(name, ": ", tuple(output.shape))
+            if minmax:
+                print(name, ": min-max ", output.min().item(), output.max().item())
+            if nan and not torch.isfinite(output).all():
+                raise FloatingPointError(f'{name} outputs NaN or Inf values')
+        return hook
+
+    def start(self):
+        """
+        Switches on anomaly detection in autograd (if requested).
+
+        """
+        if 'anomaly' in self.levels:
+            self.anomaly_mode = torch.is_anomaly_enabled()
+            torch.autograd.set_detect_anomaly(True)
+        return self
+
+    def stop(self):
+        """
+        Removes all hooks and restores the anomaly detection mode.
+
+        """
+        for handle in self.handles:
+            handle.remove()
+        self.handles = []
+        if self.anomaly_mode is not None:
+            torch.autograd.set_detect_anomaly(self.anomaly_mode)
+            self.anomaly_mode = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def __repr__(self):
+        return self.__class__.__name__ + "(levels: {})".format(self.levels)
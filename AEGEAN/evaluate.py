@@ -0,0 +1,291 @@
+"""
+Offline evaluation of the samples of a run against its dataset.
+
+The generated and the real images are compared in the space of the features
+of an extractor (see EXTRACTORS):
+
+- 'encoder': activations of the `vector0` layer of the Encoder of a reference
+  run (by default the evaluated run; use the same reference to compare runs),
+- 'latent': outputs of this Encoder,
+- 'pixels': images average-pooled to 16 x 16, which needs no model.
+
+The scores are the Fréchet distance between Gaussians fitted to both sets of
+features, and the precision and recall of the k-nearest-neighbour manifolds
+(https://arxiv.org/abs/1904.06991): the fraction of generated samples which lie
+within the manifold of the real ones, and vice versa.
+
+The statistics of the real images (mean, covariance and a random subset of
+the features) are computed once per (datapath, img_size, extractor) and
+cached in cache_dir; samples are generated and reduced to features by batches,
+without storing the images:
+
+    $ python3 -m AEGEAN.evaluate --run_path runs/AEGEAN_vanilla runs/AEGEAN_big_lrE --extractor_run runs/AEGEAN_vanilla
+"""
+import os
+import json
+import time
+import argparse
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+from .checkpoint import CHECKPOINT_FILE, atomic_write
+from .dataset import n_cpus, list_images, get_manifest, get_key, LazyFolderDataset
+from .latent_index import LatentIndex
+from .utils import NormalizeCollate
+
+EXTRACTORS = ['encoder', 'latent', 'pixels']
+EVALUATION_FILE = 'evaluation.json'
+
+
+class FeatureExtractor(object):
+    def __init__(self, name='encoder', run_path=None, device=None):
+        """
+        Args:
+                name (string): see EXTRACTORS
+                run_path (string): run of the reference Encoder ('encoder' and 'latent')
+                device: device of the computations (default: GPU if available)
+        """
+        if not name in EXTRACTORS:
+            raise ValueError(f'Unknown extractor {name}, expected one of {EXTRACTORS}')
+        self.name = name
+        self.device = torch.device(device or ('cuda' if torch.cuda.is_available() else 'cpu'))
+        self.encoder, self.img_size = None, None
+        if not name == 'pixels':
+            from .checkpoint import load_run
+            if run_path is None:
+                raise ValueError(f'The {name} extractor needs the run_path of an Encoder')
+            opt, models = load_run(run_path, device=self.device, names=('encoder',))
+            self.encoder, self.img_size = models['encoder'], opt.img_size
+            self.run_path = run_path
+            # activations of the last hidden layer, stored by a hook during the forward pass of the Encoder
+            self.hidden = None
+            self.encoder.vector0.register_forward_hook(self.store_hidden)
+
+    def store_hidden(self, module, inputs, output):
+        self.hidden = output
+
+    @property
+    def key(self):
+        """
+        Identity of the extractor (its name, and the checkpoint of its Encoder).
+
+        """
+        if self.encoder is None:
+            return self.name
+        fname = os.path.abspath(os.path.join(self.run_path, CHECKPOINT_FILE))
+        return f'{self.name}:{fname}:{os.path.getmtime(fname)}'
+
+    def __call__(self, imgs):
+        """
+        N x D features of N x C x H x W images in [0, 1] (on the device).
+
+        """
+        if self.encoder is None:
+            return F.adaptive_avg_pool2d(imgs, 16).flatten(1)
+        if not imgs.shape[-1] == self.img_size:
+            imgs = F.interpolate(imgs, size=(self.img_size, self.img_size), mode='bilinear', align_corners=False)
+        out = self.encoder(imgs)
+        if self.name == 'latent':
+            return out
+        hidden, self.hidden = self.hidden, None
+        return hidden
+
+
+class FeatureStats(object):
+    def __init__(self, n_keep=10000, seed=42):
+        """
+        Mean and covariance of features added by batches (in float64), and a random subset of n_keep of them.
+
+        """
+        self.n, self.sum, self.sum_outer = 0, None, None
+        self.n_keep, self.kept = n_keep, []
+        self.rng = np.random.default_rng(seed)
+
+    def add(self, features):
+        features = features.double()
+        if self.sum is None:
+            self.sum = torch.zeros(features.shape[1], dtype=torch.float64, device=features.device)
+            self.sum_outer = torch.zeros(features.shape[1], features.shape[1], dtype=torch.float64, device=features.device)
+        self.sum += features.sum(0)
+        self.sum_outer += features.T @ features
+        self.n += len(features)
+        # random subset: each new feature gets a random priority, the n_keep lowest are kept
+        self.kept.append((self.rng.random(len(features)), features.float().cpu()))
+        if sum(len(p) for p, _ in self.kept) > 2 * self.n_keep:
+            self.prune()
+
+    def prune(self):
+        priority = np.concatenate([p for p, _ in self.kept])
+        features = torch.cat([f for _, f in self.kept])
+        keep = np.sort(np.argsort(priority)[:self.n_keep])
+        self.kept = [(priority[keep], features[keep])]
+
+    def result(self):
+        """
+        outputs a dictionary of numpy arrays: mean, cov, features (the random subset) and n
+        """
+        self.prune()
+        mean = self.sum / self.n
+        cov = (self.sum_outer - self.n * torch.outer(mean, mean)) / max(1, self.n - 1)
+        return dict(mean=mean.cpu().numpy(), cov=cov.cpu().numpy(), features=self.kept[0][1].numpy(), n=self.n)
+
+
+def frechet_distance(mu1, cov1, mu2, cov2, eps=1e-6):
+    """
+    Fréchet distance between the Gaussians N(mu1, cov1) and N(mu2, cov2).
+
+    """
+    from scipy import linalg
+    covmean, _ = linalg.sqrtm(cov1 @ cov2, disp=False)
+    if not np.isfinite(covmean).all():
+        # singular product: regularizes the diagonals
+        offset = np.eye(cov1.shape[0]) * eps
+        covmean = linalg.sqrtm((cov1 + offset) @ (cov2 + offset))
+    covmean = covmean.real
+    diff = mu1 - mu2
+    return float(diff @ diff + np.trace(cov1) + np.trace(cov2) - 2 * np.trace(covmean))
+
+
+def knn_radii(features, k=3, block_size=4096):
+    """
+    Squared distance of each feature to its k-th nearest neighbour among the others.
+
+    """
+    if len(features) < k + 1:
+        raise ValueError(f'{len(features)} features, at least k + 1 = {k + 1} are needed for the k-th nearest neighbours')
+    radii = []
+    for start in range(0, len(features), block_size):
+        dist = LatentIndex.distances(features[start:start + block_size], features)
+        # the nearest one is the feature itself
+        radii.append(torch.topk(dist, k + 1, dim=1, largest=False).values[:, -1])
+    return torch.cat(radii)
+
+
+def coverage(queries, features, radii, block_size=4096):
+    """
+    Fraction of the queries within the radius of at least one of the features.
+
+    """
+    inside = 0
+    for start in range(0, len(queries), block_size):
+        dist = LatentIndex.distances(queries[start:start + block_size], features)
+        inside += (dist <= radii[None, :]).any(dim=1).sum().item()
+    return inside / len(queries)
+
+
+def precision_recall(real, fake, k=3):
+    """
+    Precision (fake samples in the manifold of the real ones) and recall (real samples in the manifold of the fake ones).
+
+    """
+    real_radii, fake_radii = knn_radii(real, k), knn_radii(fake, k)
+    return coverage(fake, real, real_radii), coverage(real, fake, fake_radii)
+
+
+def stats_path(datapath, img_size, extractor, n_keep, cache_dir='/tmp'):
+    """
+    Cache file of the statistics of the images of datapath for an extractor, named after the hash of the
+    manifest of the images (see dataset.get_manifest) and of the parameters.
+
+    """
+    manifest = get_manifest(list_images(datapath))
+    key = get_key(manifest, dict(img_size=img_size, extractor=extractor.key, n_keep=n_keep))
+    return os.path.join(cache_dir, f'AEGEAN_stats_{key}.npz')
+
+
+def real_stats(datapath, img_size, extractor, batch_size=256, num_workers=None, n_keep=10000, cache_dir='/tmp'):
+    """
+    Statistics of the features of the images of datapath (see FeatureStats), from the cache when possible.
+
+    """
+    fname = stats_path(datapath, img_size, extractor, n_keep, cache_dir)
+    if os.path.isfile(fname):
+        with np.load(fname) as data:
+            return {key: data[key] for key in data.files}
+    num_workers = n_cpus() if num_workers is None else num_workers
+    dataset = LazyFolderDataset(datapath, img_size, img_size, transform=None, cache_size=0)
+    loader = torch.utils.data.DataLoader(dataset, batch_size=batch_size, shuffle=False, num_workers=num_workers,
+                                         collate_fn=NormalizeCollate(0., 1.),
+                                         pin_memory=extractor.device.type == 'cuda')
+    stats = FeatureStats(n_keep)
+    with torch.inference_mode():
+        for imgs, _ in loader:
+            stats.add(extractor(imgs.to(extractor.device, non_blocking=True)))
+    stats = stats.result()
+    atomic_write(fname, lambda f: np.savez(f, **stats))
+    return stats
+
+
+def fake_stats(model, extractor, n_samples=10000, n_keep=10000, seed=42):
+    """
+    Statistics of the features of n_samples images generated by batches (see FeatureStats).
+
+    """
+    rng = torch.Generator().manual_seed(seed)
+    stats = FeatureStats(n_keep, seed)
+    for start in range(0, n_samples, model.batch_size):
+        z = torch.randn(min(model.batch_size, n_samples - start), model.opt.latent_dim, generator=rng)
+        with torch.inference_mode(), model.autocast():
+            imgs = model.generator(z.to(model.device)).float()
+            stats.add(extractor(imgs).float())
+    return stats.result()
+
+
+def evaluate(run_path, extractor='encoder', extractor_run=None, datapath=None, n_samples=10000, k=3,
+             cache_dir='/tmp', seed=42, **kwargs):
+    """
+    Scores of the samples of a run, also written to EVALUATION_FILE in the run folder.
+
+    Args:
+            run_path (string): folder of the run (with its checkpoint.pt)
+            extractor (string or FeatureExtractor): see EXTRACTORS
+            extractor_run (string): run of the reference Encoder (default: run_path)
+            datapath (string): folder of the real images (default: the datapath of the run)
+            n_samples (int): number of generated samples
+            k (int): number of neighbours defining the manifolds of precision_recall
+            cache_dir (string): folder of the cached statistics of the real images
+            kwargs: options of Inference (device, batch_size, amp, num_workers)
+
+    outputs a dictionary of the scores
+    """
+    from .inference import Inference
+    t0 = time.time()
+    model = Inference(run_path, **kwargs)
+    if isinstance(extractor, str):
+        extractor = FeatureExtractor(extractor, extractor_run or run_path, device=model.device)
+    datapath = datapath or model.opt.datapath
+    real = real_stats(datapath, model.opt.img_size, extractor, batch_size=model.batch_size,
+                      num_workers=model.num_workers, n_keep=n_samples, cache_dir=cache_dir)
+    t_real = time.time() - t0
+    fake = fake_stats(model, extractor, n_samples, n_keep=n_samples, seed=seed)
+    precision, recall = precision_recall(torch.as_tensor(real['features'], device=model.device),
+                                         torch.as_tensor(fake['features'], device=model.device), k=k)
+    scores = dict(fd=frechet_distance(real['mean'], real['cov'], fake['mean'], fake['cov']),
+                  precision=precision, recall=recall, extractor=extractor.key, datapath=datapath,
+                  n_real=int(real['n']), n_fake=n_samples, t_real=t_real, t_total=time.time() - t0)
+    atomic_write(os.path.join(run_path, EVALUATION_FILE), lambda f: f.write(json.dumps(scores, indent=1).encode()))
+    return scores
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--run_path", type=str, nargs='+', required=True, help="folders of the runs")
+    parser.add_argument("--extractor", type=str, default='encoder', choices=EXTRACTORS, help="features compared")
+    parser.add_argument("--extractor_run", type=str, default=None, help="run of the reference Encoder (default: each evaluated run)")
+    parser.add_argument("--datapath", type=str, default=None, help="folder of the real images (default: the datapath of each run)")
+    parser.add_argument("--n_samples", type=int, default=10000, help="number of generated samples")
+    parser.add_argument("--k", type=int, default=3, help="number of neighbours for precision and recall")
+    parser.add_argument("--batch_size", type=int, default=None, help="size of the batches")
+    parser.add_argument("--cache_dir", type=str, default='/tmp', help="folder of the cached statistics of the real images")
+    args = parser.parse_args()
+
+    # one reference Encoder for all runs, or the Encoder of each run
+    extractor = args.extractor
+    if not args.extractor_run is None or extractor == 'pixels':
+        extractor = FeatureExtractor(extractor, args.extractor_run)
+    for run_path in args.run_path:
+        scores = evaluate(run_path, extractor, datapath=args.datapath, n_samples=args.n_samples,
+                          k=args.k, cache_dir=args.cache_dir, batch_size=args.batch_size)
+        print(f"{run_path:40s} FD {scores['fd']:10.4f} - precision {scores['precision']:.3f} - "
+              f"recall {scores['recall']:.3f} ({scores['t_total']:.1f}s)")
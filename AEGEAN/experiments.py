@@ -0,0 +1,183 @@
+"""
+Declarative sweeps of experiments, identified by the content of their options.
+
+A sweep is a base configuration plus a list of variants, each one overriding
+some options of the base:
+
+    variants = [variant('vanilla'),
+                variant('big_lrE', lrE=lambda opt: opt.lrE * 2),
+                *axis('optimizer', ['sgd', 'adam'])]
+    jobs = resolve(dict(img_size=256), variants, tag='AEGEAN_256_')
+
+An override is either a value or a function of the base options. The name of a
+variant may also be a function of the resolved options.
+
+The hash of the options which change the training (all but NON_SEMANTIC) is
+the identity of a run: it is written to `config.json` in the run folder, and
+`ResultCache` finds the runs which are done for a given configuration, under
+any name.
+"""
+import os
+import json
+import hashlib
+import argparse
+from glob import glob
+
+from .init import init
+from .checkpoint import atomic_write, read_status
+
+CONFIG_FILE = 'config.json'
+# options which do not change the trained models
+NON_SEMANTIC = ['run_path', 'verbose', 'diagnostics', 'load_model', 'sample_interval', 'N_samples',
+                'model_save_interval', 'data_mode', 'cache_size', 'num_workers', 'prefetch_factor',
+                'persistent_workers', 'pin_memory', 'metrics_interval', 'print_interval', 'timers']
+# options which may change when a run is resumed
+RESUMABLE = ['n_epochs']
+
+
+def _canonical(value):
+    if isinstance(value, bool) or value is None or isinstance(value, str):
+        return value
+    if isinstance(value, (int, float)):
+        # 2 and 2. are the same option
+        return float(value)
+    if hasattr(value, 'item'):
+        return _canonical(value.item())
+    if isinstance(value, (list, tuple)):
+        return [_canonical(v) for v in value]
+    return repr(value)
+
+
+def get_config(opt):
+    """
+    Options of opt which change the training, as a dictionary.
+
+    """
+    return {key: _canonical(value) for key, value in sorted(vars(opt).items()) if not key in NON_SEMANTIC}
+
+
+def config_hash(opt):
+    """
+    Hash of the options which change the training (hexadecimal string).
+
+    """
+    return hashlib.sha1(json.dumps(get_config(opt), sort_keys=True).encode()).hexdigest()
+
+
+def config_diff(saved, opt):
+    """
+    Options which change the training and differ between the options saved in a checkpoint (a dictionary) and opt,
+    ignoring RESUMABLE and the options unknown to either of them.
+
+    outputs a dictionary {key: (saved value, value in opt)}
+    """
+    saved, config = get_config(argparse.Namespace(**saved)), get_config(opt)
+    return {key: (saved[key], config[key]) for key in sorted(set(saved) & set(config))
+            if not key in RESUMABLE and not saved[key] == config[key]}
+
+
+def write_config(path_data, opt):
+    info = dict(hash=config_hash(opt), config=get_config(opt), run_path=opt.run_path)
+    atomic_write(os.path.join(path_data, CONFIG_FILE), lambda f: f.write(json.dumps(info, indent=1).encode()))
+
+
+def variant(name, when=None, **overrides):
+    """
+    One run of a sweep.
+
+    Args:
+            name (string): suffix of the run_path, or a function of the resolved options
+            when: function of the base options, the run is dropped when it returns False
+            overrides: values of the options, or functions of the base options
+    """
+    return dict(name=name, when=when, overrides=overrides)
+
+
+def axis(key, values, name=None, **kwargs):
+    """
+    One variant per value of the option key, named '<name>_<value>' (name defaults to key).
+
+    """
+    return [variant(f'{name or key}_{value}', **kwargs, **{key: value}) for value in values]
+
+
+def scale(key, factor):
+    """
+    Override multiplying the base value of key by factor (rounded down for integer options).
+
+    """
+    def value(opt):
+        value = getattr(opt, key) * factor
+        return int(value) if isinstance(getattr(opt, key), int) else value
+    return value
+
+
+def toggle(key, **kwargs):
+    """
+    Variant inverting the boolean option key, named 'do_<name>' or 'no_<name>' after the new value.
+
+    """
+    name = key[3:] if key.startswith('do_') else key
+    return variant(lambda opt: ('do_' if getattr(opt, key) else 'no_') + name,
+                   **{key: lambda opt: not getattr(opt, key)}, **kwargs)
+
+
+def resolve(base, variants, tag='', args=None):
+    """
+    Options of each variant of a sweep.
+
+    Args:
+            base (dict): values of the options common to all variants
+            variants (list): see variant
+            tag (string): prefix of the run_path of all variants
+            args (list): command line arguments for init (None: sys.argv)
+
+    outputs a list of (run_path, opt) pairs
+    """
+    defaults = init(args)
+    jobs = []
+    for spec in variants:
+        opt = argparse.Namespace(**vars(defaults))
+        for key, value in base.items():
+            set_option(opt, key, value)
+        if not spec['when'] is None and not spec['when'](opt):
+            continue
+        # all overrides are computed from the base options
+        values = {key: value(opt) if callable(value) else value for key, value in spec['overrides'].items()}
+        for key, value in values.items():
+            set_option(opt, key, value)
+        opt.run_path = tag + (spec['name'](opt) if callable(spec['name']) else spec['name'])
+        jobs.append((opt.run_path, opt))
+    return jobs
+
+
+def set_option(opt, key, value):
+    if not hasattr(opt, key):
+        raise ValueError(f'Unknown option {key}')
+    setattr(opt, key, value)
+
+
+class ResultCache(object):
+    def __init__(self, run_dir="./runs"):
+        """
+        Runs which are done in run_dir, by hash of their configuration.
+
+        """
+        self.runs = {}
+        for fname in sorted(glob(os.path.join(run_dir, '*', CONFIG_FILE))):
+            path_data = os.path.dirname(fname)
+            status = read_status(path_data)
+            if status is None or status['status'] != 'done':
+                continue
+            try:
+                with open(fname) as f:
+                    self.runs.setdefault(json.load(f)['hash'], os.path.basename(path_data))
+            except (OSError, ValueError, KeyError):
+                pass
+
+    def lookup(self, opt):
+        """
+        run_path of a run which is done with the same configuration as opt, or None.
+
+        """
+        return self.runs.get(config_hash(opt))
@@ -0,0 +1,189 @@
+"""
+Standalone TorchScript versions of the Generator and of the Encoder.
+
+The exported modules are in eval mode, carry the constants they need from opt
+(and not opt itself), and take the translation of the background of the
+Generator as an explicit argument. They are loaded without this package:
+
+    generator = torch.jit.load('generator.pt')
+    imgs = generator(z, [shift_x, shift_y])
+
+    $ python3 -m AEGEAN.export --run_path runs/AEGEAN_vanilla --output export/
+
+The options of the run are stored in the exported files as 'opt.json' (see
+`torch.jit.load`'s _extra_files).
+"""
+import os
+import json
+import time
+import argparse
+from typing import List
+import numpy as np
+import torch
+import torch.nn as nn
+
+from .models import hardsoft
+from .checkpoint import load_run
+
+
+class ScriptableGenerator(nn.Module):
+    def __init__(self, generator):
+        """
+        Generator with the same parameters as generator, without opt.
+
+        """
+        super(ScriptableGenerator, self).__init__()
+        opt = generator.opt
+        self.l0, self.l1 = generator.l0, generator.l1
+        self.conv1, self.conv2, self.conv3 = generator.conv1, generator.conv2, generator.conv3
+        self.img_block = generator.img_block
+        self.has_bg = opt.channel0_bg > 0
+        # empty modules when there is no background, such that the attributes always exist
+        self.bg_block = generator.bg_block if self.has_bg else nn.Sequential()
+        self.mask_block = generator.mask_block if self.has_bg else nn.Sequential()
+        self.channel3, self.init_size = int(opt.channel3), int(generator.init_size)
+        self.channel0_img = int(generator.channel0_img)
+        self.gamma = float(opt.gamma)
+
+    def forward(self, z, shift: List[int]):
+        """
+        shift: translation (in pixels, along the two image axes) of the background
+        """
+        out = self.l1(self.l0(z))
+        out = out.view(out.shape[0], self.channel3, self.init_size, self.init_size)
+        out = self.conv3(self.conv2(self.conv1(out)))
+        if self.has_bg:
+            img = self.img_block(out[:, :self.channel0_img, :, :])
+            bg = self.bg_block(out[:, self.channel0_img:, :, :])
+            bg = torch.roll(bg, shifts=(shift[0], shift[1]), dims=(-2, -1))
+            mask = torch.sigmoid(self.mask_block(out).float())
+            out = hardsoft(img) * mask + hardsoft(bg) * (1 - mask)
+        else:
+            out = hardsoft(self.img_block(out))
+        if not self.gamma == 1.:
+            out = torch.pow(out, 1/self.gamma)
+        return out
+
+
+class ScriptableEncoder(nn.Module):
+    def __init__(self, encoder):
+        """
+        Encoder with the same parameters as encoder, without opt.
+
+        """
+        super(ScriptableEncoder, self).__init__()
+        self.conv1, self.conv2, self.conv3, self.conv4 = encoder.conv1, encoder.conv2, encoder.conv3, encoder.conv4
+        self.vector0, self.vector1 = encoder.vector0, encoder.vector1
+        self.gamma = float(encoder.opt.gamma)
+
+    def forward(self, img):
+        if not self.gamma == 1.:
+            out = torch.pow(img, self.gamma)
+        else:
+            out = img * 1.
+        out = self.conv4(self.conv3(self.conv2(self.conv1(out))))
+        out = out.view(out.shape[0], -1)
+        return self.vector1(self.vector0(out))
+
+
+def random_shift(img_size, seed=None):
+    """
+    Translation of the background drawn as in `Generator.forward`, from a seed.
+
+    """
+    rng = np.random.default_rng(seed)
+    return [int(img_size*rng.random()), int(img_size*rng.random())]
+
+
+def script(encoder, generator):
+    """
+    TorchScript modules of the encoder and of the generator, in eval mode.
+
+    """
+    encoder.eval()
+    generator.eval()
+    return torch.jit.script(ScriptableEncoder(encoder)), torch.jit.script(ScriptableGenerator(generator))
+
+
+def export(encoder, generator, opt, output):
+    """
+    Saves the TorchScript encoder and generator to output/encoder.pt and output/generator.pt.
+
+    outputs the scripted modules
+    """
+    os.makedirs(output, exist_ok=True)
+    scripted_encoder, scripted_generator = script(encoder, generator)
+    extra_files = {'opt.json': json.dumps(vars(opt), default=repr)}
+    torch.jit.save(scripted_encoder, os.path.join(output, 'encoder.pt'), _extra_files=extra_files)
+    torch.jit.save(scripted_generator, os.path.join(output, 'generator.pt'), _extra_files=extra_files)
+    return scripted_encoder, scripted_generator
+
+
+def check_parity(encoder, generator, scripted_encoder, scripted_generator, batch_size=8, seed=42):
+    """
+    Largest absolute differences between the eager and the scripted outputs
+    on random inputs (same background translation).
+
+    """
+    opt = generator.opt
+    device = next(generator.parameters()).device
+    torch.manual_seed(seed)
+    z = torch.randn(batch_size, opt.latent_dim, device=device)
+    imgs = torch.rand(batch_size, opt.channels, opt.img_size, opt.img_size, device=device)
+    shift = random_shift(opt.img_size, seed)
+    encoder.eval()
+    generator.eval()
+    with torch.no_grad():
+        errors = dict(encoder=(encoder(imgs) - scripted_encoder(imgs)).abs().max().item(),
+                      generator=(generator(z, shift=shift) - scripted_generator(z, shift)).abs().max().item())
+    return errors
+
+
+def compare_latency(encoder, generator, scripted_encoder, scripted_generator, batch_size=8, n_iter=20, compile=False):
+    """
+    Time of one call (in seconds) of the eager, scripted and optionally
+    `torch.compile`d (warmed up by the first calls) encoder and generator.
+
+    """
+    opt = generator.opt
+    device = next(generator.parameters()).device
+    z = torch.randn(batch_size, opt.latent_dim, device=device)
+    imgs = torch.rand(batch_size, opt.channels, opt.img_size, opt.img_size, device=device)
+    shift = random_shift(opt.img_size, 0)
+    variants = dict(eager=(encoder, lambda z: generator(z, shift=shift)),
+                    script=(scripted_encoder, lambda z: scripted_generator(z, shift)))
+    if compile:
+        compiled_generator = torch.compile(ScriptableGenerator(generator))
+        variants['compile'] = (torch.compile(ScriptableEncoder(encoder)), lambda z: compiled_generator(z, shift))
+
+    def timeit(func, inputs):
+        with torch.no_grad():
+            for _ in range(3):
+                func(inputs)
+            if device.type == 'cuda': torch.cuda.synchronize()
+            t0 = time.perf_counter()
+            for _ in range(n_iter):
+                func(inputs)
+            if device.type == 'cuda': torch.cuda.synchronize()
+        return (time.perf_counter() - t0) / n_iter
+
+    results = {}
+    for name, (encode, decode) in variants.items():
+        results[name] = dict(encoder=timeit(encode, imgs), generator=timeit(decode, z))
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--run_path", type=str, required=True, help="folder of the run (with its checkpoint.pt)")
+    parser.add_argument("--output", type=str, default='', help="folder of the exported modules (default: the run folder)")
+    parser.add_argument("--compile", action="store_true", help="also compare the latency with torch.compile")
+    args = parser.parse_args()
+
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    opt, models = load_run(args.run_path, device=device)
+    scripted = export(models['encoder'], models['generator'], opt, args.output or args.run_path)
+    errors = check_parity(models['encoder'], models['generator'], *scripted)
+    print('Max abs difference with the eager models:', errors)
+    for name, times in compare_latency(models['encoder'], models['generator'], *scripted, compile=args.compile).items():
+        print(f"{name:8s} encoder {times['encoder']*1000:9.3f} ms - generator {times['generator']*1000:9.3f} ms")
@@ -0,0 +1,117 @@
+"""
+History of the losses and scores of a run.
+
+The history is append-only and column-oriented: one row per batch and one row
+per epoch (the means over the batches of the epoch), each column being a numpy
+array. It is saved with the checkpoints and written at the end of each epoch to
+`history.npz` in the run folder, which `load_history` reads back without going
+through the TensorBoard event files:
+
+    batches, epochs = load_history('runs/<run_path>')
+    plt.plot(epochs['epoch'], epochs['g_loss'])
+"""
+import os
+import numpy as np
+from .checkpoint import atomic_write
+
+HISTORY_FILE = 'history.npz'
+VALUES = ['e_loss', 'd_loss', 'g_loss', 'd_x', 'd_fake', 'd_g_z']
+BATCH_COLUMNS = ['epoch', 'iteration'] + VALUES + ['time']
+EPOCH_COLUMNS = ['epoch', 'n_batch'] + VALUES + ['time']
+INT_COLUMNS = ['epoch', 'iteration', 'n_batch']
+
+
+class Table(object):
+    def __init__(self, columns, capacity=1024):
+        """
+        Growable table of numpy columns (int32 for INT_COLUMNS, float32 otherwise).
+
+        """
+        self.columns = list(columns)
+        self.n = 0
+        self.data = {c: np.zeros(max(1, capacity), dtype=np.int32 if c in INT_COLUMNS else np.float32)
+                     for c in self.columns}
+
+    def append(self, **row):
+        """
+        Appends one row (missing values are NaN, or 0 for integer columns).
+
+        """
+        if self.n == len(self.data[self.columns[0]]):
+            for c in self.columns:
+                column = np.zeros(max(1, 2 * self.n), dtype=self.data[c].dtype)
+                column[:self.n] = self.data[c]
+                self.data[c] = column
+        for c in self.columns:
+            self.data[c][self.n] = row.get(c, 0 if c in INT_COLUMNS else np.nan)
+        self.n += 1
+
+    def __getitem__(self, column):
+        return self.data[column][:self.n]
+
+    def __len__(self):
+        return self.n
+
+    def arrays(self):
+        return {c: self[c] for c in self.columns}
+
+    def __getstate__(self):
+        # only the filled rows are pickled (e.g. in the checkpoints)
+        state = self.__dict__.copy()
+        state['data'] = {c: self[c].copy() for c in self.columns}
+        return state
+
+
+class History(object):
+    def __init__(self, nb_epochs=1, nb_batch=1):
+        """
+        Args:
+                nb_epochs (int): expected number of epochs
+                nb_batch (int): expected number of batches per epoch
+        """
+        # the batch table grows as needed, starting with one epoch
+        self.batches = Table(BATCH_COLUMNS, capacity=nb_batch)
+        self.epochs = Table(EPOCH_COLUMNS, capacity=nb_epochs)
+
+    def append_batch(self, epoch, iteration, time=np.nan, **values):
+        self.batches.append(epoch=epoch, iteration=iteration, time=time, **values)
+
+    def end_epoch(self, epoch, time=np.nan):
+        """
+        Appends the means over the batches of epoch to the epoch table.
+
+        outputs the row of the epoch, as a dictionary
+        """
+        # epochs are appended in increasing order
+        start = np.searchsorted(self.batches['epoch'], epoch, side='left')
+        stop = np.searchsorted(self.batches['epoch'], epoch, side='right')
+        row = dict(epoch=epoch, n_batch=stop - start, time=time)
+        for c in VALUES:
+            row[c] = np.mean(self.batches[c][start:stop]) if stop > start else np.nan
+        self.epochs.append(**row)
+        return row
+
+    def save(self, path_data):
+        """
+        Writes the history to HISTORY_FILE in the run folder (atomically).
+
+        """
+        arrays = {f'batch_{c}': a for c, a in self.batches.arrays().items()}
+        arrays.update({f'epoch_{c}': a for c, a in self.epochs.arrays().items()})
+        atomic_write(os.path.join(path_data, HISTORY_FILE), lambda f: np.savez(f, **arrays))
+
+
+def load_history(path):
+    """
+    Reads the history of a run (path of the run folder or of its HISTORY_FILE).
+
+    outputs the batch and the epoch columns, as two dictionaries of numpy arrays
+    """
+    if os.path.isdir(path):
+        path = os.path.join(path, HISTORY_FILE)
+    batches, epochs = {}, {}
+    with np.load(path) as data:
+        for key in data.files:
+            table, column = key.split('_', 1)
+            (batches if table == 'batch' else epochs)[column] = data[key]
+    return batches, epochs
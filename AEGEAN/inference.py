@@ -0,0 +1,206 @@
+"""
+Inference with the models of a trained run.
+
+    model = Inference('runs/AEGEAN_vanilla')
+    z = model.encode(imgs)                  # N x C x H x W images in [0, 1] (or uint8)
+    imgs = model.decode(z)
+    z, names = model.encode('../database/cats/')
+
+Inputs are processed by chunks of batch_size under `torch.inference_mode`; on
+GPU, the chunks are halved when they do not fit in memory. Folders are read
+by DataLoader workers and processed batch by batch (see `stream`).
+
+    $ python3 -m AEGEAN.inference encode --run_path runs/AEGEAN_vanilla --input images/ --output latents.npy
+    $ python3 -m AEGEAN.inference reconstruct --run_path runs/AEGEAN_vanilla --input images/ --output reconstructions/
+    $ python3 -m AEGEAN.inference decode --run_path runs/AEGEAN_vanilla --input latents.npy --output samples/
+"""
+import os
+import json
+import time
+import argparse
+import contextlib
+import numpy as np
+import torch
+
+from .checkpoint import load_run
+from .dataset import n_cpus, list_images, LazyFolderDataset
+from .utils import normalize_batch, NormalizeCollate
+
+
+class Inference(object):
+    def __init__(self, run_path, device=None, batch_size=None, amp=False, num_workers=None):
+        """
+        Args:
+                run_path (string): folder of the run (with its checkpoint.pt)
+                device: device of the models (default: GPU if available)
+                batch_size (int): size of the chunks (default: 512 on GPU, 64 on CPU)
+                amp (bool): mixed precision (see the --amp option of the training)
+                num_workers (int): number of DataLoader workers reading the folders (default: all CPUs)
+        """
+        self.device = torch.device(device or ('cuda' if torch.cuda.is_available() else 'cpu'))
+        self.opt, models = load_run(run_path, device=self.device)
+        self.encoder, self.generator = models['encoder'], models['generator']
+        self.batch_size = batch_size or (512 if self.device.type == 'cuda' else 64)
+        self.amp = amp
+        self.num_workers = n_cpus() if num_workers is None else num_workers
+
+    def autocast(self):
+        if not self.amp:
+            return contextlib.nullcontext()
+        return torch.autocast(device_type=self.device.type,
+                              dtype=torch.float16 if self.device.type == 'cuda' else torch.bfloat16)
+
+    def map(self, func, inputs):
+        """
+        Applies func to inputs by chunks on the device.
+
+        outputs the concatenated float32 outputs, on the CPU
+        """
+        outputs, start = [], 0
+        while start < len(inputs):
+            chunk = inputs[start:start + self.batch_size]
+            try:
+                with torch.inference_mode(), self.autocast():
+                    out = func(chunk.to(self.device, non_blocking=True)).float()
+            except torch.cuda.OutOfMemoryError:
+                if self.batch_size == 1:
+                    raise
+                self.batch_size //= 2
+                torch.cuda.empty_cache()
+                print(f"[Out of memory, batch size reduced to {self.batch_size}]")
+                continue
+            outputs.append(out.cpu())
+            start += len(chunk)
+        return torch.cat(outputs)
+
+    def prepare(self, imgs):
+        """
+        N x C x H x W images: float images are used as they are (in [0, 1]), uint8 images are normalized
+        as in the training (see normalize_batch).
+
+        """
+        if not tuple(imgs.shape[1:]) == (self.opt.channels, self.opt.img_size, self.opt.img_size):
+            raise ValueError(f'Expected N x {self.opt.channels} x {self.opt.img_size} x {self.opt.img_size} images, '
+                             f'got {tuple(imgs.shape)}')
+        if imgs.dtype == torch.uint8:
+            return normalize_batch(imgs)
+        return imgs.float()
+
+    def stream(self, path, func):
+        """
+        Applies func (e.g. self.encode) to the images of a folder, batch by batch.
+
+        outputs a generator of (outputs, file names)
+        """
+        dataset = LazyFolderDataset(path, self.opt.img_size, self.opt.img_size, transform=None, cache_size=0)
+        kwargs = dict(prefetch_factor=4) if self.num_workers > 0 else {}
+        loader = torch.utils.data.DataLoader(dataset, batch_size=self.batch_size, shuffle=False,
+                                             num_workers=self.num_workers, collate_fn=NormalizeCollate(0., 1.),
+                                             pin_memory=self.device.type == 'cuda', **kwargs)
+        for imgs, names in loader:
+            yield func(imgs), names
+
+    def _apply(self, func, images):
+        if isinstance(images, str):
+            batches = list(self.stream(images, func))
+            if not batches:
+                raise ValueError(f'No images in {images}')
+            outputs, names = zip(*batches)
+            return torch.cat(outputs), [name for batch in names for name in batch]
+        return func(images)
+
+    def encode(self, images):
+        """
+        Latent vectors of images (a tensor, or a folder: then also outputs the file names).
+
+        """
+        return self._apply(lambda imgs: self.map(self.encoder, self.prepare(imgs)), images)
+
+    def decode(self, z, shift=None):
+        """
+        Images generated from the latent vectors z.
+
+        shift: translation of the background (see Generator.forward), random by default
+        """
+        return self.map(lambda z: self.generator(z, shift=shift), torch.as_tensor(z, dtype=torch.float32))
+
+    def reconstruct(self, images, shift=None):
+        """
+        Images auto-encoded by the encoder and the generator (a tensor, or a folder: then also outputs the file names).
+
+        """
+        return self._apply(lambda imgs: self.map(lambda x: self.generator(self.encoder(x), shift=shift),
+                                                 self.prepare(imgs)), images)
+
+
+def save_images(imgs, names, output):
+    """
+    Writes each image to output as a PNG file named after names.
+
+    """
+    from torchvision.utils import save_image
+    os.makedirs(output, exist_ok=True)
+    for img, name in zip(imgs, names):
+        save_image(img, os.path.join(output, os.path.splitext(os.path.basename(name))[0] + '.png'))
+
+
+def encode_folder(model, path, output):
+    """
+    Encodes the images of a folder, batch by batch, to a memory-mapped N x
+    latent_dim float32 array (output, a .npy file) with the file names in a
+    .json file next to it. Both files are written under a temporary name and
+    then renamed, the array first.
+
+    outputs the number of images
+    """
+    prefix = os.path.splitext(output)[0]
+    tmp_path = f'{prefix}.tmp{os.getpid()}.npy'
+    latents = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.float32,
+                                        shape=(len(list_images(path)), model.opt.latent_dim))
+    names = []
+    for z, batch_names in model.stream(path, model.encode):
+        latents[len(names):len(names) + len(z)] = z.numpy()
+        names.extend(batch_names)
+    latents.flush()
+    del latents
+    os.replace(tmp_path, f'{prefix}.npy')
+    tmp_path = f'{prefix}.tmp{os.getpid()}.json'
+    with open(tmp_path, 'w') as f:
+        json.dump(dict(files=names, datapath=path, latent_dim=model.opt.latent_dim), f)
+    os.replace(tmp_path, f'{prefix}.json')
+    return len(names)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("command", choices=['encode', 'decode', 'reconstruct'])
+    parser.add_argument("--run_path", type=str, required=True, help="folder of the run (with its checkpoint.pt)")
+    parser.add_argument("--input", type=str, required=True, help="folder of images (encode, reconstruct) or .npy latents (decode)")
+    parser.add_argument("--output", type=str, required=True, help=".npy file of latents (encode) or folder of images")
+    parser.add_argument("--batch_size", type=int, default=None, help="size of the chunks")
+    parser.add_argument("--num_workers", type=int, default=None, help="number of DataLoader workers")
+    parser.add_argument("--amp", action="store_true", help="mixed precision")
+    parser.add_argument("--seed", type=int, default=None, help="seed of the translation of the background")
+    args = parser.parse_args()
+
+    t0 = time.time()
+    model = Inference(args.run_path, batch_size=args.batch_size, amp=args.amp, num_workers=args.num_workers)
+    shift = None
+    if not args.seed is None:
+        from .export import random_shift
+        shift = random_shift(model.opt.img_size, args.seed)
+
+    n_images = 0
+    if args.command == 'encode':
+        n_images = encode_folder(model, args.input, args.output)
+    elif args.command == 'reconstruct':
+        for imgs, names in model.stream(args.input, lambda imgs: model.reconstruct(imgs, shift=shift)):
+            save_images(imgs, names, args.output)
+            n_images += len(imgs)
+    else:
+        z = np.load(args.input, mmap_mode='r')
+        for start in range(0, len(z), model.batch_size):
+            imgs = model.decode(np.array(z[start:start + model.batch_size]), shift=shift)
+            save_images(imgs, [f'{i:06d}' for i in range(start, start + len(imgs))], args.output)
+            n_images += len(imgs)
+    print(f"[{args.command}: {n_images} images in {time.time() - t0:.1f}s]")
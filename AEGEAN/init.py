@@ -11,8 +11,11 @@ elif HOST == 'fortytwo':
 else:
     DEBUG = 1
 
+# values of --reuse_latent
+REUSE_LATENT = ['', 'detach', 'recompute']
 
-def init():
+
+def init(args=None):
     parser = argparse.ArgumentParser()
     parser.add_argument("--run_path", type=str, default='vanilla', help="TensorBoard folder to save samples data and statistics")
     parser.add_argument("--n_epochs", type=int, default=2048, help="number of epochs of training")
@@ -39,6 +42,9 @@ def init():
     parser.add_argument("--do_slerp", type=bool, default=True, help="Draw random vectors between E(x1) and  E(x2).")
     parser.add_argument("--do_joint", type=bool, default=True, help="Do a joint learning of E and G, dude.")
     parser.add_argument("--do_insight", type=bool, default=False, help="D looks at G_E_x instead of x.")
+    parser.add_argument("--reuse_latent", type=str, default='', choices=REUSE_LATENT,
+                        help="Encode the real images once per iteration for the D and G steps: '' (no), 'detach' (reuse the E step) or 'recompute' (once after the E update).")
+    parser.add_argument("--amp", type=bool, default=False, help="Mixed precision (bfloat16 on CPU, float16 with loss scaling on GPU).")
     parser.add_argument("--do_transpose", type=bool, default=False, help="use of Conv2Dtranspose.")
     parser.add_argument("--bn_eps", type=float, default=0.01, help="norm: espilon for numerical stability")
     parser.add_argument("--bn_momentum", type=float, default=.1, help="batchnorm: momentum for numerical stability")
@@ -59,18 +65,35 @@ def init():
     parser.add_argument("--img_size", type=int, default=128//DEBUG, help="size of each image dimension")
     parser.add_argument("--window_size", type=int, default=11, help="size of window_size for SSIM")
     parser.add_argument("--channels", type=int, default=3, help="number of input image channels")
+    parser.add_argument("--seed", type=int, default=None, help="seed of the random number generators (None: not reproducible)")
     parser.add_argument("--sample_interval", type=int, default=128, help="interval in epochs between image sampling")
     parser.add_argument("--N_samples", type=int, default=48, help="number of images each sampling")
-    # parser.add_argument("--model_save_interval", type=int, default=5000,
-    #                     help="interval between image sampling. If model_save_interval > n_epochs : no save")
+    parser.add_argument("--model_save_interval", type=int, default=64,
+                        help="interval in epochs between checkpoints of the run (the last epoch is always saved)")
     # parser.add_argument('--model_save_path', type=str, default='models')
     # parser.add_argument('--datapath', type=str, default='../database/Simpsons-Face_clear/cp/')
     parser.add_argument('--datapath', type=str, default='../database/CFD Version 2.0.3/CFD 2.0.3 Images')
-    # parser.add_argument('--load_model', action="store_true",
-    #                     help="Load model present in model_save_path/Last_*.pt, if present.")
+    parser.add_argument('--load_model', action="store_true",
+                        help="Resume from the checkpoint in the run folder, if present.")
+    parser.add_argument('--data_mode', type=str, default='store',
+                        help="How images are loaded: 'store' (memory-mapped cache), 'shm' (same, shared in /dev/shm by the runs of the node), 'lazy' or 'stream' (decoded on the fly, for large folders).")
+    parser.add_argument("--cache_size", type=int, default=1024, help="number of decoded images kept by each worker in the lazy modes")
+    parser.add_argument("--num_workers", type=int, default=None,
+                        help="number of DataLoader workers (default: 1 on GPU, 0 on CPU, -1: tuned against the step time)")
+    parser.add_argument("--prefetch_factor", type=int, default=2, help="number of batches loaded in advance by each worker")
+    parser.add_argument("--persistent_workers", action=argparse.BooleanOptionalAction, default=True, help="keep the DataLoader workers alive between epochs")
+    parser.add_argument("--pin_memory", action=argparse.BooleanOptionalAction, default=True, help="pin the batches in memory for faster transfers to the GPU")
     parser.add_argument("--verbose", type=bool, default=False if DEBUG < 4 else True,
                                      help="Displays more verbose output.")
-    opt = parser.parse_args()
+    parser.add_argument("--metrics_interval", type=int, default=16,
+                        help="Number of batches between two copies of the losses and scores to the host.")
+    parser.add_argument("--print_interval", type=float, default=10.,
+                        help="Minimal time between two printed progress lines, in seconds (0: every batch).")
+    parser.add_argument("--timers", type=bool, default=False,
+                        help="Time the phases of the training loop (data, E, D, G, metrics, tensorboard, checkpoint), synchronizing the device.")
+    parser.add_argument("--diagnostics", type=str, default='',
+                        help="Comma-separated list of diagnostics among shapes, minmax, nan, anomaly or all (off by default).")
+    opt = parser.parse_args(args)
 
     # Dossier de sauvegarde
     # os.makedirs(opt.model_save_path, exist_ok=True)
@@ -0,0 +1,216 @@
+"""
+Latent vectors of a whole dataset and nearest-neighbour search among them.
+
+The encoder of a run is applied once to all the images of its dataset; the
+vectors are stored as a memory-mapped N x latent_dim float32 array with the
+file names (see `inference.encode_folder`), by default in the run folder:
+
+    $ python3 -m AEGEAN.latent_index build --run_path runs/AEGEAN_vanilla
+    $ python3 -m AEGEAN.latent_index query --run_path runs/AEGEAN_vanilla --n_samples 4096 --k 5
+
+`LatentIndex.search` is exact: the database is read by blocks, the distances
+to the queries are computed with one matrix product per block and the k best
+are kept with `torch.topk`. With `build_ivf`, `search(..., n_probe=...)` only
+looks at the vectors of the n_probe clusters closest to each query (inverted
+file over a k-means of the vectors): it is approximate, and much faster for
+large datasets.
+
+The query command encodes generated images, E(G(z)), and compares their
+distance to the nearest image of the dataset with the distance between
+images of the dataset: generated samples much closer to the dataset than
+real images are to each other are a sign of memorization, and many samples
+sharing the same neighbours a sign of mode collapse.
+"""
+import os
+import json
+import time
+import argparse
+import numpy as np
+import torch
+
+INDEX_FILE = 'latents.npy'
+
+
+class LatentIndex(object):
+    def __init__(self, path, device=None, block_size=65536, query_block_size=1024):
+        """
+        Args:
+                path (string): .npy array of latent vectors (with its .json index of file names)
+                device: device of the computations (default: GPU if available)
+                block_size (int): number of vectors of the database compared at once with the queries
+                query_block_size (int): number of queries compared at once with a block of the database
+                                        (the distance matrix holds query_block_size x block_size floats)
+        """
+        self.prefix = os.path.splitext(path)[0]
+        self.latents = np.load(f'{self.prefix}.npy', mmap_mode='r')
+        with open(f'{self.prefix}.json') as f:
+            self.files = json.load(f)['files']
+        self.device = torch.device(device or ('cuda' if torch.cuda.is_available() else 'cpu'))
+        self.block_size, self.query_block_size = block_size, query_block_size
+        self.ivf = None
+        if os.path.isfile(f'{self.prefix}.ivf.npz'):
+            self.load_ivf()
+
+    def __len__(self):
+        return len(self.latents)
+
+    def blocks(self):
+        """
+        Blocks of the database on the device, with the index of their first row.
+
+        """
+        for start in range(0, len(self), self.block_size):
+            block = self.latents[start:start + self.block_size]
+            yield start, torch.as_tensor(np.asarray(block, dtype=np.float32), device=self.device)
+
+    @staticmethod
+    def distances(queries, block, metric='l2'):
+        """
+        Squared L2 distances (or cosine distances) between each query and each vector of block.
+
+        """
+        if metric == 'cosine':
+            return 1 - torch.nn.functional.normalize(queries, dim=1) @ torch.nn.functional.normalize(block, dim=1).T
+        # |q - b|^2 = |q|^2 - 2 q.b + |b|^2, with one matrix product
+        dist = queries.pow(2).sum(1, keepdim=True) - 2 * queries @ block.T + block.pow(2).sum(1)[None, :]
+        return dist.clamp_(min=0)
+
+    def search(self, queries, k=10, metric='l2', n_probe=None):
+        """
+        k nearest neighbours of each query.
+
+        Args:
+                queries: Q x latent_dim array or tensor
+                k (int): number of neighbours
+                metric (string): 'l2' (squared distance) or 'cosine'
+                n_probe (int): approximate search among the vectors of the n_probe closest clusters (see build_ivf),
+                               None for an exact search
+
+        outputs the Q x k distances and the Q x k indices of the neighbours (-1 when there are less than k), on the CPU
+        """
+        queries = torch.as_tensor(np.asarray(queries, dtype=np.float32), device=self.device)
+        best_dist = torch.full((len(queries), k), np.inf, device=self.device)
+        best_index = torch.full((len(queries), k), -1, dtype=torch.long, device=self.device)
+
+        def merge(rows, dist, index):
+            # keeps the k best among the current ones and the new candidates
+            dist = torch.cat([best_dist[rows], dist], dim=1)
+            index = torch.cat([best_index[rows], index], dim=1)
+            dist, order = torch.topk(dist, k, dim=1, largest=False)
+            best_dist[rows], best_index[rows] = dist, torch.gather(index, 1, order)
+
+        def compare(rows, block, index):
+            # by chunks of queries, such that the distance matrix stays bounded
+            for chunk in rows.split(self.query_block_size):
+                dist = self.distances(queries[chunk], block, metric)
+                dist, nearest = torch.topk(dist, min(k, block.shape[0]), dim=1, largest=False)
+                merge(chunk, dist, index[nearest])
+
+        all_rows = torch.arange(len(queries), device=self.device)
+        if n_probe is None:
+            # each block of the database is read once, for all the queries
+            for start, block in self.blocks():
+                compare(all_rows, block, torch.arange(start, start + block.shape[0], device=self.device))
+        else:
+            if self.ivf is None:
+                raise ValueError('No inverted file, see build_ivf')
+            centroids, order, offsets = self.ivf
+            probes = torch.cat([torch.topk(self.distances(chunk, centroids, metric), min(n_probe, len(centroids)),
+                                           dim=1, largest=False).indices
+                                for chunk in queries.split(self.query_block_size)])
+            for cluster in torch.unique(probes).tolist():
+                rows = torch.nonzero((probes == cluster).any(dim=1)).flatten()
+                # rows of the cluster, in increasing order (see build_ivf)
+                members = order[offsets[cluster]:offsets[cluster + 1]]
+                if len(members) == 0:
+                    continue
+                block = torch.as_tensor(np.asarray(self.latents[members], dtype=np.float32), device=self.device)
+                compare(rows, block, torch.as_tensor(members, device=self.device))
+        return best_dist.cpu(), best_index.cpu()
+
+    def build_ivf(self, n_lists=None, n_iter=10, n_train=65536, seed=42):
+        """
+        Inverted file: k-means of the vectors into n_lists clusters (default: sqrt(N)) and the members of each
+        cluster, saved next to the index.
+
+        """
+        rng = np.random.default_rng(seed)
+        train = np.sort(rng.choice(len(self), min(n_train, len(self)), replace=False))
+        train = torch.as_tensor(np.asarray(self.latents[train], dtype=np.float32), device=self.device)
+        n_lists = min(n_lists or max(1, int(np.sqrt(len(self)))), len(train))
+        centroids = train[torch.as_tensor(rng.choice(len(train), n_lists, replace=False), device=self.device)]
+        for _ in range(n_iter):
+            assign = self.distances(train, centroids).argmin(dim=1)
+            sums = torch.zeros_like(centroids).index_add_(0, assign, train)
+            counts = torch.bincount(assign, minlength=n_lists).float()[:, None]
+            # empty clusters keep their centroid
+            centroids = torch.where(counts > 0, sums / counts.clamp(min=1), centroids)
+        assign = torch.cat([self.distances(block, centroids).argmin(dim=1) for _, block in self.blocks()]).cpu().numpy()
+        # stable: the rows of each cluster stay in increasing order
+        order = np.argsort(assign, kind='stable')
+        offsets = np.concatenate([[0], np.cumsum(np.bincount(assign, minlength=n_lists))])
+        tmp_path = f'{self.prefix}.tmp{os.getpid()}.ivf.npz'
+        np.savez(tmp_path, centroids=centroids.cpu().numpy(), order=order, offsets=offsets)
+        os.replace(tmp_path, f'{self.prefix}.ivf.npz')
+        self.load_ivf()
+
+    def load_ivf(self):
+        with np.load(f'{self.prefix}.ivf.npz') as data:
+            self.ivf = (torch.as_tensor(data['centroids'], device=self.device), data['order'], data['offsets'])
+
+
+def build(run_path, datapath=None, output=None, **kwargs):
+    """
+    Encodes the dataset of a run (by default its opt.datapath) to output (by default INDEX_FILE in the run folder).
+
+    outputs the LatentIndex
+    """
+    from .inference import Inference, encode_folder
+    model = Inference(run_path, **kwargs)
+    output = output or os.path.join(run_path, INDEX_FILE)
+    t0 = time.time()
+    n_images = encode_folder(model, datapath or model.opt.datapath, output)
+    print(f"[Latent index: {n_images} images encoded in {time.time() - t0:.1f}s]")
+    return LatentIndex(output)
+
+
+def generated_latents(model, n_samples, seed=42):
+    """
+    E(G(z)) for n_samples random latent vectors z.
+
+    """
+    z = torch.randn(n_samples, model.opt.latent_dim, generator=torch.Generator().manual_seed(seed))
+    return model.map(lambda z: model.encoder(model.generator(z)), z)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("command", choices=['build', 'query'])
+    parser.add_argument("--run_path", type=str, required=True, help="folder of the run (with its checkpoint.pt)")
+    parser.add_argument("--datapath", type=str, default=None, help="folder of the images (default: the datapath of the run)")
+    parser.add_argument("--index", type=str, default=None, help=f"latent index (default: {INDEX_FILE} in the run folder)")
+    parser.add_argument("--n_lists", type=int, default=None, help="number of clusters of the inverted file (build)")
+    parser.add_argument("--n_samples", type=int, default=4096, help="number of generated samples (query)")
+    parser.add_argument("--k", type=int, default=5, help="number of neighbours (query)")
+    parser.add_argument("--n_probe", type=int, default=None, help="approximate search in the n_probe closest clusters (query)")
+    args = parser.parse_args()
+
+    path = args.index or os.path.join(args.run_path, INDEX_FILE)
+    if args.command == 'build':
+        index = build(args.run_path, args.datapath, path)
+        index.build_ivf(args.n_lists)
+    else:
+        from .inference import Inference
+        model = Inference(args.run_path)
+        index = LatentIndex(path)
+        t0 = time.time()
+        dist, neighbours = index.search(generated_latents(model, args.n_samples), k=args.k, n_probe=args.n_probe)
+        t_search = time.time() - t0
+        # reference: distance of real images to their nearest other real image
+        rows = np.sort(np.random.default_rng(42).choice(len(index), min(args.n_samples, len(index)), replace=False))
+        real_dist, _ = index.search(index.latents[rows], k=2, n_probe=args.n_probe)
+        n_unique = len(np.unique(neighbours[:, 0].numpy()))
+        print(f"[{args.n_samples} queries in {t_search:.2f}s over {len(index)} latents]")
+        print(f"nearest neighbour distance: generated {dist[:, 0].median().item():.4f} (median) - "
+              f"real {real_dist[:, 1].median().item():.4f} (median)")
+        print(f"distinct nearest neighbours: {n_unique} for {args.n_samples} samples")
@@ -0,0 +1,92 @@
+"""
+Per-batch statistics of the training, without synchronizing with the device.
+
+The losses and scores of each batch are written to a buffer on the device.
+Every `flush_every` batches, the buffer is copied to (pinned) host memory
+asynchronously, and the previous copy, which has completed in the meantime, is
+appended to the history (see `History`). Progress is printed at most every
+`print_interval` seconds.
+"""
+import time
+import torch
+
+from .history import VALUES as METRICS
+
+
+class MetricsAccumulator(object):
+    def __init__(self, hist, device, run_path='', n_epochs=1, nb_batch=1, flush_every=16, print_interval=10.):
+        """
+        Args:
+                hist (History): history of the run, appended to
+                device: device of the losses and scores
+                run_path (string): prefix of the printed lines
+                n_epochs (int): number of epochs (printed)
+                nb_batch (int): number of batches per epoch (printed)
+                flush_every (int): number of batches between two copies to the host
+                print_interval (float): minimal time between two printed lines, in seconds (0: every batch)
+        """
+        self.hist = hist
+        self.run_path, self.n_epochs, self.nb_batch = run_path, n_epochs, nb_batch
+        self.flush_every = max(1, flush_every)
+        self.print_interval = print_interval
+        use_cuda = torch.device(device).type == 'cuda'
+        shape = (self.flush_every, len(METRICS))
+        self.values = torch.zeros(shape, device=device)
+        # two host buffers: one is read while the other one is written
+        self.host = [torch.zeros(shape, pin_memory=use_cuda) for _ in range(2)]
+        self.events = [torch.cuda.Event() if use_cuda else None for _ in range(2)]
+        self.i_host = 0
+        self.steps = [] # (epoch, iteration, time) of the rows of self.values
+        self.in_flight = None # (index of the host buffer, steps) being copied
+        self.last = None
+        self.t_print = 0.
+
+    def record(self, epoch, iteration, t_batch, **values):
+        """
+        Records the values of one batch (tensors on the device, see METRICS).
+
+        """
+        row = self.values[len(self.steps)]
+        with torch.no_grad():
+            row.copy_(torch.stack([values[name].detach().float().mean() for name in METRICS]))
+        self.steps.append((epoch, iteration, t_batch))
+        if len(self.steps) == self.flush_every:
+            self.flush()
+
+    def flush(self, wait=False):
+        """
+        Starts the copy of the recorded values to the host, and writes the
+        previous copy to the history. With wait, also waits for this copy.
+
+        """
+        if self.steps:
+            n = len(self.steps)
+            self.host[self.i_host][:n].copy_(self.values[:n], non_blocking=True)
+            if not self.events[self.i_host] is None:
+                self.events[self.i_host].record()
+            previous, self.in_flight = self.in_flight, (self.i_host, self.steps)
+            self.steps, self.i_host = [], 1 - self.i_host
+            if not previous is None:
+                self.write(*previous)
+        if wait and not self.in_flight is None:
+            self.write(*self.in_flight)
+            self.in_flight = None
+
+    def write(self, i_host, steps):
+        if not self.events[i_host] is None:
+            self.events[i_host].synchronize()
+        rows = self.host[i_host][:len(steps)].tolist()
+        for (epoch, iteration, t_batch), row in zip(steps, rows):
+            self.hist.append_batch(epoch, iteration, time=t_batch, **dict(zip(METRICS, row)))
+        self.last = dict(zip(METRICS, rows[-1]))
+        epoch, iteration, t_batch = steps[-1]
+        if time.time() - self.t_print >= self.print_interval or iteration + 1 == self.nb_batch:
+            self.t_print = time.time()
+            self.print_line(epoch, iteration, t_batch, self.last)
+
+    def print_line(self, epoch, iteration, t_batch, values):
+        print(
+            "%s [Epoch %d/%d] [Batch %d/%d] [E loss: %f] [D loss: %f] [G loss: %f] [D(x) %f] [D(G(z)) %f] [D(G(z')) %f] [Time: %fs]"
+            % (self.run_path, epoch, self.n_epochs, iteration+1, self.nb_batch, values['e_loss'], values['d_loss'],
+               values['g_loss'], values['d_x'], values['d_fake'], values['d_g_z'], t_batch)
+        )
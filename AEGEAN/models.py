@@ -9,7 +9,9 @@ import torch
 cuda = True if torch.cuda.is_available() else False
 
 
-def hardsoft(img, rho=.9):
+def hardsoft(img: torch.Tensor, rho: float = .9):
+    # computed in float32, also under autocast
+    img = img.float()
     return rho * F.hardtanh(img, min_val=0.0, max_val=1.0) + (1-rho) * torch.sigmoid(img-.5)
 
 
@@ -93,31 +95,19 @@ class Encoder(nn.Module):
         self.opt = opt
 
     def forward(self, img):
-        if self.opt.verbose: print("Encoder")
-        if self.opt.verbose:
-            print("Image shape : ", img.shape)
-            print("Image min-max : ", img.min(), img.max())
         if not(self.opt.gamma == 1.):
             # https://en.wikipedia.org/wiki/Gamma_correction
             out = torch.pow(img, self.opt.gamma)
         else:
             out = img * 1.
-        if self.opt.verbose: print("Image shape : ", out.shape)
         out = self.conv1(out)
-        if self.opt.verbose: print("Conv1 out : ", out.shape)
         out = self.conv2(out)
-        if self.opt.verbose: print("Conv2 out : ", out.shape)
         out = self.conv3(out)
-        if self.opt.verbose: print("Conv3 out : ", out.shape)
         out = self.conv4(out)
-        if self.opt.verbose: print("Conv4 out : ", out.shape)
 
         out = out.view(out.shape[0], -1)
-        if self.opt.verbose: print("View out : ", out.shape, " init_size=", self.init_size)
         out = self.vector0(out)
-        if self.opt.verbose: print("Z0 : ", out.shape)
         out = self.vector1(out)
-        if self.opt.verbose: print("Z1 : ", out.shape)
 
         return out
 
@@ -201,55 +191,45 @@ class Generator(nn.Module):
 
         self.opt = opt
 
-    def forward(self, z):
-        if self.opt.verbose: print("Generator")
+    def forward(self, z, shift=None):
+        """
+        shift: translation (in pixels, along the two image axes) of the background, random by default
+        """
         # Dim : opt.latent_dim
         out = self.l0(z)
-        if self.opt.verbose: print("l0 out : ", out.shape)
         # out = self.l00(out)
-        # if self.opt.verbose: #     print("l00 out : ", out.shape)
         out = self.l1(out)
-        if self.opt.verbose: print("l1 out : ", out.shape)
         out = out.view(out.shape[0], self.opt.channel3, self.init_size, self.init_size)
         # Dim : (opt.channel3, opt.img_size/8, opt.img_size/8)
-        if self.opt.verbose: print("View out : ", out.shape)
 
         out = self.conv1(out)
         # Dim : (opt.channel3/2, opt.img_size/4, opt.img_size/4)
-        if self.opt.verbose: print("Conv1 out : ", out.shape)
         out = self.conv2(out)
         # Dim : (opt.channel3/4, opt.img_size/2, opt.img_size/2)
-        if self.opt.verbose: print("Conv2 out : ", out.shape)
 
         out = self.conv3(out)
         # Dim : (opt.channel3/8, opt.img_size, opt.img_size)
-        if self.opt.verbose: print("Conv3 out : ", out.shape)
 
         if self.opt.channel0_bg>0:
             # implement a prior in the generator for the background + mask to merge it with the figure
             img = self.img_block(out[:, :self.channel0_img, :, :])
             bg = self.bg_block(out[:, self.channel0_img:, :, :])
             # random translation https://pytorch.org/docs/stable/torch.html#torch.roll
-            shift_x, shift_y = int(self.opt.img_size*np.random.rand()), int(self.opt.img_size*np.random.rand())
+            if shift is None:
+                shift = int(self.opt.img_size*np.random.rand()), int(self.opt.img_size*np.random.rand())
             #shift_x, shift_y = int(10*np.random.rand()-5), int(10*np.random.rand()-5)
-            bg = torch.roll(bg, shifts=(shift_x, shift_y), dims=(-2, -1))
+            bg = torch.roll(bg, shifts=(int(shift[0]), int(shift[1])), dims=(-2, -1))
 
             mask = self.mask_block(out)
             # Dim : (opt.chanels, opt.img_size, opt.img_size)
-            if self.opt.verbose:
-                print("img shape : ", img.shape)
-                print("mask shape : ", mask.shape)
-                print("bg shape : ", bg.shape)
 
             # the mask represents the alpha channel of the figure.
-            out = hardsoft(img) * torch.sigmoid(mask) + hardsoft(bg) * (1 - torch.sigmoid(mask))
+            mask = torch.sigmoid(mask.float())
+            out = hardsoft(img) * mask + hardsoft(bg) * (1 - mask)
         else:
             out = hardsoft(self.img_block(out))
-            if self.opt.verbose: print("img shape : ", out.shape)
 
         # # https://en.wikipedia.org/wiki/Gamma_correction
-        # if self.opt.verbose:
-        #     print("out Image min-max : ", out.min(), out.max())
         if not(self.opt.gamma == 1.):
             out = torch.pow(out, 1/self.opt.gamma)
 
@@ -290,32 +270,15 @@ class Discriminator(nn.Module):
         self.adv_layer = nn.Linear(opt.channel4, 1)
 
     def forward(self, img):
-        if self.opt.verbose:
-            print("D")
-            print("Image shape : ", img.shape)
-            # Dim : (opt.chanels, opt.img_size, opt.img_size)
-            print("img Image min-max : ", img.min(), img.max())
-
+        # Dim : (opt.chanels, opt.img_size, opt.img_size)
         out = self.conv1(img)
-        if self.opt.verbose: print("Conv1 out : ", out.shape)
-
         out = self.conv2(out)
-        if self.opt.verbose: print("Conv2 out : ", out.shape)
-
         out = self.conv3(out)
-        if self.opt.verbose: print("Conv3 out : ", out.shape)
-
         out = self.conv4(out)
-        if self.opt.verbose: print("Conv4 out : ", out.shape)
 
         out = out.view(out.shape[0], -1)
-        if self.opt.verbose: print("View out : ", out.shape)
-
         out = self.lnl(out)
-        if self.opt.verbose: print("LNL out : ", out.shape)
-
         validity = self.adv_layer(out)
-        if self.opt.verbose: print("Val out : ", validity.shape)
 
         return validity
 
@@ -0,0 +1,194 @@
+"""
+Videos of spherical interpolations between keyframes in the latent space.
+
+The keyframes are random latent vectors, or the latent vectors of chosen
+images (see `Inference.encode`). The path between two keyframes is sampled
+with `slerp`; the frames are generated by batches on the device and piped one
+by one to ffmpeg (see FFmpegWriter), which encodes them as they come, such
+that the memory used does not depend on the length of the video:
+
+    $ python3 -m AEGEAN.render --run_path runs/AEGEAN_vanilla --output morph.mp4 --n_keyframes 64 --loop
+    $ python3 -m AEGEAN.render --run_path runs/AEGEAN_vanilla --output morph.gif --images keyframes/ --fps 10
+
+The format is given by the extension of output. GIF frames get their own
+palette, such that they are also encoded one by one (the writers of imageio
+and Pillow keep all the frames of a GIF until it is closed).
+"""
+import time
+import shutil
+import argparse
+import subprocess
+import numpy as np
+import torch
+
+from .utils import slerp
+
+
+def ffmpeg_exe():
+    """
+    Path of the ffmpeg executable, from the imageio-ffmpeg package or the PATH.
+
+    """
+    try:
+        import imageio_ffmpeg
+        return imageio_ffmpeg.get_ffmpeg_exe()
+    except (ImportError, RuntimeError):
+        pass
+    exe = shutil.which('ffmpeg')
+    if exe is None:
+        raise RuntimeError('ffmpeg not found: install imageio-ffmpeg')
+    return exe
+
+
+class FFmpegWriter(object):
+    def __init__(self, output, fps=30):
+        """
+        Video (or GIF) encoded by ffmpeg from frames written to its standard input.
+
+        Args:
+                output (string): video file, its format is given by its extension
+                fps (int): frames per second
+        """
+        self.output, self.fps = output, fps
+        self.process = None
+
+    def start(self, shape):
+        height, width = shape[:2]
+        cmd = [ffmpeg_exe(), '-y', '-loglevel', 'error', '-f', 'rawvideo',
+               '-pix_fmt', 'gray' if len(shape) == 2 else 'rgb24', '-s', f'{width}x{height}',
+               '-r', str(self.fps), '-i', '-']
+        if self.output.lower().endswith('.gif'):
+            # one palette per frame, computed from that frame only
+            cmd += ['-vf', 'split[a][b];[a]palettegen=stats_mode=single[p];[b][p]paletteuse=new=1', '-loop', '0']
+        else:
+            cmd += ['-pix_fmt', 'yuv420p']
+        self.process = subprocess.Popen(cmd + [self.output], stdin=subprocess.PIPE)
+
+    def append_data(self, frame):
+        """
+        Writes a H x W (x 3) uint8 frame (blocks while ffmpeg is busy).
+
+        """
+        if self.process is None:
+            self.start(frame.shape)
+        self.process.stdin.write(np.ascontiguousarray(frame, dtype=np.uint8).tobytes())
+
+    def close(self):
+        if self.process is None:
+            return
+        self.process.stdin.close()
+        if not self.process.wait() == 0:
+            raise RuntimeError(f'ffmpeg failed to write {self.output} (exit code {self.process.returncode})')
+        self.process = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def keyframes(model, n_keyframes=None, images=None, seed=42):
+    """
+    Latent vectors of the images of a folder (in the order of their names) and/or n_keyframes random latent vectors.
+
+    outputs a K x latent_dim tensor
+    """
+    z = []
+    if not images is None:
+        z_images, names = model.encode(images)
+        z.append(z_images[np.argsort(names)])
+    if n_keyframes:
+        z.append(torch.randn(n_keyframes, model.opt.latent_dim, generator=torch.Generator().manual_seed(seed)))
+    if not z:
+        raise ValueError('No keyframes')
+    return torch.cat(z)
+
+
+def slerp_path(z, n_frames, batch_size, loop=False):
+    """
+    Latent vectors along the spherical interpolation between each keyframe of z and the next one,
+    n_frames per segment, by batches of batch_size frames.
+
+    outputs a generator of batch_size x latent_dim tensors (on the device of z)
+    """
+    if loop:
+        z = torch.cat([z, z[:1]])
+    # the last keyframe ends the path (a loop ends just before the first one)
+    total = (len(z) - 1) * n_frames + (0 if loop else 1)
+    for start in range(0, total, batch_size):
+        frame = torch.arange(start, min(start + batch_size, total), device=z.device)
+        segment = torch.clamp(frame // n_frames, max=len(z) - 2)
+        val = ((frame - segment * n_frames).float() / n_frames)[:, None]
+        yield slerp(val, z[segment], z[segment + 1])
+
+
+def render(model, z, output, n_frames=60, fps=30, loop=False, shift=None):
+    """
+    Writes the frames of the interpolation between the keyframes z to output.
+
+    Args:
+            model: Inference
+            z: K x latent_dim keyframes
+            n_frames (int): number of frames between two keyframes
+            fps (int): frames per second of the video
+            loop (bool): goes back to the first keyframe at the end
+            shift: translation of the background (see Generator.forward), the same for all frames (default: random)
+
+    outputs the number of frames
+    """
+    from .export import random_shift
+    shift = random_shift(model.opt.img_size) if shift is None else shift
+    z = torch.as_tensor(z, dtype=torch.float32).to(model.device)
+
+    def generate(batch):
+        with torch.inference_mode(), model.autocast():
+            imgs = model.generator(batch, shift=shift).float()
+        # H x W x C uint8 frames, converted on the device
+        return (imgs.clamp(0, 1) * 255).round().to(torch.uint8).permute(0, 2, 3, 1)
+
+    n_written = 0
+    with FFmpegWriter(output, fps=fps) as writer:
+        frames = None
+        for batch in slerp_path(z, n_frames, model.batch_size, loop=loop):
+            # the next batch is launched before the previous one is written: on GPU, both overlap
+            next_frames = generate(batch)
+            if not frames is None:
+                n_written += write_frames(writer, frames)
+            frames = next_frames
+        n_written += write_frames(writer, frames)
+    return n_written
+
+
+def write_frames(writer, frames):
+    frames = frames.cpu().numpy()
+    if frames.shape[-1] == 1:
+        frames = frames[..., 0]
+    for frame in frames:
+        writer.append_data(frame)
+    return len(frames)
+
+
+if __name__ == "__main__":
+    from .inference import Inference
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--run_path", type=str, required=True, help="folder of the run (with its checkpoint.pt)")
+    parser.add_argument("--output", type=str, required=True, help="video file (.mp4, .gif, ...)")
+    parser.add_argument("--images", type=str, default=None, help="folder of images encoded as the first keyframes")
+    parser.add_argument("--n_keyframes", type=int, default=None, help="number of random keyframes (default: 16 without --images)")
+    parser.add_argument("--n_frames", type=int, default=60, help="number of frames between two keyframes")
+    parser.add_argument("--fps", type=int, default=30, help="frames per second")
+    parser.add_argument("--loop", action="store_true", help="goes back to the first keyframe at the end")
+    parser.add_argument("--batch_size", type=int, default=None, help="number of frames generated at once")
+    parser.add_argument("--amp", action="store_true", help="mixed precision")
+    parser.add_argument("--seed", type=int, default=42, help="seed of the random keyframes and of the background")
+    args = parser.parse_args()
+
+    from .export import random_shift
+    t0 = time.time()
+    model = Inference(args.run_path, batch_size=args.batch_size, amp=args.amp)
+    n_keyframes = args.n_keyframes if (args.n_keyframes or args.images) else 16
+    z = keyframes(model, n_keyframes, images=args.images, seed=args.seed)
+    n_frames = render(model, z, args.output, n_frames=args.n_frames, fps=args.fps, loop=args.loop,
+                      shift=random_shift(model.opt.img_size, args.seed))
+    print(f"[{n_frames} frames ({len(z)} keyframes) written to {args.output} in {time.time() - t0:.1f}s]")
@@ -0,0 +1,226 @@
+"""
+Runs a list of experiments in parallel on the local node.
+
+Each job is a (run_path, opt) pair trained with `learn` in its own process,
+such that a crash (or the memory) of one run does not affect the others. The
+number of simultaneous jobs is limited by the CPUs (n_threads per job), by the
+GPUs (jobs_per_gpu per device, each job only sees its own device) and
+optionally by the available memory:
+
+    jobs = [(run_path, opt), ...]
+    results = run_jobs(jobs, n_threads=4)
+
+Runs which are done (or running in another process) are skipped as with
+`learn`, and incomplete runs resume from their last checkpoint. With cache,
+runs with the same configuration as a run which is done, or as an earlier job,
+are skipped as well (see `AEGEAN.experiments`).
+
+Each job runs in a new interpreter (`python3 -m AEGEAN.scheduler <job file>`,
+see `launch`) started with CUDA_VISIBLE_DEVICES set to its GPU: CUDA reads it
+only when the driver is initialized, which may already be the case in this
+process (e.g. by `torch.cuda.is_available()`). This also works from scripts
+without a `if __name__ == "__main__"` guard, which are not imported again.
+"""
+import os
+import sys
+import json
+import time
+import pickle
+import tempfile
+import subprocess
+import traceback
+import torch
+
+from .dataset import n_cpus
+from .checkpoint import read_status, is_running
+from .experiments import config_hash, ResultCache
+
+
+def list_gpus():
+    """
+    Indices of the visible GPUs, without initializing CUDA in this process.
+
+    """
+    if 'CUDA_VISIBLE_DEVICES' in os.environ:
+        return [gpu for gpu in os.environ['CUDA_VISIBLE_DEVICES'].split(',') if gpu.strip() not in ('', '-1')]
+    try:
+        output = subprocess.run(['nvidia-smi', '--query-gpu=index', '--format=csv,noheader'],
+                                capture_output=True, text=True, timeout=30).stdout
+    except (OSError, subprocess.SubprocessError):
+        return []
+    return [line.strip() for line in output.splitlines() if line.strip()]
+
+
+def available_memory():
+    """
+    Available physical memory, in bytes.
+
+    """
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_AVPHYS_PAGES')
+
+
+def get_state(run_dir, run_path):
+    """
+    'done', 'running' or 'todo' (new, failed or killed run).
+
+    """
+    path_data = os.path.join(run_dir, run_path)
+    if not os.path.isdir(path_data):
+        return 'todo'
+    status = read_status(path_data)
+    if status is None or status['status'] == 'done':
+        # runs without status marker are considered as done (see learn)
+        return 'done'
+    return 'running' if is_running(status) else 'todo'
+
+
+def launch(func, args, n_threads, gpu=None):
+    """
+    Calls func(*args) in a new interpreter, with n_threads CPU threads and only the GPU gpu visible (as device 0).
+    func must be importable (defined at the top level of a module).
+
+    outputs the subprocess.Popen of the job
+    """
+    fd, job_file = tempfile.mkstemp(prefix='AEGEAN_job_', suffix='.pkl')
+    with os.fdopen(fd, 'wb') as f:
+        pickle.dump((func, args, n_threads, gpu), f)
+    env = dict(os.environ)
+    if not gpu is None:
+        env['CUDA_VISIBLE_DEVICES'] = str(gpu)
+    # the package is found from any working directory
+    package_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env['PYTHONPATH'] = os.pathsep.join([package_dir] + [path for path in [env.get('PYTHONPATH')] if path])
+    return subprocess.Popen([sys.executable, '-m', 'AEGEAN.scheduler', job_file], env=env)
+
+
+def _job_main(job_file):
+    with open(job_file, 'rb') as f:
+        func, args, n_threads, gpu = pickle.load(f)
+    os.remove(job_file)
+    torch.set_num_threads(n_threads)
+    if not gpu is None:
+        if not torch.cuda.device_count() == 1:
+            raise RuntimeError(f'The job on GPU {gpu} sees {torch.cuda.device_count()} devices')
+        torch.cuda.set_device(0)
+    func(*args)
+
+
+def _learn(run_path, opt, run_dir):
+    from .aegean import learn
+    opt.run_path = run_path
+    learn(opt, run_dir)
+
+
+def device_report(path):
+    """
+    Writes the devices seen by the job calling it to path (a .json file), see launch.
+
+    """
+    info = dict(visible=os.environ.get('CUDA_VISIBLE_DEVICES'), n_threads=torch.get_num_threads(),
+                device_count=torch.cuda.device_count() if torch.cuda.is_available() else 0)
+    if info['device_count'] > 0:
+        info.update(current_device=torch.cuda.current_device(),
+                    name=torch.cuda.get_device_name(torch.cuda.current_device()))
+    with open(path, 'w') as f:
+        json.dump(info, f)
+
+
+def run_jobs(jobs, run_dir="./runs", n_jobs=None, n_threads=None, gpus=None, jobs_per_gpu=1,
+             memory_per_job=None, poll_interval=10., cache=True):
+    """
+    Trains the jobs in parallel processes.
+
+    Args:
+            jobs (list): (run_path, opt) pairs
+            run_dir (string): folder of the runs
+            n_jobs (int): maximal number of simultaneous jobs (default: as many as the resources allow)
+            n_threads (int): number of CPU threads of each job (default: the CPUs shared between the jobs)
+            gpus (list): GPUs to use (default: all visible GPUs, [] to train on the CPU)
+            jobs_per_gpu (int): number of simultaneous jobs on each GPU
+            memory_per_job (int): memory needed by a job, in bytes (a job starts only when it is available)
+            poll_interval (float): time between two checks of the available memory, in seconds
+            cache (bool): skip the configurations which are already trained or listed, under any run_path
+
+    outputs a dictionary {run_path: result} where result holds the state ('done', 'failed',
+    'skipped' for runs done, running elsewhere or listed twice), the exit code and the duration of the job
+    (and for cached configurations, the run_path of the same configuration)
+    """
+    gpus = list_gpus() if gpus is None else list(gpus)
+    limits = [len(jobs)]
+    if not n_jobs is None:
+        limits.append(n_jobs)
+    if gpus:
+        limits.append(len(gpus) * jobs_per_gpu)
+    if not n_threads is None:
+        limits.append(n_cpus() // n_threads)
+    elif not gpus:
+        # training on the CPU: at least 4 threads per job
+        limits.append(n_cpus() // 4)
+    n_jobs = max(1, min(limits))
+    n_threads = n_threads or max(1, n_cpus() // n_jobs)
+    # one slot per simultaneous job, the GPUs being shared evenly
+    slots = [gpus[i % len(gpus)] if gpus else None for i in range(n_jobs)]
+
+    results, pending = {}, []
+    done, listed = ResultCache(run_dir) if cache else None, {}
+    for run_path, opt in jobs:
+        state = 'duplicate' if run_path in results or run_path in dict(pending) else get_state(run_dir, run_path)
+        if state == 'todo' and cache:
+            key = config_hash(opt)
+            same_as = listed.setdefault(key, run_path)
+            if same_as == run_path:
+                same_as = done.lookup(opt)
+            if not same_as is None and same_as != run_path:
+                results[run_path] = dict(state='skipped', reason='cached', same_as=same_as, exitcode=None, time=0.)
+                continue
+        if state == 'todo':
+            pending.append((run_path, opt))
+        else:
+            results[run_path] = dict(state='skipped', reason=state, exitcode=None, time=0.)
+    print(f'Scheduler: {len(pending)} jobs to run, {len(results)} skipped, '
+          f'{n_jobs} at a time with {n_threads} threads each, GPUs: {gpus or "none"}')
+
+    running = [] # (run_path, process, slot, start time)
+    while pending or running:
+        while pending and slots:
+            if running and not memory_per_job is None and available_memory() < memory_per_job:
+                break
+            run_path, opt = pending.pop(0)
+            slot = slots.pop(0)
+            process = launch(_learn, (run_path, opt, run_dir), n_threads, slot)
+            running.append((run_path, process, slot, time.time()))
+            print(f'Scheduler: started {run_path} (PID {process.pid}, GPU {slot})')
+        t_poll, finished = time.time(), []
+        while running and time.time() - t_poll < poll_interval:
+            finished = [job for job in running if not job[1].poll() is None]
+            if finished:
+                break
+            time.sleep(.1)
+        for job in finished:
+            running.remove(job)
+            run_path, process, slot, t_start = job
+            slots.append(slot)
+            state = 'done' if process.returncode == 0 else 'failed'
+            results[run_path] = dict(state=state, exitcode=process.returncode, time=time.time() - t_start)
+            print(f'Scheduler: {run_path} {state} (exit code {process.returncode}) in {time.time() - t_start:.0f}s')
+
+    n_failed = sum(result['state'] == 'failed' for result in results.values())
+    print(f'Scheduler: {len(results) - n_failed} jobs done or skipped, {n_failed} failed')
+    return results
+
+
+if __name__ == "__main__":
+    # a job started by launch
+    try:
+        _job_main(sys.argv[1])
+    except BaseException:
+        traceback.print_exc()
+        sys.stdout.flush()
+        sys.exit(1)
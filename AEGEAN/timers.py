@@ -0,0 +1,48 @@
+"""
+Time spent in each phase of the training loop.
+
+The loop calls `switch(phase)` at the boundaries of its phases: the current
+phase ends and the next one starts. The device is synchronized at each
+boundary, such that asynchronous CUDA kernels are counted in the phase which
+launched them. When disabled, `switch` returns immediately.
+"""
+import time
+from collections import OrderedDict
+import torch
+
+
+class PhaseTimer(object):
+    def __init__(self, device, enabled=True):
+        """
+        Args:
+                device: device of the training (synchronized at each boundary on GPU)
+                enabled (bool): measure the phases
+        """
+        self.enabled = enabled
+        self.use_cuda = torch.device(device).type == 'cuda'
+        self.phase, self.t_start = None, None
+        self.totals = OrderedDict()
+
+    def switch(self, phase=None):
+        """
+        Ends the current phase (if any) and starts phase (None: no phase).
+
+        """
+        if not self.enabled:
+            return
+        if self.use_cuda:
+            torch.cuda.synchronize()
+        t = time.perf_counter()
+        if not self.phase is None:
+            self.totals[self.phase] = self.totals.get(self.phase, 0.) + t - self.t_start
+        self.phase, self.t_start = phase, t
+
+    def end_epoch(self):
+        """
+        Ends the current phase.
+
+        outputs the time spent in each phase since the last call, in seconds
+        """
+        self.switch(None)
+        totals, self.totals = self.totals, OrderedDict()
+        return dict(totals)
@@ -1,4 +1,5 @@
 import os
+import re
 from itertools import product
 import time
 import torch
@@ -15,48 +16,54 @@ from torchvision.utils import save_image
 from PIL import Image, ImageDraw
 import matplotlib
 matplotlib.use('Agg')
+from .history import History
+from .dataset import EXTENSIONS, n_cpus, store_prefix, get_store, open_store, SharedStore, LazyFolderDataset, ImageStream
 
 class FolderDataset(Dataset):
-    def __init__(self, dir_path, height, width, transform):
+    def __init__(self, dir_path, height, width, transform, cache_prefix=None,
+                 resample='bilinear', extensions=EXTENSIONS, n_jobs=None, shared=False):
         """
         Args:
                 dir_path (string): path to dir that contains exclusively png images
                 height (int): image height
                 width (int): image width
                 transform: pytorch transforms for transforms and tensor conversion during training
+                           (None: returns the uint8 images, see NormalizeCollate)
+                cache_prefix (string): path (without extension) of the store of the resized images
+                resample (string): filter used to resize the images (see dataset.RESAMPLE)
+                extensions (list): extensions of the image files
+                n_jobs (int): number of processes decoding the images when building the store (default: all CPUs)
+                shared (bool): read the store from its copy in shared memory, used by all the runs of the node
+                               (see dataset.SharedStore)
         """
-        files = []
-        for ext in ['png', 'PNG', 'jpg', 'JPG']:
-            files.extend(glob(os.path.join(dir_path, f'*.{ext}')))
-            files.extend(glob(os.path.join(dir_path, f'**/*.{ext}')))
-        #self.files = list(pathlib.Path(dir_path).rglob("*.png"))#".[png|jpg]")
-        # print(self.files, os.path.join(dir_path, '**/*'))
-        # self.labels = np.zeros(len(self.files))
         self.height = height
         self.width = width
         self.transform = transform
-
-        # Chargement des images
-        self.imgs = list()
-        self.files = list()
-        for fname in files:
-            if os.path.isfile(fname):
-                #img_as_np = np.asarray(Image.open(img).resize((self.height, self.width))).astype('uint8')
-                img_as_pil = Image.open(fname)
-                # HACK for CFD images
-                # if list(img_as_pil.getdata())[0]  == (255, 255, 255): # rgb_im.getpixel((1, 1))
-                #     ImageDraw.floodfill(img_as_pil, xy=(0, 0), value=(127, 127, 127), thresh=10)
-                #     ImageDraw.floodfill(img_as_pil, xy=(0, -1), value=(127, 127, 127), thresh=10)
-                img_as_pil = img_as_pil.resize((self.height, self.width), resample=Image.BILINEAR)
-                # TODO: use LAB color space for CFD / CMYK for simpsons
-                self.imgs.append(img_as_pil)
-                self.files.append(fname)
+        self.cache_prefix = cache_prefix or store_prefix(dir_path, height)
+
+        # Chargement des images: the store is updated if the folder changed, then memory-mapped
+        self.files = get_store(dir_path, self.cache_prefix, self.height, self.width,
+                               resample=resample, extensions=extensions, n_jobs=n_jobs)
+        self.shared, self.open_prefix = None, self.cache_prefix
+        if shared:
+            try:
+                self.shared = SharedStore(self.cache_prefix)
+                self.open_prefix = self.shared.prefix
+            except OSError as e:
+                print(f'Shared memory not available ({e}), using {self.cache_prefix}')
+        # opened on first access, such that each worker maps the store itself
+        self.imgs = None
 
     def __getitem__(self, index):
         #print("Image load : ",self.files[index])
         #single_image_label = self.labels[index]
+        if self.imgs is None:
+            self.imgs, _ = open_store(self.open_prefix)
         filename = self.files[index]
-        img_as_pil = self.imgs[index]
+        if self.transform is None:
+            # raw uint8 image, converted in the collate function (see NormalizeCollate)
+            return (self.imgs[index], filename)
+        img_as_pil = Image.fromarray(self.imgs[index])
 
         # Transform image to tensor
         img_as_tensor = self.transform(img_as_pil)
@@ -64,6 +71,12 @@ class FolderDataset(Dataset):
         # Return image and the label
         return (img_as_tensor, filename)
 
+    def __getstate__(self):
+        # the memory map is not pickled to the workers, nor the reference to the shared copy
+        state = self.__dict__.copy()
+        state['imgs'], state['shared'] = None, None
+        return state
+
     def __len__(self):
         return len(self.files)
 
@@ -140,10 +153,10 @@ class Normalize(object):
     def __call__(self, img):
         """
         :param img: PIL Image
-        :return: PIL Image
+        :return: float32 array
 
         """
-        tmp_img = np.array(img).astype(np.float)
+        tmp_img = np.array(img, dtype=np.float32)
         #print('min-mean-max', tmp_img.min(), tmp_img.mean(), tmp_img.max())
         if False:
             tmp_img -= np.mean(tmp_img)
@@ -152,11 +165,10 @@ class Normalize(object):
             tmp_img += self.mean
         else:
             tmp_img -= np.min(tmp_img)
-            tmp_img = tmp_img / tmp_img.max()
-            # tmp_img = tmp_img.astype(tmp_img.dtype)
+            tmp_img /= tmp_img.max()
             # print('0-1', tmp_img.min(), tmp_img.max())
-            # return Image.fromarray(tmp_img)
-            tmp_img = (self.max-self.min)*tmp_img + self.min
+            tmp_img *= self.max - self.min
+            tmp_img += self.min
         #print('min-mean-max', tmp_img.min(), tmp_img.mean(), tmp_img.max())
         return tmp_img
 
@@ -164,6 +176,54 @@ class Normalize(object):
         return self.__class__.__name__ + "(mean: {}, max: {})".format(self.mean, self.max)
 
 
+def normalize_batch(imgs, min=0., max=1., out=None):
+    """
+    Rescales each image of a batch between min and max, as `Normalize`, with
+    vectorized reductions in float32.
+
+    :param imgs: N x C x H x W tensor, uint8 or float
+    :param out: contiguous float32 tensor receiving the result (by default imgs itself if it is float32)
+    :return: out
+    """
+    if out is None:
+        out = imgs if imgs.dtype == torch.float32 else torch.empty(imgs.shape, dtype=torch.float32, device=imgs.device)
+    if not out is imgs:
+        out.copy_(imgs)
+    flat = out.view(out.shape[0], -1)
+    low = flat.amin(dim=1, keepdim=True)
+    flat.sub_(low)
+    flat.div_(flat.amax(dim=1, keepdim=True))
+    flat.mul_(max - min).add_(min)
+    return out
+
+
+class NormalizeCollate(object):
+    def __init__(self, min=0., max=1.):
+        """
+        Collates (H x W x C uint8 image, filename) samples into one normalized N x C x H x W float32 batch.
+
+        Each image is converted while it is written into the batch, which is then
+        normalized in place: there is no intermediate copy per image.
+
+        """
+        self.min, self.max = min, max
+
+    def __call__(self, batch):
+        imgs, filenames = zip(*batch)
+        height, width, channels = imgs[0].shape
+        out = torch.empty((len(imgs), channels, height, width), dtype=torch.float32)
+        if torch.utils.data.get_worker_info() is not None:
+            # the batch is sent to the main process through shared memory
+            out.share_memory_()
+        for i, img in enumerate(imgs):
+            # writes the uint8 image through a H x W x C view of the float32 batch
+            out[i].permute(1, 2, 0).numpy()[...] = img
+        return normalize_batch(out, self.min, self.max), list(filenames)
+
+    def __repr__(self):
+        return self.__class__.__name__ + "(min: {}, max: {})".format(self.min, self.max)
+
+
 import torch.nn as nn
 
 def weights_init_normal(m, weight_0=0.01, factor=1.0):
@@ -183,14 +243,123 @@ def weights_init_normal(m, weight_0=0.01, factor=1.0):
         nn.init.constant_(m.bias.data, 0)
 
 
+def lerp(val, low, high):
+    """
+    Linear interpolation between two batches of vectors.
+
+    """
+    return torch.lerp(low, high, val)
+
+
+# https://github.com/soumith/dcgan.torch/issues/14  dribnet commented on 21 Mar 2016
+# https://arxiv.org/abs/1609.04468
+def slerp(val, low, high, eps=1e-7):
+    """
+    Spherical interpolation between two batches of vectors (one angle per row).
+
+    Computed with torch on the device of the inputs, falling back to a LERP
+    when the angle is degenerate (L'Hopital's rule).
+
+    """
+    corr = (low / low.norm(dim=1, keepdim=True)) * (high / high.norm(dim=1, keepdim=True))
+    omega = torch.acos(torch.clamp(corr.sum(dim=1, keepdim=True), -1, 1))
+    so = torch.sin(omega)
+    degenerate = so.abs() < eps
+    so = torch.where(degenerate, torch.ones_like(so), so)
+    out = torch.sin((1.0-val)*omega) / so * low + torch.sin(val*omega) / so * high
+    return torch.where(degenerate, lerp(val, low, high), out)
+
+
+class NoisePool(object):
+    def __init__(self, device, valid_smooth=.94, seed=None, streams=('E', 'D', 'G')):
+        """
+        Buffers for the noise added to the images and for the smoothed labels of D.
+
+        The buffers are allocated once on the device and refilled in place at each
+        call, each stream drawing from its own torch random number generator.
+
+        Args:
+                device: device where the buffers live
+                valid_smooth (float): smoothing of the labels (see `--valid_smooth`)
+                seed (int): seed of the random number generators (None: not reproducible)
+                streams (tuple): names of the image noise streams
+        """
+        self.device = device
+        self.valid_smooth = valid_smooth
+        self.generators = {}
+        for i_stream, stream in enumerate(streams + ('smooth', )):
+            self.generators[stream] = torch.Generator(device=device)
+            if seed is None:
+                self.generators[stream].seed()
+            else:
+                self.generators[stream].manual_seed(seed + 1 + i_stream)
+        self.noise, self.contrast = {}, {}
+        self.valid, self.fake = None, None
+
+    def image_noise(self, stream, shape):
+        """
+        Noise in the image space, one contrast value per image and channel.
+
+        outputs an image (a buffer which is overwritten at the next call on the same stream)
+        """
+        shape = tuple(shape)
+        if not stream in self.noise or self.noise[stream].shape != shape:
+            self.noise[stream] = torch.empty(shape, device=self.device)
+            self.contrast[stream] = torch.empty(shape[:2] + (1, 1), device=self.device)
+        generator = self.generators[stream]
+        noise = self.noise[stream].normal_(generator=generator)
+        return noise.mul_(self.contrast[stream].normal_(generator=generator).abs_())
+
+    def labels(self, batch_size):
+        """
+        Smoothed labels for the real and fake images.
+
+        outputs two vectors (buffers which are overwritten at the next call)
+        """
+        if self.valid is None or self.valid.shape[0] != batch_size:
+            self.valid = torch.empty((batch_size, 1), device=self.device)
+            self.fake = torch.empty((batch_size, 1), device=self.device)
+        generator = self.generators['smooth']
+        self.valid.uniform_(self.valid_smooth, 1.0-(1-self.valid_smooth)/2, generator=generator)
+        self.fake.uniform_((1-self.valid_smooth)/2, 1-self.valid_smooth, generator=generator)
+        return self.valid, self.fake
+
+    def state_dict(self):
+        return {stream: generator.get_state() for stream, generator in self.generators.items()}
+
+    def load_state_dict(self, state_dict):
+        for stream, state in state_dict.items():
+            self.generators[stream].set_state(state)
+
+
 def load_data(path, img_size, batch_size,
               rand_hflip=False, rand_affine=0.,
-              min=0., max=1., mean=.5, std=1.):
+              min=0., max=1., mean=.5, std=1.,
+              resample='bilinear', extensions=EXTENSIONS,
+              mode='store', cache_size=1024, seed=None,
+              num_workers=None, prefetch_factor=2, persistent_workers=True, pin_memory=True,
+              step_time=None):
+    """
+    DataLoader over the images of a folder.
+
+    mode is one of:
+    - 'store': the resized images are cached in a memory-mapped store (see dataset.py),
+    - 'shm': same, from a copy of the store in /dev/shm shared by the runs of the node,
+    - 'lazy': images are decoded on access in the workers, with a LRU cache of cache_size images per worker,
+    - 'stream': same, as a shuffled stream sharded across the workers (for folders larger than RAM).
+
+    num_workers is the number of worker processes (None: 1 on GPU, 0 on CPU). With
+    -1, it is the smallest number which delivers batches faster than step_time
+    (the duration of a training step, in seconds), see tune_num_workers.
+    pin_memory only applies on GPU.
+
+    """
     print("Loading data...")
     t_total = time.time()
 
     # Sequence of transformations
     transform_tmp = []
+    collate_fn = None
     if rand_hflip:
         transform_tmp.append(transforms.RandomHorizontalFlip(p=0.5))
         # transform_tmp.append(ShiftTransform(x=0.05, y=0.05))
@@ -204,27 +373,79 @@ def load_data(path, img_size, batch_size,
     # transform_tmp.append(transforms.Normalize([mean]*3, [std]*3))
 
     transform = transforms.Compose(transform_tmp)
-
-    file_path = f"/tmp/AEGEAN_dataset_{path.replace('/', '_')}_{img_size}.pt"
-    print(file_path)
-    try :
-        dataset = torch.load(file_path)
-        print("Loading dataset")
-    except :
-
-        dataset = FolderDataset(path, img_size, img_size, transform)
-        torch.save(dataset, file_path)
+    if not rand_hflip and not rand_affine > 0.:
+        # without per-image augmentation, whole batches are normalized at once in float32
+        transform, collate_fn = None, NormalizeCollate(min, max)
+
+    if mode in ['store', 'shm']:
+        cache_prefix = store_prefix(path, img_size)
+        print(cache_prefix)
+        dataset = FolderDataset(path, img_size, img_size, transform, cache_prefix=cache_prefix,
+                                resample=resample, extensions=extensions, shared=mode == 'shm')
+    elif mode == 'lazy':
+        dataset = LazyFolderDataset(path, img_size, img_size, transform=transform, cache_size=cache_size,
+                                    resample=resample, extensions=extensions)
+    elif mode == 'stream':
+        dataset = ImageStream(path, img_size, img_size, transform=transform, cache_size=cache_size, seed=seed,
+                              resample=resample, extensions=extensions)
+    else:
+        raise ValueError(f'Unknown data mode {mode}')
 
     use_cuda = True if torch.cuda.is_available() else False
-    kwargs = {'num_workers': 1, 'pin_memory': True} if use_cuda else {}
-    dataloader = torch.utils.data.DataLoader(
-        dataset, batch_size=batch_size, shuffle=True, drop_last=True, **kwargs)
+    kwargs = dict(batch_size=batch_size, shuffle=not mode == 'stream', drop_last=True, collate_fn=collate_fn,
+                  pin_memory=pin_memory and use_cuda)
+    if num_workers is None:
+        num_workers = 1 if use_cuda else 0
+    elif num_workers == -1:
+        num_workers = tune_num_workers(dataset, step_time, prefetch_factor=prefetch_factor, **kwargs)
+    if num_workers > 0:
+        kwargs.update(prefetch_factor=prefetch_factor, persistent_workers=persistent_workers)
+    if mode == 'stream':
+        # each worker drops its partial last batch (drop_last)
+        dataset.set_loader(num_workers, batch_size)
+    dataloader = torch.utils.data.DataLoader(dataset, num_workers=num_workers, **kwargs)
 
     print("[Loading Time: ", time.strftime("%Mm:%Ss", time.gmtime(time.time() - t_total)),
           "] [Numbers of samples :", len(dataset), " ]\n")
 
     return dataloader
 
+def tune_num_workers(dataset, step_time, prefetch_factor=2, max_workers=None, **kwargs):
+    """
+    Measures the time to deliver a batch for an increasing number of workers
+    (0, 1, 2, 4, ...) and returns the smallest one which delivers batches faster
+    than step_time, such that the training loop does not wait for the data
+    (without step_time, the fastest one).
+
+    kwargs are passed to the DataLoader.
+    """
+    step_time = 0. if step_time is None else step_time
+    max_workers = max_workers or n_cpus()
+    candidates = [0] + [2**i for i in range(int(np.log2(max_workers)) + 1)]
+    best, best_time = 0, np.inf
+    for num_workers in candidates:
+        opts = dict(prefetch_factor=prefetch_factor) if num_workers > 0 else {}
+        if hasattr(dataset, 'set_loader'):
+            dataset.set_loader(num_workers, kwargs.get('batch_size'))
+        loader = torch.utils.data.DataLoader(dataset, num_workers=num_workers, **opts, **kwargs)
+        # enough batches to drain the prefetched ones
+        n_batches = min(len(loader) - 1, max(8, 2 * num_workers * prefetch_factor))
+        if n_batches < 1:
+            return num_workers
+        iterator = iter(loader)
+        next(iterator) # start-up of the workers
+        t0 = time.time()
+        for _ in range(n_batches):
+            next(iterator)
+        batch_time = (time.time() - t0) / n_batches
+        del iterator
+        print(f"[num_workers={num_workers}: {batch_time:.4f}s/batch, step time {step_time:.4f}s]")
+        if batch_time < best_time:
+            best, best_time = num_workers, batch_time
+        if batch_time < step_time:
+            return num_workers
+    return best
+
 def sampling(noise, generator, path, epoch, tag='', nrow=16):
     """
     Use generator model and noise vector to generate images.
@@ -233,7 +454,7 @@ def sampling(noise, generator, path, epoch, tag='', nrow=16):
     """
     generator.eval()
     gen_imgs = generator(noise)
-    save_image(gen_imgs.data[:], f"{path}/{tag}_{epoch:04d}.png", normalize=True, nrow=nrow, range=(0, 1))
+    save_image(gen_imgs.data[:], f"{path}/{tag}_{epoch:04d}.png", normalize=True, nrow=nrow, value_range=(0, 1))
     generator.train()
 
 def print_network(net):
@@ -248,62 +469,23 @@ def print_network(net):
 
 def init_hist(nb_epochs, nb_batch):
     """
-    Initialise et retourne un dictionnaire qui servira à sauvegarder les données que l'on voudrais afficher par la suite.
+    Initialise et retourne l'historique (voir History) qui servira à sauvegarder les données que l'on voudrais afficher par la suite.
     """
 
-    hist = {}
-
-    # Container for ploting (en minuscule pour les batchs et en majuscule pour les epochs)
-    # Losses G et D
-    hist["G_losses"] = np.zeros(nb_epochs)
-    hist["D_losses"] = np.zeros(nb_epochs)
-    hist["g_losses"] = np.zeros(nb_batch)
-    hist["d_losses"] = np.zeros(nb_batch)
-    hist["E_losses"] = np.zeros(nb_epochs)
-    hist["e_losses"] = np.zeros(nb_batch)
+    return History(nb_epochs, nb_batch)
 
-    # Moyenne des réponse D(x) et D(G(z)) moyenner par epochs
-    hist["D_x_mean"] = np.zeros(nb_epochs)
-    hist["D_G_z_mean"] = np.zeros(nb_epochs)
-    hist["d_x_mean"] = np.zeros(nb_batch)
-    # hist["d_fake_mean"] = np.zeros(nb_batch)
-    hist["d_g_z_mean"] = np.zeros(nb_batch)
 
-    return hist
-
-
-def save_hist_batch(hist, idx_batch, idx_epoch, g_loss, d_loss, e_loss, d_x, d_g_z): #, d_fake
-    """
-    Sauvegarde les données du batch dans l'historique après traitement
+def generate_animation(path, fps=1):
     """
+    Writes the images path/<number>*.png, sorted by number, to path/training.gif, one by one (see render.FFmpegWriter).
 
-    d_x = d_x.detach().cpu().numpy()
-    # d_fake = d_fake.detach().cpu().numpy()
-    d_g_z = d_g_z.detach().cpu().numpy()
-    g_loss = g_loss.item()
-    d_loss = d_loss.item()
-    e_loss = e_loss.item()
-
-    hist["g_losses"][idx_batch] = g_loss
-    hist["d_losses"][idx_batch] = d_loss
-    hist["e_losses"][idx_batch] = e_loss
-
-
-    hist["d_x_mean"][idx_batch] = d_x.mean()
-    # hist["d_fake_mean"][idx_batch] = d_fake.mean()
-    hist["d_g_z_mean"][idx_batch] = d_g_z.mean()
-
-
-def generate_animation(path, fps=1):
-    import imageio
+    """
+    from .render import FFmpegWriter
     images_path = glob(path + '[0-9]*.png')
-    images_path = sorted(images_path, key=comp)
-    images = []
-    for i in images_path:
-        # print(i)
-        images.append(imageio.imread(i))
-
-    imageio.mimsave(path + 'training.gif', images, fps=fps)
+    images_path = sorted(images_path, key=lambda fname: int(re.match(r'\d+', os.path.basename(fname)).group()))
+    with FFmpegWriter(path + 'training.gif', fps=fps) as writer:
+        for fname in images_path:
+            writer.append_data(np.asarray(Image.open(fname).convert('RGB')))
 
 if __name__ == "__main__":
 
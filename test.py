@@ -2,6 +2,8 @@ import sys
 sys.settrace
 
 import AEGEAN as AG
+from AEGEAN.experiments import variant, axis, scale, toggle, resolve
+from AEGEAN.scheduler import run_jobs
 import numpy as np
 # import os
 # PID, HOST = os.getpid(), os.uname()[1]
@@ -27,470 +29,95 @@ experiments['Simpsons_256'] = [('datapath', '../database/Simpsons-Face_clear/cp/
 # experiments['Holidays'] = [('datapath', '../../../../quantic/Photos/2019'), ('img_size', 128)]
 
 do_test = True
+base = 2
+base_lambda = 8
 
-for expname in experiments.keys():
-    def init():
-        opt = AG.init()
-        for variable, value in experiments[expname]:
-            vars(opt)[variable] = value
-        tag = f'{expname}_'
-        return tag, opt
+# runs without a discriminator (lrD=0) or without a supervision of G by D (lrG=0) skip the corresponding variants
+with_D = lambda opt: opt.lrD > 0
+with_G = lambda opt: opt.lrG > 0
 
-    # VANILLA
-    tag, opt = init()
-    opt.run_path = tag + 'vanilla'
-    AG.learn(opt)
+GAN_losses = ['original', 'ian',  'hinge', 'wasserstein', 'alternative', 'alternativ2', 'alternativ3']
+GAN_losses = ['original',  'hinge', 'alternativ3']
 
+variants = [
+    variant('vanilla'),
     # Does it help a GAN to be coupled with an AE ?
-    tag, opt = init()
-    opt.do_joint = not opt.do_joint
-    if opt.do_joint:
-        opt.run_path = tag + 'do_joint'
-    else:
-        opt.do_insight = False
-        opt.run_path = tag + 'no_joint'
-    AG.learn(opt)
-
-    # What if the discriminator has only acces to the image reconstructed by the AE ?
-    tag, opt = init()
-    opt.do_insight = not opt.do_insight
-    if opt.do_insight:
-        opt.run_path = tag + 'do_insight'
-    else:
-        opt.run_path = tag + 'no_insight'
-    AG.learn(opt)
-
+    toggle('do_joint', do_insight=lambda opt: opt.do_insight and not opt.do_joint),
     # What if the discriminator has only acces to the image reconstructed by the AE ?
-    tag, opt = init()
-    opt.do_transpose = not opt.do_transpose
-    if opt.do_transpose:
-        opt.run_path = tag + 'do_transpose'
-    else:
-        opt.run_path = tag + 'no_transpose'
-    AG.learn(opt)
-
-    if True:
-
-        # GAN_losses = ['original', 'wasserstein', 'ian', 'alternative', 'alternativ2']
-        GAN_losses = ['original', 'ian',  'hinge', 'wasserstein', 'alternative', 'alternativ2', 'alternativ3']
-        GAN_losses = ['original',  'hinge', 'alternativ3']
-        # GAN_losses = ['original', 'ian', 'alternativ3']
-
-        for GAN_loss in GAN_losses:
-            tag, opt = init()
-            if opt.lrD > 0:
-                opt.run_path = tag + 'GAN_loss_' + GAN_loss
-                opt.GAN_loss = GAN_loss
-                opt.run_path += '_no_bn'
-                opt.bn_eps = np.inf
-                AG.learn(opt)
-
-        #GAN_losses.remove(opt.GAN_loss)
-        for GAN_loss in GAN_losses:
-            tag, opt = init()
-            if opt.lrD > 0:
-                opt.run_path = tag + 'GAN_loss_' + GAN_loss
-                opt.GAN_loss = GAN_loss
-                AG.learn(opt)
-
-    for padding_mode in ['reflect', 'border', 'zeros']: # https://pytorch.org/docs/1.4.0/nn.functional.html#grid-sample
-        tag, opt = init()
-        opt.run_path = tag + 'padding_mode_' + padding_mode
-        opt.padding_mode = padding_mode
-        AG.learn(opt)
-
-    for optimizer in ['sgd', 'adam', 'rmsprop']: # https://pytorch.org/docs/1.4.0/nn.functional.html#grid-sample
-        tag, opt = init()
-        opt.run_path = tag + 'optimizer_' + optimizer
-        opt.optimizer = optimizer
-        AG.learn(opt)
-
-    base = 2
-
-    tag, opt = init()
-    opt.run_path = tag + 'low_batch_size'
-    opt.batch_size //= base
-    AG.learn(opt)
-
-    tag, opt = init()
-    opt.run_path = tag + 'high_batch_size'
-    opt.batch_size *= base
-    AG.learn(opt)
-
-
-    tag, opt = init()
-    opt.run_path = tag + 'small_lrE'
-    opt.lrE /= base
-    AG.learn(opt)
-
-    tag, opt = init()
-    opt.run_path = tag + 'big_lrE'
-    opt.lrE *= base
-    AG.learn(opt)
-
-    tag, opt = init()
-    if opt.lrD > 0:
-        opt.run_path = tag + 'small_lrD'
-        opt.lrD /= base
-        AG.learn(opt)
-
-    tag, opt = init()
-    if opt.lrD > 0:
-        opt.run_path = tag + 'big_lrD'
-        opt.lrD *= base
-        AG.learn(opt)
-
-    tag, opt = init()
-    if opt.lrG > 0:
-        opt.run_path = tag + 'small_lrG'
-        opt.lrG /= base
-        AG.learn(opt)
-
-    tag, opt = init()
-    if opt.lrG > 0:
-        opt.run_path = tag + 'big_lrG'
-        opt.lrG *= base
-        AG.learn(opt)
-
-    if True:
-        tag, opt = init()
-        opt.gamma = .618 if opt.gamma==1. else 1.
-        # opt.gamma = 1.
-        opt.run_path = tag + f'gamma_{str(opt.gamma)}'
-        AG.learn(opt)
-
-        tag, opt = init()
-        opt.gamma = 1.4 if opt.gamma==1. else 1.
-        # opt.gamma = 1.
-        opt.run_path = tag + f'gamma_{str(opt.gamma)}'
-        AG.learn(opt)
-
-    if True:
-        tag, opt = init()
-        opt.run_path = tag + 'small_window_size'
-        opt.window_size //= base
-        AG.learn(opt)
-
-        tag, opt = init()
-        opt.run_path = tag + 'big_window_size'
-        opt.window_size *= base
-        AG.learn(opt)
-
-        tag, opt = init()
-        opt.run_path = tag + 'no_channel0_bg'
-        opt.channel0_bg = 0
-        AG.learn(opt)
-
-        tag, opt = init()
-        opt.run_path = tag + 'small_channel0_bg'
-        opt.channel0_bg = 2
-        AG.learn(opt)
-
-        tag, opt = init()
-        opt.run_path = tag + 'big_channel0_bg'
-        opt.channel0_bg = opt.channel0 // 4
-        AG.learn(opt)
-
-        tag, opt = init()
-        opt.resblocks, opt.run_path = opt.resblocks//base, tag + 'small_resblocks'
-        AG.learn(opt)
-
-        tag, opt = init()
-        opt.resblocks, opt.run_path = opt.resblocks*base, tag + 'large_resblocks'
-        AG.learn(opt)
-
-
-        tag, opt = init()
-        opt.run_path = tag + 'small_channel0'
-        opt.channel0 //= base
-        AG.learn(opt)
-
-        tag, opt = init()
-        opt.run_path = tag + 'big_channel0'
-        opt.channel0 *= base
-        AG.learn(opt)
-
-        tag, opt = init()
-        opt.run_path = tag + 'small_channel1'
-        opt.channel1 //= base
-        AG.learn(opt)
-
-        tag, opt = init()
-        opt.run_path = tag + 'big_channel1'
-        opt.channel1 *= base
-        AG.learn(opt)
-
-        tag, opt = init()
-        opt.run_path = tag + 'small_channel2'
-        opt.channel2 //= base
-        AG.learn(opt)
-
-        tag, opt = init()
-        opt.run_path = tag + 'big_channel2'
-        opt.channel2 *= base
-        AG.learn(opt)
-
-        tag, opt = init()
-        opt.run_path = tag + 'small_channel3'
-        opt.channel3 //= base
-        AG.learn(opt)
-
-        tag, opt = init()
-        opt.run_path = tag + 'big_channel3'
-        opt.channel3 *= base
-        AG.learn(opt)
-
-        tag, opt = init()
-        opt.run_path = tag + 'small_channel4'
-        opt.channel4 //= base
-        AG.learn(opt)
-
-        tag, opt = init()
-        opt.run_path = tag + 'big_channel4'
-        opt.channel4 *= base
-        AG.learn(opt)
-
-
-    if opt.E_noise > 0. :
-        tag, opt = init()
-        opt.run_path = tag + 'no_E_noise'
-        opt.E_noise = 0.
-        AG.learn(opt)
-
-        tag, opt = init()
-        opt.run_path = tag + 'low_E_noise'
-        opt.E_noise /= base
-        AG.learn(opt)
-
-        tag, opt = init()
-        opt.run_path = tag + 'high_E_noise'
-        opt.E_noise *= base
-        AG.learn(opt)
-
-    else:
-        tag, opt = init()
-        opt.run_path = tag + 'low_E_noise'
-        opt.E_noise = 0.001
-        AG.learn(opt)
-
-        tag, opt = init()
-        opt.run_path = tag + 'high_E_noise'
-        opt.E_noise = 0.1
-        AG.learn(opt)
-
-    if opt.D_noise > 0. :
-        tag, opt = init()
-        opt.run_path = tag + 'no_D_noise'
-        opt.D_noise = 0.
-        AG.learn(opt)
-
-        tag, opt = init()
-        opt.run_path = tag + 'low_D_noise'
-        opt.D_noise /= base
-        AG.learn(opt)
-
-        tag, opt = init()
-        opt.run_path = tag + 'high_D_noise'
-        opt.D_noise *= base
-        AG.learn(opt)
-
-    else:
-        tag, opt = init()
-        opt.run_path = tag + 'low_D_noise'
-        opt.D_noise = 0.001
-        AG.learn(opt)
-
-        tag, opt = init()
-        opt.run_path = tag + 'high_D_noise'
-        opt.D_noise = 0.1
-        AG.learn(opt)
-
-    if opt.G_noise > 0. :
-
-        tag, opt = init()
-        opt.run_path = tag + 'no_G_noise'
-        opt.G_noise = 0.
-        AG.learn(opt)
-
-        tag, opt = init()
-        opt.run_path = tag + 'low_G_noise'
-        opt.G_noise /= base
-        AG.learn(opt)
-
-        tag, opt = init()
-        opt.run_path = tag + 'high_G_noise'
-        opt.G_noise *= base
-        AG.learn(opt)
-
-    else:
-        tag, opt = init()
-        opt.run_path = tag + 'low_G_noise'
-        opt.G_noise = 0.001
-        AG.learn(opt)
-
-        tag, opt = init()
-        opt.run_path = tag + 'high_G_noise'
-        opt.G_noise = 0.1
-        AG.learn(opt)
-
-    tag, opt = init()
-    opt.do_SSIM = not opt.do_SSIM
-    if opt.do_SSIM:
-        opt.run_path = tag + 'do_SSIM'
-    else:
-        opt.run_path = tag + 'no_SSIM'
-    AG.learn(opt)
-
-
-    if do_test:
-
-        tag, opt = init()
-        opt.init_weight = not opt.init_weight
-        if opt.init_weight:
-            opt.run_path = tag + 'do_init_weight'
-        else:
-            opt.run_path = tag + 'no_init_weight'
-        AG.learn(opt)
-
-        tag, opt = init()
-        opt.do_bias = not opt.do_bias
-        if opt.do_bias:
-            opt.run_path = tag + 'do_bias'
-        else:
-            opt.run_path = tag + 'no_bias'
-        AG.learn(opt)
-
-
-        tag, opt = init()
-        opt.run_path = tag + 'no_dropout'
-        opt.dropout = 0.
-        AG.learn(opt)
-
-        tag, opt = init()
-        opt.run_path = tag + 'low_dropout'
-        opt.dropout = 0.001
-        AG.learn(opt)
-
-        tag, opt = init()
-        opt.run_path = tag + 'high_dropout'
-        opt.dropout = 0.01
-        AG.learn(opt)
-
-        tag, opt = init()
-        opt.run_path = tag + 'zero_beta1'
-        opt.beta1 = 0.0
-        AG.learn(opt)
-
-        tag, opt = init()
-        opt.run_path = tag + 'low_beta1'
-        opt.beta1 = 0.9
-        AG.learn(opt)
-
-        tag, opt = init()
-        opt.run_path = tag + 'high_beta1'
-        opt.beta1 = 0.995
-        AG.learn(opt)
-
-        tag, opt = init()
-        opt.run_path = tag + 'low_beta2'
-        opt.beta2 = 0.9
-        AG.learn(opt)
-
-        tag, opt = init()
-        opt.run_path = tag + 'high_beta2'
-        opt.beta2 = 0.99999
-        AG.learn(opt)
-
-        tag, opt = init()
-        if opt.rand_affine == 0.:
-            opt.run_path = tag + 'do_affine'
-            opt.rand_affine = 2.
-        else:
-            opt.run_path = tag + 'no_affine'
-            opt.rand_affine = 0.
-        AG.learn(opt)
-
-        tag, opt = init()
-        opt.lrelu = 0.1 if opt.lrelu==0. else 0.
-        opt.run_path = tag + 'relu' if opt.lrelu==0. else tag + 'lrelu'
-        AG.learn(opt)
-
-
-        tag, opt = init()
-        if opt.lrD > 0:
-            opt.run_path = tag + 'high_valid_smooth'
-            opt.valid_smooth = 0.99
-            AG.learn(opt)
-        tag, opt = init()
-        if opt.lrD > 0:
-            opt.run_path = tag + 'low_valid_smooth'
-            opt.valid_smooth = 0.9
-            AG.learn(opt)
-        tag, opt = init()
-        if opt.lrD > 0:
-            opt.run_path = tag + 'no_valid_smooth'
-            opt.valid_smooth = 1.
-            AG.learn(opt)
-
-    #
-    # tag, opt = init()
-    # if opt.bn_eps == np.inf:
-    #     opt.run_path = tag + 'do_bn'
-    #     opt.bn_eps = .3
-    # else:
-    #     opt.run_path = tag + 'no_bn'
-    #     opt.bn_eps = np.inf
-    # AG.learn(opt)
-    base = 8
-
+    toggle('do_insight'),
+    toggle('do_transpose'),
+    *[variant(f'GAN_loss_{GAN_loss}_no_bn', when=with_D, GAN_loss=GAN_loss, bn_eps=np.inf) for GAN_loss in GAN_losses],
+    *axis('GAN_loss', GAN_losses, when=with_D),
+    *axis('padding_mode', ['reflect', 'border', 'zeros']), # https://pytorch.org/docs/1.4.0/nn.functional.html#grid-sample
+    *axis('optimizer', ['sgd', 'adam', 'rmsprop']),
+    variant('low_batch_size', batch_size=scale('batch_size', 1/base)),
+    variant('high_batch_size', batch_size=scale('batch_size', base)),
+    variant('small_lrE', lrE=scale('lrE', 1/base)),
+    variant('big_lrE', lrE=scale('lrE', base)),
+    variant('small_lrD', when=with_D, lrD=scale('lrD', 1/base)),
+    variant('big_lrD', when=with_D, lrD=scale('lrD', base)),
+    variant('small_lrG', when=with_G, lrG=scale('lrG', 1/base)),
+    variant('big_lrG', when=with_G, lrG=scale('lrG', base)),
+    variant(lambda opt: f'gamma_{str(opt.gamma)}', gamma=lambda opt: .618 if opt.gamma==1. else 1.),
+    variant(lambda opt: f'gamma_{str(opt.gamma)}', gamma=lambda opt: 1.4 if opt.gamma==1. else 1.),
+    variant('small_window_size', window_size=scale('window_size', 1/base)),
+    variant('big_window_size', window_size=scale('window_size', base)),
+    variant('no_channel0_bg', channel0_bg=0),
+    variant('small_channel0_bg', channel0_bg=2),
+    variant('big_channel0_bg', channel0_bg=lambda opt: opt.channel0 // 4),
+    variant('small_resblocks', resblocks=scale('resblocks', 1/base)),
+    variant('large_resblocks', resblocks=scale('resblocks', base)),
+    *[variant(f'{size}_channel{i}', **{f'channel{i}': scale(f'channel{i}', factor)})
+      for i in range(5) for size, factor in [('small', 1/base), ('big', base)]],
+]
+for noise in ['E_noise', 'D_noise', 'G_noise']:
+    with_noise = lambda opt, noise=noise: getattr(opt, noise) > 0.
+    without_noise = lambda opt, noise=noise: not getattr(opt, noise) > 0.
+    variants += [
+        variant(f'no_{noise}', when=with_noise, **{noise: 0.}),
+        variant(f'low_{noise}', when=with_noise, **{noise: scale(noise, 1/base)}),
+        variant(f'high_{noise}', when=with_noise, **{noise: scale(noise, base)}),
+        variant(f'low_{noise}', when=without_noise, **{noise: 0.001}),
+        variant(f'high_{noise}', when=without_noise, **{noise: 0.1}),
+    ]
+variants += [
+    toggle('do_SSIM'),
     # what's the effect of a smaller latent_dim ?
-    tag, opt = init()
-    opt.latent_dim, opt.run_path = opt.latent_dim//base, tag + 'small_latent_dim'
-    AG.learn(opt)
-
-    # what's the effect of a smaller latent_dim ?
-    tag, opt = init()
-    opt.latent_dim, opt.run_path = opt.latent_dim*base, tag + 'large_latent_dim'
-    AG.learn(opt)
-
-    tag, opt = init()
-    opt.run_path = tag + 'small_lambdaE'
-    opt.lambdaE /= base
-    AG.learn(opt)
-
-    tag, opt = init()
-    opt.run_path = tag + 'big_lambdaE'
-    opt.lambdaE *= base
-    AG.learn(opt)
-
-    tag, opt = init()
-    opt.run_path = tag + 'small_lambdaG'
-    opt.lambdaG /= base
-    AG.learn(opt)
-
-    tag, opt = init()
-    opt.run_path = tag + 'big_lambdaG'
-    opt.lambdaG *= base
-    AG.learn(opt)
-
-    if do_test:
-
-        tag, opt = init()
-        opt.run_path = tag + 'small_bn_eps'
-        opt.bn_eps /= base
-        AG.learn(opt)
-
-        tag, opt = init()
-        opt.run_path = tag + 'big_bn_eps'
-        opt.bn_eps *= base
-        AG.learn(opt)
-
-        tag, opt = init()
-        opt.run_path = tag + 'small_bn_momentum'
-        opt.bn_momentum = .1
-        AG.learn(opt)
+    variant('small_latent_dim', latent_dim=scale('latent_dim', 1/base_lambda)),
+    variant('large_latent_dim', latent_dim=scale('latent_dim', base_lambda)),
+    variant('small_lambdaE', lambdaE=scale('lambdaE', 1/base_lambda)),
+    variant('big_lambdaE', lambdaE=scale('lambdaE', base_lambda)),
+    variant('small_lambdaG', lambdaG=scale('lambdaG', 1/base_lambda)),
+    variant('big_lambdaG', lambdaG=scale('lambdaG', base_lambda)),
+]
+if do_test:
+    variants += [
+        toggle('init_weight'),
+        toggle('do_bias'),
+        variant('no_dropout', dropout=0.),
+        variant('low_dropout', dropout=0.001),
+        variant('high_dropout', dropout=0.01),
+        variant('zero_beta1', beta1=0.0),
+        variant('low_beta1', beta1=0.9),
+        variant('high_beta1', beta1=0.995),
+        variant('low_beta2', beta2=0.9),
+        variant('high_beta2', beta2=0.99999),
+        variant(lambda opt: 'do_affine' if opt.rand_affine > 0. else 'no_affine',
+                rand_affine=lambda opt: 2. if opt.rand_affine == 0. else 0.),
+        variant(lambda opt: 'relu' if opt.lrelu==0. else 'lrelu', lrelu=lambda opt: 0.1 if opt.lrelu==0. else 0.),
+        variant('high_valid_smooth', when=with_D, valid_smooth=0.99),
+        variant('low_valid_smooth', when=with_D, valid_smooth=0.9),
+        variant('no_valid_smooth', when=with_D, valid_smooth=1.),
+        variant('small_bn_eps', bn_eps=scale('bn_eps', 1/base_lambda)),
+        variant('big_bn_eps', bn_eps=scale('bn_eps', base_lambda)),
+        variant('small_bn_momentum', bn_momentum=.1),
+        variant('big_bn_momentum', bn_momentum=.9),
+    ]
+
+# the runs are collected and then trained in parallel (see AEGEAN.scheduler), a
+# configuration which is already trained (under any name) is not trained again
+jobs = []
+for expname in experiments.keys():
+    jobs += resolve(dict(experiments[expname]), variants, tag=f'{expname}_')
 
-        tag, opt = init()
-        opt.run_path = tag + 'big_bn_momentum'
-        opt.bn_momentum = .9
-        AG.learn(opt)
+results = run_jobs(jobs)
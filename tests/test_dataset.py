@@ -0,0 +1,32 @@
+"""
+Length of the stream of images of AEGEAN.dataset.
+
+    $ python3 -m pytest tests
+"""
+import numpy as np
+import pytest
+import torch
+from PIL import Image
+
+from AEGEAN.dataset import ImageStream
+from AEGEAN.utils import NormalizeCollate
+
+
+@pytest.fixture
+def folder(tmp_path):
+    rng = np.random.default_rng(42)
+    for i in range(23):
+        Image.fromarray(rng.integers(0, 256, (8, 8, 3), dtype=np.uint8)).save(tmp_path / f'{i:03d}.png')
+    return str(tmp_path)
+
+
+@pytest.mark.parametrize('num_workers', [0, 1, 3])
+def test_stream_length(folder, num_workers):
+    batch_size = 4
+    dataset = ImageStream(folder, 8, 8, seed=42)
+    dataset.set_loader(num_workers, batch_size)
+    loader = torch.utils.data.DataLoader(dataset, batch_size=batch_size, drop_last=True, num_workers=num_workers,
+                                         collate_fn=NormalizeCollate(0., 1.))
+    batches = [imgs for imgs, _ in loader]
+    assert len(batches) == len(loader)
+    assert all(len(imgs) == batch_size for imgs in batches)
@@ -0,0 +1,39 @@
+"""
+Scores of AEGEAN.evaluate on small sets of features.
+
+    $ python3 -m pytest tests
+"""
+import numpy as np
+import pytest
+import torch
+
+from AEGEAN.evaluate import FeatureStats, frechet_distance, knn_radii, precision_recall
+
+
+def test_feature_stats():
+    features = torch.randn(100, 8, dtype=torch.float64)
+    stats = FeatureStats(n_keep=10)
+    for batch in features.split(7):
+        stats.add(batch)
+    stats = stats.result()
+    assert stats['n'] == 100 and stats['features'].shape == (10, 8)
+    assert np.allclose(stats['mean'], features.mean(0).numpy())
+    assert np.allclose(stats['cov'], np.cov(features.numpy(), rowvar=False))
+
+
+def test_frechet_distance_identical():
+    features = np.random.default_rng(0).normal(size=(200, 4))
+    mean, cov = features.mean(0), np.cov(features, rowvar=False)
+    assert abs(frechet_distance(mean, cov, mean, cov)) < 1e-6
+
+
+def test_precision_recall_tiny():
+    k = 3
+    real = torch.randn(k + 1, 4)
+    assert knn_radii(real, k).shape == (k + 1,)
+    precision, recall = precision_recall(real, real.clone(), k=k)
+    assert precision == 1. and recall == 1.
+    with pytest.raises(ValueError):
+        knn_radii(real[:k], k)
+    with pytest.raises(ValueError):
+        precision_recall(real, real[:2], k=k)
@@ -0,0 +1,31 @@
+"""
+TorchScript export of the Generator and of the Encoder (see AEGEAN.export).
+
+    $ python3 -m pytest tests
+"""
+import torch
+
+from AEGEAN.init import init
+from AEGEAN.models import Encoder, Generator
+from AEGEAN.export import export, random_shift
+
+
+def small_models():
+    opt = init(['--img_size', '32', '--channel3', '16', '--channel4', '32', '--resblocks', '1'])
+    torch.manual_seed(42)
+    encoder, generator = Encoder(opt), Generator(opt)
+    return opt, encoder.eval(), generator.eval()
+
+
+def test_export_parity(tmp_path):
+    opt, encoder, generator = small_models()
+    export(encoder, generator, opt, str(tmp_path))
+    scripted_encoder = torch.jit.load(str(tmp_path / 'encoder.pt'))
+    scripted_generator = torch.jit.load(str(tmp_path / 'generator.pt'))
+
+    z = torch.randn(4, opt.latent_dim)
+    imgs = torch.rand(4, opt.channels, opt.img_size, opt.img_size)
+    shift = random_shift(opt.img_size, 0)
+    with torch.no_grad():
+        assert torch.allclose(encoder(imgs), scripted_encoder(imgs), atol=1e-5)
+        assert torch.allclose(generator(z, shift=shift), scripted_generator(z, shift), atol=1e-5)
@@ -0,0 +1,58 @@
+"""
+Videos of AEGEAN.render: number of frames, and memory independent of the length.
+
+    $ python3 -m pytest tests
+"""
+import os
+import resource
+
+import pytest
+import torch
+from PIL import Image
+
+from AEGEAN.init import init
+from AEGEAN.models import Encoder, Generator
+from AEGEAN.checkpoint import save_checkpoint
+from AEGEAN.inference import Inference
+from AEGEAN.render import render, keyframes, ffmpeg_exe
+
+try:
+    ffmpeg_exe()
+    has_ffmpeg = True
+except RuntimeError:
+    has_ffmpeg = False
+pytestmark = pytest.mark.skipif(not has_ffmpeg, reason='no ffmpeg')
+
+
+@pytest.fixture
+def model(tmp_path):
+    opt = init(['--img_size', '64', '--channel3', '16', '--channel4', '32', '--resblocks', '1'])
+    torch.manual_seed(42)
+    path_data = str(tmp_path / 'run')
+    os.makedirs(path_data)
+    save_checkpoint(path_data, dict(epoch=1, opt=vars(opt), encoder=Encoder(opt).state_dict(),
+                                    generator=Generator(opt).state_dict()))
+    return Inference(path_data, device='cpu', batch_size=64)
+
+
+def max_rss():
+    # peak resident memory of this process, in bytes
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def test_frame_count(model, tmp_path):
+    output = str(tmp_path / 'morph.gif')
+    z = keyframes(model, 3)
+    assert render(model, z, output, n_frames=5) == 2 * 5 + 1
+    assert Image.open(output).n_frames == 2 * 5 + 1
+    assert render(model, z, output, n_frames=5, loop=True) == 3 * 5
+
+
+@pytest.mark.parametrize('ext', ['gif', 'mp4'])
+def test_bounded_memory(model, tmp_path, ext):
+    z = keyframes(model, 4)
+    render(model, z, str(tmp_path / f'short.{ext}'), n_frames=10)
+    rss = max_rss()
+    # 3000 frames of 64 x 64 x 3 bytes: about 37 MB if they were kept in memory
+    assert render(model, z, str(tmp_path / f'long.{ext}'), n_frames=1000) == 3001
+    assert max_rss() - rss < 16 * 2**20
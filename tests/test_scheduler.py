@@ -0,0 +1,39 @@
+"""
+Jobs of AEGEAN.scheduler: each one runs in a new interpreter and only sees its GPU.
+
+    $ python3 -m pytest tests
+"""
+import json
+import os
+
+import pytest
+
+from AEGEAN.scheduler import launch, device_report, list_gpus
+
+
+def run(tmp_path, gpu=None, n_threads=2):
+    path = str(tmp_path / f'device_{gpu}.json')
+    process = launch(device_report, (path,), n_threads, gpu)
+    assert process.wait(timeout=300) == 0
+    with open(path) as f:
+        return json.load(f)
+
+
+def test_launch_cpu(tmp_path):
+    info = run(tmp_path, n_threads=2)
+    assert info['n_threads'] == 2
+    assert info['visible'] == os.environ.get('CUDA_VISIBLE_DEVICES')
+
+
+def test_launch_failure(tmp_path):
+    process = launch(os.remove, (str(tmp_path / 'missing'),), 1)
+    assert process.wait(timeout=300) == 1
+
+
+@pytest.mark.skipif(not list_gpus(), reason='no GPU')
+def test_launch_gpu(tmp_path):
+    for gpu in list_gpus():
+        info = run(tmp_path, gpu)
+        # the assigned GPU is the only device of the job
+        assert info['visible'] == str(gpu)
+        assert info['device_count'] == 1 and info['current_device'] == 0